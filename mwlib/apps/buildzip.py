@@ -100,6 +100,15 @@ def main():
     parser.add_option("-s", "--status-file",
                       help='write status/progress info to this file')
 
+    parser.add_option("--previous",
+                      help="reuse unchanged articles and images from this previously built zip file or nuwiki directory")
+
+    parser.add_option("--dump",
+                      help="read articles and templates from this xml dump instead of the wiki")
+
+    parser.add_option("--imagedir",
+                      help="copy images from this directory (used with --dump)")
+
     options, args = parser.parse_args()
     conf.readrc()
     use_help = 'Use --help for usage information.'
@@ -107,6 +116,10 @@ def main():
                         
     if parser.metabook is None and options.collectionpage is None:
         parser.error('Neither --metabook nor, --collectionpage or arguments specified.\n' + use_help)
+    if options.dump and not options.config:
+        parser.error('--dump needs --config with the base URL of the wiki.\n' + use_help)
+    if options.collectionpage and options.dump:
+        parser.error('Specify either --collectionpage or --dump.\n' + use_help)
     if options.posturl and options.getposturl:
         parser.error('Specify either --posturl or --getposturl.\n' + use_help)
     if not options.posturl and not options.getposturl and not options.output:
@@ -0,0 +1,302 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""mw-bulkparse - installed via setuptools' entry_points
+
+parses all pages of a dump or nuwiki in a pool of processes and writes
+one json object per page to the output file. every worker opens the
+wiki once and keeps it for the pages it parses. on python 2.7 workers
+are replaced after a number of pages, which bounds the memory they use.
+
+the number of pages done is written to OUTPUT.checkpoint from time to
+time together with the size of the output at that point, so that an
+interrupted run can be resumed.
+"""
+
+import os, sys, time, shutil, StringIO, multiprocessing
+from collections import deque
+
+from mwlib import myjson as json
+
+result_types = ("stats", "errors", "trees")
+
+
+def open_nuwiki(path):
+    """return the nuwiki in the directory path. no snapshot is written,
+    the directory may be a shared or read-only one"""
+    from mwlib import nuwiki
+
+    return nuwiki.adapt(nuwiki.NuWiki(path, snapshot=False))
+
+
+def unzip_nuwiki(path):
+    """extract the nuwiki zip file at path into a temporary directory
+    and return the directory, which the caller has to remove"""
+    import tempfile, zipfile
+    from mwlib import nuwiki
+
+    tmpdir = tempfile.mkdtemp(prefix="bulkparse-")
+    try:
+        nuwiki.extractall(zipfile.ZipFile(path), tmpdir)
+    except:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return tmpdir
+
+
+def open_wikidb(kind, path, siteinfo=None):
+    """return the wikidb for the nuwiki or dump at path. dumps, which
+    have not been indexed, can't expand templates and get a wikidb
+    with siteinfo only"""
+    if kind == "nuwiki":
+        return open_nuwiki(path)
+
+    from mwlib import dumpindex
+    if os.path.exists(dumpindex.get_index_path(path)):
+        return dumpindex.dumpwiki(path)
+
+    from mwlib.dummydb import DummyDB
+    db = DummyDB()
+    db.siteinfo = siteinfo
+    return db
+
+
+def iter_dump(path, namespaces):
+    """yield (title, revid, raw, expanded) for the pages of the dump at
+    path and None for those, which should not be parsed"""
+    from mwlib import nshandling
+    from mwlib.dumpparser import DumpParser, complete_siteinfo
+
+    parser = DumpParser(path)
+    nshandler = None
+    for p in parser:
+        if nshandler is None:
+            nshandler = nshandling.nshandler(complete_siteinfo(parser.siteinfo))
+        ns = getattr(p, "namespace", None)
+        if ns is None:
+            ns = nshandler.splitname(p.title)[0]
+        txt = getattr(p, "text", None)
+        if ns not in namespaces or not txt or nshandler.redirect_matcher(txt):
+            yield None
+        else:
+            yield p.title, getattr(p, "revid", None), txt, False
+
+
+def iter_nuwiki(path, namespaces):
+    nw = open_nuwiki(path).nuwiki
+    for title in nw.iter_titles():
+        p = nw.get_page(title)
+        if p is None or p.ns not in namespaces or not p.rawtext or title in nw.redirects:
+            yield None
+        else:
+            yield title, p.revid, p.rawtext, bool(p.expanded)
+
+
+_wikidb = None
+_results = "stats"
+_expand = True
+
+
+def _init_worker(kind, path, siteinfo, results):
+    global _wikidb, _results, _expand
+    _wikidb = open_wikidb(kind, path, siteinfo)
+    _results = results
+    _expand = kind == "nuwiki" or hasattr(_wikidb, "normalize_and_get_page")
+
+
+def parse_page(title, revid, raw, expanded):
+    """parse a page in a worker. return the json serializable result
+    or None if there is nothing to report"""
+    from mwlib.refine.uparser import parseString
+    from mwlib.parser import show
+
+    stime = time.time()
+    res = dict(title=title, revid=revid)
+    try:
+        tree = parseString(title=title, raw=raw, wikidb=_wikidb, revision=revid,
+                           expandTemplates=_expand and not expanded)
+    except Exception, err:
+        res["error"] = "%s: %s" % (err.__class__.__name__, err)
+        return res
+
+    if _results == "errors":
+        return None
+
+    if _results == "trees":
+        out = StringIO.StringIO()
+        show(out, tree)
+        res["tree"] = out.getvalue()
+        return res
+
+    nodes = 0
+    for x in tree.allchildren():
+        nodes += 1
+    res.update(size=len(raw), nodes=nodes, seconds=round(time.time() - stime, 4))
+    return res
+
+
+def _parse_task(args):
+    return parse_page(*args)
+
+
+class checkpoint(object):
+    """number of pages done and size of the output after them"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return dict(done=0, size=0)
+        return json.load(open(self.path, "rb"))
+
+    def write(self, done, size):
+        tmp = self.path + ".tmp"
+        f = open(tmp, "wb")
+        json.dump(dict(done=done, size=size), f)
+        f.close()
+        os.rename(tmp, self.path)
+
+
+def bulkparse(kind, path, output, processes=None, results="stats", namespaces=(0,),
+              resume=False, checkpoint_every=1000, maxtasksperchild=500, window=None):
+    """parse the pages of the nuwiki or dump (kind) at path and write
+    the results to output. return dict with counts.
+
+    nuwiki zip files are extracted once into a temporary directory,
+    which is shared by all workers.
+    """
+    assert results in result_types, "results must be one of %s" % (", ".join(result_types),)
+    tmpdir = None
+    if kind == "nuwiki" and os.path.isfile(path):
+        tmpdir = path = unzip_nuwiki(path)
+    try:
+        return _bulkparse(kind, path, output, processes, results, namespaces,
+                          resume, checkpoint_every, maxtasksperchild, window)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _bulkparse(kind, path, output, processes, results, namespaces,
+               resume, checkpoint_every, maxtasksperchild, window):
+    processes = processes or multiprocessing.cpu_count()
+    window = window or processes * 8
+
+    cp = checkpoint(output + ".checkpoint")
+    state = cp.read() if resume else dict(done=0, size=0)
+    if resume and os.path.exists(output):
+        out = open(output, "r+b")
+        out.truncate(state["size"])
+        out.seek(state["size"])
+    else:
+        out = open(output, "wb")
+
+    siteinfo = None
+    if kind == "nuwiki":
+        tasks = iter_nuwiki(path, namespaces)
+    else:
+        from mwlib.dumpparser import DumpParser, complete_siteinfo
+        siteinfo = complete_siteinfo(DumpParser(path).read_siteinfo())
+        tasks = iter_dump(path, namespaces)
+
+    kw = {}
+    if sys.version_info >= (2, 7):  # python 2.6 never replaces workers
+        kw["maxtasksperchild"] = maxtasksperchild
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(kind, path, siteinfo, results), **kw)
+    pending = deque()  # AsyncResult or None for items not parsed
+    counts = dict(done=state["done"], parsed=0, errors=0)
+    stime = time.time()
+
+    for i in xrange(state["done"]):
+        tasks.next()
+
+    def submit():
+        """queue the items up to the next page to parse. return False if
+        there are none left"""
+        for task in tasks:
+            if task is None:
+                pending.append(None)
+                continue
+            pending.append(pool.apply_async(_parse_task, (task,)))
+            return True
+        return False
+
+    def save():
+        out.flush()
+        os.fsync(out.fileno())
+        cp.write(counts["done"], out.tell())
+
+    try:
+        for i in xrange(window):
+            if not submit():
+                break
+
+        while pending:
+            ar = pending.popleft()
+            if ar is not None:
+                res = ar.get()
+                submit()
+                counts["parsed"] += 1
+                if res is not None:
+                    if "error" in res:
+                        counts["errors"] += 1
+                    out.write(json.dumps(res) + "\n")
+            counts["done"] += 1
+            if counts["done"] % checkpoint_every == 0:
+                save()
+        save()
+    finally:
+        pool.terminate()
+        pool.join()
+        out.close()
+
+    counts["seconds"] = time.time() - stime
+    return counts
+
+
+def main():
+    import optparse
+    from mwlib import conf
+
+    parser = optparse.OptionParser(usage="%prog [OPTIONS] (--dump DUMP | --nuwiki NUWIKI) -o OUTPUT")
+    a = parser.add_option
+    a("--dump", help="parse the pages of this xml dump (templates are expanded if it has been indexed with mw-index-dump)")
+    a("--nuwiki", help="parse the pages of this nuwiki directory or zip file")
+    a("-o", "--output", help="write one json object per page to OUTPUT")
+    a("-r", "--results", default="stats",
+      help="what to write: %s (default: stats)" % (", ".join(result_types),))
+    a("-j", "--processes", type="int", help="number of worker processes (default: number of cpus)")
+    a("-n", "--namespace", action="append", type="int",
+      help="parse pages in this namespace (may be given more than once, default: 0)")
+    a("--resume", action="store_true", help="continue an interrupted run from OUTPUT.checkpoint")
+    a("--checkpoint-every", type="int", default=1000, help="write a checkpoint every N pages (default: 1000)")
+    a("--max-tasks-per-child", type="int", default=500,
+      help="replace worker processes after parsing N pages to bound their memory (default: 500, needs python 2.7)")
+
+    options, args = parser.parse_args()
+    conf.readrc()
+
+    if bool(options.dump) == bool(options.nuwiki):
+        parser.error("specify either --dump or --nuwiki")
+    if not options.output:
+        parser.error("--output is required")
+    if options.results not in result_types:
+        parser.error("--results must be one of %s" % (", ".join(result_types),))
+
+    kind, path = ("dump", options.dump) if options.dump else ("nuwiki", options.nuwiki)
+    res = bulkparse(kind, path, options.output,
+                    processes=options.processes,
+                    results=options.results,
+                    namespaces=tuple(options.namespace or (0,)),
+                    resume=options.resume,
+                    checkpoint_every=options.checkpoint_every,
+                    maxtasksperchild=options.max_tasks_per_child)
+
+    print "parsed %(parsed)d pages (%(errors)d errors) in %(seconds).1fs" % res
+    if res["seconds"]:
+        print "%.1f pages/s" % (res["parsed"] / res["seconds"],)
+    if sys.platform in ("linux2", "linux3"):
+        from mwlib import linuxmem
+        print "peak rss of main process: %.1fMB" % linuxmem.peak()
@@ -0,0 +1,80 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""mw-fetch-bench - installed via setuptools' entry_points
+
+builds a nuwiki from a recording made with fetch.record (e.g. by
+running mw-zip with MWLIB_FETCH_RECORD=recording.jsonl) and reports
+how long it took.
+"""
+
+import os, sys, time, tempfile, shutil
+
+
+def run_bench(recording, options, metabook_from_options, latency=0.0, bandwidth=None, error_rate=0.0):
+    """replay recording and build a nuwiki for the collection
+    metabook_from_options(options) returns. return dict with the
+    benchmark's results"""
+    from mwlib.net.replay import replay_server
+    from mwlib.apps.make_nuwiki import make_nuwiki
+
+    server = replay_server(recording, latency=latency, bandwidth=bandwidth, error_rate=error_rate)
+    server.start()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        options.config = server.local_url(options.config)
+        metabook = metabook_from_options(options)
+        stime = time.time()
+        make_nuwiki(os.path.join(tmpdir, "nuwiki"), metabook=metabook, options=options)
+        needed = time.time() - stime
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return dict(requests=server.requests, bytes=server.bytes_sent, errors=server.errors,
+                missing=server.missing, merged=server.merged, seconds=needed)
+
+
+def main():
+    from gevent import monkey
+    monkey.patch_all(thread=False)
+
+    from mwlib.options import OptionParser
+    from mwlib import conf
+
+    parser = OptionParser(usage="%prog --recording RECORDING -c BASEURL [OPTIONS] [ARTICLE ...]")
+    parser.add_option("--recording", help="replay responses recorded in RECORDING")
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="add LATENCY seconds to every request (default: 0)")
+    parser.add_option("--bandwidth", type="float", default=0.0,
+                      help="limit responses to BANDWIDTH kB/s (default: unlimited)")
+    parser.add_option("--error-rate", type="float", default=0.0,
+                      help="answer this share of requests with 503 errors (default: 0)")
+    parser.add_option("--previous", help="reuse articles and images from this nuwiki or zip file")
+
+    options, args = parser.parse_args()
+    conf.readrc()
+
+    if not options.recording:
+        parser.error("--recording is required")
+    if not (options.config or "").startswith(("http://", "https://")):
+        parser.error("-c must be the base url of the recorded wiki")
+    if parser.metabook is None and options.collectionpage is None:
+        parser.error("no articles specified")
+
+    def metabook_from_options(options):
+        env = parser.makewiki()
+        assert env.metabook, "no metabook"
+        return env.metabook
+
+    res = run_bench(options.recording, options, metabook_from_options,
+                    latency=options.latency,
+                    bandwidth=options.bandwidth * 1024 or None,
+                    error_rate=options.error_rate)
+
+    print "requests: %(requests)d (%(errors)d errors injected, %(missing)d not recorded, %(merged)d merged)" % res
+    print "bytes: %(bytes)d" % res
+    print "wall time: %(seconds).2fs" % res
+    if sys.platform in ("linux2", "linux3"):
+        from mwlib import linuxmem
+        print "peak rss: %.1fMB" % linuxmem.peak()
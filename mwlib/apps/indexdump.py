@@ -0,0 +1,27 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""mw-index-dump - installed via setuptools' entry_points
+
+writes the index of a mediawiki xml dump, which mwlib.dumpindex.dumpwiki
+uses to read single pages from it.
+"""
+
+
+def main():
+    import optparse
+    from mwlib import conf
+    from mwlib.dumpindex import index_dump
+
+    parser = optparse.OptionParser(usage="%prog [OPTIONS] DUMP")
+    parser.add_option("-o", "--output", help="write index to OUTPUT (default: DUMP.index)")
+    parser.add_option("-j", "--processes", type="int",
+                      help="number of processes decompressing bz2 dumps (default: number of cpus)")
+    parser.add_option("--stream-index", help="multistream index of a bz2 dump published by wikimedia")
+    options, args = parser.parse_args()
+    conf.readrc()
+
+    if len(args) != 1:
+        parser.error("exactly one dump must be given")
+    count = index_dump(args[0], options.output, processes=options.processes, streamindex=options.stream_index)
+    print "indexed %d pages" % (count,)
@@ -2,7 +2,7 @@
 # Copyright (c) 2007-2009 PediaPress GmbH
 # See README.rst for additional licensing information.
 
-import os
+import os, zipfile
 from mwlib.net import fetch, sapi as mwapi
 
 from mwlib.parse_collection_page import extract_metadata
@@ -14,7 +14,8 @@ import gevent.pool
 
 class start_fetcher(object):
     progress = None
-    
+    previous = None
+
     def __init__(self, **kw):
         self.fetcher = None
         self.__dict__.update(kw)
@@ -56,7 +57,30 @@ class start_fetcher(object):
                                      progress=self.progress, 
                                      imagesize=self.options.imagesize,
                                      cover_image=metabook.cover_image,
-                                     fetch_images=not self.options.noimages)
+                                     fetch_images=not self.options.noimages,
+                                     previous=self.previous)
+        self.fetcher.run()
+
+    def fetch_pages_from_dump(self):
+        from mwlib.net.dumpfetch import dumpfetcher
+
+        fsout = self.fsout
+        metabook = self.metabook
+        fsout.dump_json(metabook=metabook)
+        nfo = self.nfo.copy()
+        nfo.update({
+                'format': 'nuwiki',
+                'base_url': self.base_url,
+                'script_extension': self.options.script_extension})
+        fsout.nfo = nfo
+
+        pages = fetch.pages_from_metabook(metabook)
+        self.fetcher = dumpfetcher(self.options.dump, fsout, pages,
+                                   licenses=self.licenses,
+                                   imagedir=getattr(self.options, "imagedir", None),
+                                   fetch_images=not self.options.noimages,
+                                   status=self.status,
+                                   progress=self.progress)
         self.fetcher.run()
 
     def init_variables(self):
@@ -114,6 +138,10 @@ class start_fetcher(object):
         
         self.licenses = get_licenses(self.metabook)
 
+        if getattr(self.options, "dump", None):
+            self.fetch_pages_from_dump()
+            return
+
         api = self.get_api()
         self.fetch_collectionpage(api)
         self.fetch_pages_from_metabook(api)
@@ -142,6 +170,25 @@ def wikitrust(baseurl, metabook):
         except Exception, err:
             print "error choosing trusted revision for", repr(x.title),  repr(err)
 
+def open_previous(path, id=""):
+    """open the nuwiki for wiki id from the previously built zip file
+    or nuwiki directory path. return None if it's not there.
+    """
+    from mwlib import nuwiki
+
+    if os.path.isdir(path):
+        path = os.path.join(path, id)
+        if not os.path.exists(os.path.join(path, "siteinfo.json")):
+            return None
+        return nuwiki.adapt(path)
+
+    prefix = id and id + "/"
+    zf = zipfile.ZipFile(path)
+    if prefix + "siteinfo.json" not in zf.namelist():
+        return None
+    return nuwiki.adapt(zf, prefix=prefix)
+
+
 def make_nuwiki(fsdir, metabook, options, podclient=None, status=None):
     id2wiki = {}
     for x in metabook.wikis:
@@ -152,12 +199,16 @@ def make_nuwiki(fsdir, metabook, options, podclient=None, status=None):
         id2wiki[x.wikiident][1].append(x)
 
     is_multiwiki = len(id2wiki)>1
-    
+    assert not (is_multiwiki and getattr(options, "dump", None)), "a dump can only be used for articles from one wiki"
+
     if is_multiwiki:
         progress = fetch.shared_progress(status=status)
     else:
         progress = None
         
+    previous_path = getattr(options, "previous", None)
+    previous = []
+
     fetchers =[]
     for id, (wikiconf, articles) in id2wiki.items():
         if id is None:
@@ -178,7 +229,14 @@ def make_nuwiki(fsdir, metabook, options, podclient=None, status=None):
 
         wikitrust(wikiconf.baseurl, my_mb)
 
-        fetchers.append(start_fetcher(fsdir=my_fsdir, progress=progress, base_url=wikiconf.baseurl, metabook=my_mb, options=options, podclient=podclient, status=status))
+        if previous_path:
+            prev = open_previous(previous_path, id)
+            if prev is not None:
+                previous.append(prev)
+        else:
+            prev = None
+
+        fetchers.append(start_fetcher(fsdir=my_fsdir, progress=progress, base_url=wikiconf.baseurl, metabook=my_mb, options=options, podclient=podclient, status=status, previous=prev))
 
     if is_multiwiki:
         if not os.path.exists(fsdir):
@@ -189,7 +247,11 @@ def make_nuwiki(fsdir, metabook, options, podclient=None, status=None):
     pool = gevent.pool.Pool()
     for x in fetchers:
         pool.spawn(x.run)
-    pool.join(raise_error=True)
+    try:
+        pool.join(raise_error=True)
+    finally:
+        for x in previous:
+            x.clear()
 
     import signal
     signal.signal(signal.SIGINT,  signal.SIG_DFL)
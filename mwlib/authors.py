@@ -10,10 +10,12 @@ class inspect_authors(object):
     ip_rex = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
     ip6_rex = re.compile(r'^(((?=.*(::))(?!.*\3.+\3))\3?|[\dA-F]{1,4}:)([\dA-F]{1,4}(\3|:\b)|\2){5}(([\dA-F]{1,4}(\3|:\b|$)|\2){2}|(((2[0-4]|1\d|[1-9])?\d|25[0-5])\.?\b){4})\Z', re.I)
     bot_rex = re.compile(r'bot$', re.IGNORECASE)
-    ANON = "ANONIPEDITS"
+    ANON = "ANONIPEDITS"  # number of edits by anonymous users
+    ANON_CONTRIBUTORS = "ANONCONTRIBUTORS"  # number of anonymous users
 
     def __init__(self):
         self.num_anon = 0
+        self.num_anon_contributors = None  # set instead of num_anon by prop=contributors
         self.authors = set()
 
     def scan_edits(self, revs):
@@ -45,7 +47,10 @@ class inspect_authors(object):
 
         authors = list(self.authors)
         authors.sort()
-        if authors or self.num_anon:
+        if self.num_anon_contributors is not None:
+            if authors or self.num_anon_contributors:
+                authors.append("%s:%d" % (self.ANON_CONTRIBUTORS, self.num_anon_contributors))
+        elif authors or self.num_anon:
             authors.append("%s:%d" % (self.ANON, self.num_anon))  # append anon
         return authors
 
@@ -0,0 +1,222 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""random access to the pages of mediawiki xml dumps.
+
+index_dump scans a dump once and stores the position of every page in
+an sqlite database next to it. dumpwiki is a wikidb, which reads pages
+by seeking straight to them. dumps are either uncompressed or
+multistream bz2 files as published by wikimedia, i.e. concatenated bz2
+streams of about 100 pages each. positions in those are the offset and
+length of the stream and the position of the page in the decompressed
+stream.
+"""
+
+import os, sqlite3
+
+try:
+    from xml.etree import cElementTree
+except ImportError:
+    import cElementTree
+
+from mwlib import nshandling, conf, myjson as json
+from mwlib.dumpparser import DumpParser, complete_siteinfo
+from mwlib.multistream import find_streams, iter_ranges, decompress_range, scan_elements
+from mwlib.lrucache import lrucache
+from mwlib.nuwiki import page
+
+
+def get_index_path(dumppath):
+    return dumppath + ".index"
+
+
+class indexer(object):
+    """writes the index of a dump"""
+
+    batchsize = 10000
+
+    def __init__(self, dumppath, indexpath=None, processes=None, streamindex=None):
+        self.dumppath = dumppath
+        self.indexpath = indexpath or get_index_path(dumppath)
+        if processes is None:
+            processes = conf.get("dump", "processes", 0, int)
+        self.processes = processes
+        self.streamindex = streamindex
+        self.parser = DumpParser(dumppath)
+        self.siteinfo = None
+        self.nshandler = None
+        self.rows = []
+        self.count = 0
+
+    def handle(self, stream, stream_length, offset, xml):
+        elem = cElementTree.fromstring(xml)
+        if self.parser.getTag(elem) == "siteinfo":
+            self.parser.handleSiteinfo(elem)
+            self._set_siteinfo(self.parser.siteinfo)
+            return
+
+        if self.nshandler is None:
+            self._set_siteinfo(None)
+
+        p = self.parser.handlePageElement(elem)
+        txt = getattr(p, "text", None) or u""
+        target = self.nshandler.redirect_matcher(txt)
+        if target:
+            target = self.nshandler.get_fqname(target)
+        ns = getattr(p, "namespace", None)
+        if ns is None:
+            ns = self.nshandler.splitname(p.title)[0]
+        self.rows.append((p.title, ns, getattr(p, "revid", None), stream, stream_length, offset, len(xml), target))
+        self.count += 1
+        if len(self.rows) >= self.batchsize:
+            self.flush()
+
+    def _set_siteinfo(self, dsi):
+        self.siteinfo = complete_siteinfo(dsi)
+        self.nshandler = nshandling.nshandler(self.siteinfo)
+
+    def flush(self):
+        self.conn.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.rows)
+        self.rows = []
+
+    def scan(self):
+        if self.dumppath.lower().endswith(".bz2"):
+            ranges = find_streams(self.dumppath, indexpath=self.streamindex)
+            for stream, length, data in iter_ranges(self.dumppath, ranges, processes=self.processes or None):
+                def handle(offset, xml):
+                    self.handle(stream, length, offset, xml)
+                if scan_elements(data.splitlines(True), handle) is not None:
+                    raise ValueError("page crosses the end of the bz2 stream at %d. not a multistream dump?" % (stream,))
+            return
+
+        if self.dumppath.lower().endswith(".7z"):
+            raise ValueError("7z compressed dumps can not be indexed")
+
+        f = open(self.dumppath, "rb")
+        try:
+            def handle(offset, xml):
+                self.handle(None, None, offset, xml)
+            scan_elements(f, handle)
+        finally:
+            f.close()
+
+    def resolve_redirects(self, maxdepth=5):
+        """let redirects point to the final target of redirect chains"""
+        for i in range(maxdepth):
+            cur = self.conn.execute("""UPDATE pages SET target=(SELECT p.target FROM pages p WHERE p.title=pages.target)
+                                       WHERE target IS NOT NULL AND
+                                       (SELECT p.target FROM pages p WHERE p.title=pages.target) IS NOT NULL""")
+            if not cur.rowcount:
+                break
+
+    def run(self):
+        tmp = self.indexpath + ".tmp"
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        self.conn = sqlite3.connect(tmp)
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("""CREATE TABLE pages (title TEXT PRIMARY KEY, ns INTEGER, revid INTEGER,
+                             stream INTEGER, stream_length INTEGER, offset INTEGER, length INTEGER, target TEXT)""")
+        self.conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        self.scan()
+        self.flush()
+        if self.siteinfo is None:
+            self._set_siteinfo(None)
+        self.resolve_redirects()
+
+        st = os.stat(self.dumppath)
+        meta = dict(siteinfo=json.dumps(self.siteinfo), size=str(st.st_size), mtime=str(int(st.st_mtime)))
+        self.conn.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+        self.conn.commit()
+        self.conn.close()
+        os.rename(tmp, self.indexpath)
+        return self.count
+
+
+def index_dump(dumppath, indexpath=None, processes=None, streamindex=None):
+    """write the index of the dump at dumppath, by default to
+    dumppath.index. return the number of pages. bz2 dumps are
+    decompressed by processes processes, using wikimedia's multistream
+    index streamindex if given."""
+    return indexer(dumppath, indexpath, processes=processes, streamindex=streamindex).run()
+
+
+class dumpwiki(object):
+    """wikidb reading the pages of an indexed dump"""
+
+    def __init__(self, dumppath, indexpath=None, cachesize=16):
+        self.dumppath = dumppath
+        indexpath = indexpath or get_index_path(dumppath)
+        if not os.path.exists(indexpath):
+            raise RuntimeError("dump %r has not been indexed" % (dumppath,))
+        self.conn = sqlite3.connect(indexpath)
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+
+        st = os.stat(dumppath)
+        if meta["size"] != str(st.st_size) or meta["mtime"] != str(int(st.st_mtime)):
+            raise RuntimeError("index %r does not belong to dump %r" % (indexpath, dumppath))
+
+        self.siteinfo = json.loads(meta["siteinfo"])
+        self.nshandler = nshandling.nshandler(self.siteinfo)
+        self.file = open(dumppath, "rb")
+        self.stream_cache = lrucache(cachesize)  # offset -> decompressed stream
+        self.parser = DumpParser(dumppath)
+
+    def close(self):
+        self.file.close()
+        self.conn.close()
+
+    def get_siteinfo(self):
+        return self.siteinfo
+
+    def _read(self, stream, stream_length, offset, length):
+        if stream is None:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+        try:
+            data = self.stream_cache[stream]
+        except KeyError:
+            self.file.seek(stream)
+            data = self.stream_cache[stream] = decompress_range(self.file.read(stream_length))
+        return data[offset:offset + length]
+
+    def _lookup(self, name):
+        return self.conn.execute("SELECT title, ns, revid, stream, stream_length, offset, length, target FROM pages WHERE title=?",
+                                 (name,)).fetchone()
+
+    def _make_page(self, row):
+        title, ns, revid, stream, stream_length, offset, length, target = row
+        elem = cElementTree.fromstring(self._read(stream, stream_length, offset, length))
+        p = self.parser.handlePageElement(elem)
+        return page(dict(title=title, ns=ns, revid=revid), rawtext=getattr(p, "text", None) or u"")
+
+    def get_redirect(self, name):
+        """return the final target of redirect name or None"""
+        row = self._lookup(name)
+        if row is None:
+            return None
+        return row[-1]
+
+    def get_page(self, name, revision=None):
+        row = self._lookup(name)
+        if row is None:
+            return None
+        target = row[-1]
+        if target:
+            trow = self._lookup(target)
+            if trow is not None:
+                row = trow
+        return self._make_page(row)
+
+    def normalize_and_get_page(self, name, defaultns):
+        fqname = self.nshandler.get_fqname(name, defaultns=defaultns)
+        return self.get_page(fqname)
+
+    def normalize_and_get_image_path(self, name):
+        return None
+
+    def __repr__(self):
+        return "<dumpwiki %s cache hits=%s misses=%s>" % (self.dumppath, self.stream_cache.hits, self.stream_cache.misses)
+
@@ -1,11 +1,16 @@
 import os
 import re
+import copy
+import urlparse
 
 try:
     from xml.etree import cElementTree
 except ImportError:
     import cElementTree
 
+from mwlib import conf, multistream
+from mwlib.siteinfo import get_siteinfo
+
 ns = '{http://www.mediawiki.org/xml/export-0.3/}'
 class Tags:
 
@@ -68,14 +73,40 @@ class Page(object):
 class DumpParser(object):
 
     tags = Tags()
+    siteinfo = None
 
     def __init__(self, xmlfilename,
-                 ignore_redirects=False):
+                 ignore_redirects=False,
+                 processes=None, ordered=True, streamindex=None, multistream=False):
+        """.bz2 dumps are decompressed with bunzip2 unless multistream
+        is true or wikimedia's multistream index streamindex is given.
+        multistream dumps are decompressed by processes processes
+        (default: dump.processes or the number of cpus, 1 uses bunzip2).
+        if ordered is False, pages are parsed by the processes, too,
+        and yielded in the order they are ready.
+        """
         self.xmlfilename = xmlfilename
         self.ignore_redirects = ignore_redirects
+        if processes is None:
+            processes = conf.get("dump", "processes", 0, int)
+        self.processes = processes
+        self.ordered = ordered
+        self.streamindex = streamindex
+        self.multistream = multistream
+
+    def _get_streams(self):
+        if not (self.multistream or self.streamindex):
+            return None
+        if self.processes == 1 or not self.xmlfilename.lower().endswith(".bz2"):
+            return None
+        return multistream.get_streams(self.xmlfilename, indexpath=self.streamindex)
 
     def openInputStream(self):
         if self.xmlfilename.lower().endswith(".bz2"):
+            streams = self._get_streams()
+            if streams is not None:
+                return multistream.streamfile(
+                    multistream.iter_ranges(self.xmlfilename, streams, processes=self.processes or None))
             f = os.popen("bunzip2 -c %s" % self.xmlfilename, "r")
         elif self.xmlfilename.lower().endswith(".7z"):
             f = os.popen("7z -so x %s" % self.xmlfilename, "r")
@@ -87,33 +118,75 @@ class DumpParser(object):
     @staticmethod
     def getTag(elem):
         # rough is good enough
-        return elem.tag[elem.tag.rindex('}')+1:]
+        return elem.tag[elem.tag.rfind('}')+1:]
 
     def handleSiteinfo(self, siteinfo):
-        pass
-    
-        # for nsElem in siteinfo.findall(self.tags.namespace):
-        #     try:
-        #         self.namespaces[nsElem.text.lower()] = int(nsElem.get('key'))
-        #     except AttributeError:
-        #         # text is probably None
-        #         pass
-        
+        """store <siteinfo> as self.siteinfo in the format of the api's
+        meta=siteinfo: general and namespaces"""
+        general = {}
+        namespaces = {}
+        for el in siteinfo:
+            tag = self.getTag(el)
+            if tag == 'namespaces':
+                for nsElem in el:
+                    key = int(nsElem.get('key'))
+                    namespaces[str(key)] = {
+                        'id': key,
+                        '*': unicode(nsElem.text or u''),
+                        'case': nsElem.get('case', 'first-letter')}
+            else:
+                general[tag] = unicode(el.text or u'')
+        self.siteinfo = dict(general=general, namespaces=namespaces)
+
+    def read_siteinfo(self):
+        """read the <siteinfo> at the start of the dump and return it"""
+        f = self.openInputStream()
+        try:
+            for evt, elem in cElementTree.iterparse(f):
+                tag = self.getTag(elem)
+                if tag == 'siteinfo':
+                    self.handleSiteinfo(elem)
+                    break
+                elif tag == 'page':
+                    break
+        finally:
+            f.close()
+        return self.siteinfo
+
     def __iter__(self):
+        if not self.ordered:
+            streams = self._get_streams()
+            if streams is not None:
+                return self._iter_unordered(streams)
+        return self._iter_ordered()
+
+    def _iter_unordered(self, streams):
+        results = multistream.iter_ranges(self.xmlfilename, streams, processes=self.processes or None,
+                                          ordered=False, parse=dict(ignore_redirects=self.ignore_redirects))
+        for offset, length, (siteinfo, pages, unfinished) in results:
+            if unfinished is not None:
+                results.close()
+                raise ValueError("page crosses the end of the bz2 stream at %d. not a multistream dump?" % (offset,))
+            if siteinfo is not None:
+                self.siteinfo = siteinfo
+            for page in pages:
+                yield page
+
+    def _iter_ordered(self):
         f = self.openInputStream()    
-        
-        elemIter = (el for evt, el in cElementTree.iterparse(f))
-        for elem in elemIter:
-            if self.getTag(elem) == 'page':
-                page = self.handlePageElement(elem)
-                if page:
-                    yield page
-                elem.clear()
-            elif self.getTag(elem) == 'siteinfo':
-                self.handleSiteinfo(elem)
-                elem.clear()
-        
-        f.close()
+        try:
+            elemIter = (el for evt, el in cElementTree.iterparse(f))
+            for elem in elemIter:
+                if self.getTag(elem) == 'page':
+                    page = self.handlePageElement(elem)
+                    if page:
+                        yield page
+                    elem.clear()
+                elif self.getTag(elem) == 'siteinfo':
+                    self.handleSiteinfo(elem)
+                    elem.clear()
+        finally:
+            f.close()
     
     def handlePageElement(self, pageElem):
         res = Page()
@@ -125,6 +198,8 @@ class DumpParser(object):
                 res.title = title
             elif tag == 'id':
                 res.pageid = int(el.text)
+            elif tag == 'ns':
+                res.namespace = int(el.text)
             elif tag == 'revision':
                 lastRevision = el
 
@@ -151,7 +226,7 @@ class DumpParser(object):
             elif tag == 'comment':
                 res.comment = unicode(el.text)
             elif tag == 'text':
-                res.text = unicode(el.text)
+                res.text = unicode(el.text or u'')
                 el.clear()
 
         return res
@@ -165,3 +240,24 @@ class DumpParser(object):
             elif self.getTag(el) == 'id':
                 userid = int(el.text)
         return (username, userid)
+
+
+def complete_siteinfo(dsi):
+    """return the siteinfo dsi read from a dump completed with the magic
+    words and interwikis, which dumps do not contain, from the siteinfo
+    shipped for the language of the wiki or english"""
+    dsi = dsi or dict(general={}, namespaces={})
+    base = dsi["general"].get("base", u"")
+    lang = urlparse.urlsplit(base)[1].split(".")[0]
+    si = copy.deepcopy(get_siteinfo(lang) or get_siteinfo("en"))
+    si["general"].update(dsi["general"])
+    if dsi["namespaces"]:
+        namespaces = {}
+        for k, ns in dsi["namespaces"].items():
+            ns = dict(ns)
+            canonical = si["namespaces"].get(k, {}).get("canonical")
+            if canonical:
+                ns["canonical"] = canonical
+            namespaces[k] = ns
+        si["namespaces"] = namespaces
+    return si
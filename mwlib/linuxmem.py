@@ -34,6 +34,12 @@ def resident():
     return _readproc('VmRSS:')
 
 
+def peak():
+    '''Return peak resident memory usage in MB.
+    '''
+    return _readproc('VmHWM:')
+
+
 def stacksize():
     '''Return stack size in MB.
     '''
@@ -0,0 +1,356 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""decompress the independent bz2 streams of multistream dumps in a
+pool of processes.
+
+the streams are taken from wikimedia's multistream index
+(...-multistream-index.txt.bz2) if given, otherwise they are found by
+searching for bz2 stream headers. a header found inside of compressed
+data splits a stream in two parts, which both fail to decompress.
+such a stream is then decompressed in the calling process and the
+parts are skipped.
+"""
+
+import os, re, bz2, Queue, multiprocessing
+from collections import deque
+
+try:
+    from xml.etree import cElementTree
+except ImportError:
+    import cElementTree
+
+# 'BZh', block size, magic number of the first block
+_header_rx = re.compile(r"BZh[1-9]1AY&SY")
+
+# larger compressed streams mean that the dump is not a multistream dump
+max_stream_length = 64 * 1024 * 1024
+
+# decompressed streams larger than this are not part of a multistream dump
+max_stream_size = 256 * 1024 * 1024
+
+
+def iter_bz2_streams(f, blocksize=1024 * 1024, maxsize=max_stream_size):
+    """yield (offset, length, data) for every bz2 stream in the file
+    f, data being the decompressed stream"""
+    offset = 0
+    buf = f.read(blocksize)
+    while buf:
+        d = bz2.BZ2Decompressor()
+        out = []
+        size = length = 0
+        while buf:
+            try:
+                data = d.decompress(buf)
+            except EOFError:  # the stream ended with the previous block
+                break
+            out.append(data)
+            size += len(data)
+            if size > maxsize:
+                raise ValueError("bz2 stream at %d is larger than %d bytes. not a multistream dump?" % (offset, maxsize))
+            if d.unused_data:
+                length += len(buf) - len(d.unused_data)
+                buf = d.unused_data
+                break
+            length += len(buf)
+            buf = f.read(blocksize)
+
+        yield offset, length, "".join(out)
+        offset += length
+        if not buf:
+            buf = f.read(blocksize)
+
+
+def scan_elements(lines, handle, tags=("<page>", "<siteinfo>")):
+    """call handle(offset, xml) for every element starting with one of
+    tags in the iterable of byte strings lines. return the offset of
+    an unfinished element at the end or None."""
+    pos = 0
+    start = None
+    parts = []
+    endtag = None
+    for line in lines:
+        idx = 0
+        while 1:
+            if start is None:
+                found = [(line.find(t, idx), t) for t in tags]
+                found = [x for x in found if x[0] != -1]
+                if not found:
+                    break
+                idx, tag = min(found)
+                start = pos + idx
+                endtag = "</" + tag[1:]
+
+            j = line.find(endtag, idx)
+            if j == -1:
+                parts.append(line[idx:])
+                break
+
+            end = j + len(endtag)
+            parts.append(line[idx:end])
+            handle(start, "".join(parts))
+            start = None
+            parts = []
+            idx = end
+        pos += len(line)
+    return start
+
+
+class not_multistream(ValueError):
+    pass
+
+
+def _read_index(indexpath):
+    f = open(indexpath, "rb")
+    try:
+        if indexpath.lower().endswith(".bz2"):
+            data = "".join(x[2] for x in iter_bz2_streams(f))
+        else:
+            data = f.read()
+    finally:
+        f.close()
+
+    offsets = set()
+    for line in data.splitlines():
+        if line.strip():
+            offsets.add(int(line.split(":", 1)[0]))
+    return offsets
+
+
+def _search_headers(path, maxlength=None, blocksize=8 * 1024 * 1024):
+    """yield the offsets of the bz2 stream headers in path. raise
+    not_multistream as soon as more than maxlength bytes have been
+    read without finding one, e.g. in a single stream dump"""
+    f = open(path, "rb")
+    try:
+        pos = 0
+        last = 0
+        tail = ""
+        while 1:
+            block = f.read(blocksize)
+            if not block:
+                break
+            data = tail + block
+            start = pos - len(tail)
+            for mo in _header_rx.finditer(data):
+                last = start + mo.start()
+                yield last
+            # a header may span two blocks
+            tail = data[-9:]
+            pos += len(block)
+            if maxlength is not None and pos - len(tail) - last > maxlength:
+                raise not_multistream("bz2 stream at %d is larger than %d bytes" % (last, maxlength))
+    finally:
+        f.close()
+
+
+def find_streams(path, indexpath=None, maxlength=max_stream_length):
+    """yield (offset, length) of the ranges of path, which contain whole
+    bz2 streams. raise not_multistream if a range is larger than
+    maxlength."""
+    size = os.path.getsize(path)
+    if indexpath:
+        offsets = _read_index(indexpath)
+        offsets.add(0)
+        offsets = sorted(o for o in offsets if o < size)
+    else:
+        offsets = _search_headers(path, maxlength)
+
+    last = None
+    for o in offsets:
+        if last is not None:
+            if o - last > maxlength:
+                raise not_multistream("bz2 stream at %d is larger than %d bytes" % (last, maxlength))
+            yield last, o - last
+        last = o
+    if last is not None and size > last:
+        if size - last > maxlength:
+            raise not_multistream("bz2 stream at %d is larger than %d bytes" % (last, maxlength))
+        yield last, size - last
+
+
+def decompress_range(data):
+    """decompress the concatenated bz2 streams in data. raise IOError
+    or ValueError if data does not consist of complete streams"""
+    out = []
+    while data:
+        d = bz2.BZ2Decompressor()
+        out.append(d.decompress(data))
+        data = d.unused_data
+        if not data:
+            try:
+                d.decompress("\0")
+            except EOFError:  # the stream is complete
+                break
+            except IOError:
+                pass
+            raise ValueError("incomplete bz2 stream")
+    return "".join(out)
+
+
+def parse_pages(data, ignore_redirects=False):
+    """return (siteinfo, pages, unfinished) of the <siteinfo> and <page>
+    elements in the xml fragment data. unfinished is the offset of an
+    element, which is not finished at the end of data, or None."""
+    from mwlib.dumpparser import DumpParser
+
+    parser = DumpParser(None, ignore_redirects=ignore_redirects)
+    pages = []
+
+    def handle(offset, xml):
+        elem = cElementTree.fromstring(xml)
+        if parser.getTag(elem) == "siteinfo":
+            parser.handleSiteinfo(elem)
+            return
+        p = parser.handlePageElement(elem)
+        if p:
+            pages.append(p)
+
+    unfinished = scan_elements(data.splitlines(True), handle)
+    return parser.siteinfo, pages, unfinished
+
+
+def _read_range(args):
+    """decompress (and parse) a range of a dump in a worker process.
+    the result is None if the range does not contain whole streams."""
+    path, offset, length, parse = args
+    try:
+        f = open(path, "rb")
+        try:
+            f.seek(offset)
+            data = decompress_range(f.read(length))
+        finally:
+            f.close()
+        if parse is not None:
+            return offset, length, parse_pages(data, **parse)
+        return offset, length, data
+    except Exception:
+        return offset, length, None
+
+
+def _read_stream(path, offset, parse):
+    """decompress (and parse) the stream starting at offset in this
+    process"""
+    f = open(path, "rb")
+    try:
+        f.seek(offset)
+        start, length, data = iter_bz2_streams(f).next()
+    finally:
+        f.close()
+    if parse is not None:
+        return offset, length, parse_pages(data, **parse)
+    return offset, length, data
+
+
+def iter_ranges(path, ranges, processes=None, ordered=True, parse=None, window=None):
+    """decompress the (offset, length) ranges of path in a pool of
+    processes and yield (offset, length, data). ranges are yielded in
+    order unless ordered is False. if parse is a dict, data is the
+    (siteinfo, pages) parse_pages returns for it called with parse as
+    keyword arguments. at most window ranges are decompressed ahead.
+    with parse, the callers have to check that no element crosses the
+    end of a range, as these are not part of the pages."""
+    processes = processes or multiprocessing.cpu_count()
+    window = window or processes * 4
+    ranges = iter(ranges)
+    pool = multiprocessing.Pool(processes)
+    results = Queue.Queue()
+    pending = deque()
+
+    def submit():
+        for offset, length in ranges:
+            args = ((path, offset, length, parse),)
+            if ordered:
+                pending.append(pool.apply_async(_read_range, args))
+            else:
+                pending.append(None)
+                pool.apply_async(_read_range, args, callback=results.put)
+            return
+
+    try:
+        for i in range(window):
+            submit()
+
+        covered = 0
+        failed = []
+        while pending:
+            ar = pending.popleft()
+            if ordered:
+                offset, length, res = ar.get()
+            else:
+                offset, length, res = results.get()
+            submit()
+
+            if res is None:
+                if ordered:
+                    if offset >= covered:
+                        offset, length, res = _read_stream(path, offset, parse)
+                        covered = offset + length
+                        yield offset, length, res
+                else:
+                    failed.append(offset)
+                continue
+            if offset >= covered:
+                yield offset, length, res
+
+        for offset in sorted(failed):
+            if offset >= covered:
+                offset, length, res = _read_stream(path, offset, parse)
+                covered = offset + length
+                yield offset, length, res
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class streamfile(object):
+    """read-only file object for the decompressed data yielded by
+    iter_ranges"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf = ""
+        self.pos = 0
+
+    def read(self, size=-1):
+        while self.pos >= len(self.buf):
+            try:
+                offset, length, self.buf = self.chunks.next()
+            except StopIteration:
+                return ""
+            self.pos = 0
+        if size < 0:
+            res = self.buf[self.pos:]
+        else:
+            res = self.buf[self.pos:self.pos + size]
+        self.pos += len(res)
+        return res
+
+    def close(self):
+        self.chunks.close()
+
+
+def get_streams(path, indexpath=None):
+    """return an iterator over the ranges find_streams yields or None
+    if path is not a multistream dump"""
+    ranges = find_streams(path, indexpath=indexpath)
+    try:
+        first = ranges.next()
+    except (not_multistream, StopIteration):
+        return None
+
+    def all_ranges():
+        yield first
+        for r in ranges:
+            yield r
+
+    return all_ranges()
+
+
+def open_multistream(path, processes=None, indexpath=None):
+    """return a file object for the decompressed multistream dump path
+    or None if it is not one"""
+    ranges = get_streams(path, indexpath=indexpath)
+    if ranges is None:
+        return None
+    return streamfile(iter_ranges(path, ranges, processes=processes))
@@ -0,0 +1,106 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""on-disk cache for responses of the mediawiki api.
+
+responses are stored zlib compressed in a sqlite database, which may be
+shared by several processes. queries for nothing but the revisions
+of specific revision ids are cached forever, all other requests expire
+after a configurable time. e.g. prop=info tells the latest revision of
+a page and action=parse expands the current templates.
+"""
+
+import os, time, zlib, sqlite3
+from hashlib import sha1
+
+from mwlib import conf
+
+# parameters, which address immutable revisions
+_revision_params = ("revids", "rvstartid")
+
+# props of a query, which do not change for a given revision
+_revision_props = ("revisions",)
+
+
+class apicache(object):
+    def __init__(self, path, ttl=300, siteinfo_ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self.siteinfo_ttl = siteinfo_ttl
+        self.hits = 0
+        self.misses = 0
+
+        d = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.text_factory = str
+        try:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError:
+            pass
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, data BLOB)")
+            self.conn.execute("DELETE FROM responses WHERE expires > 0 AND expires < ?", (time.time(),))
+
+    def make_key(self, apiurl, params):
+        items = []
+        for k, v in sorted(params.items()):
+            if isinstance(v, unicode):
+                v = v.encode("utf-8")
+            items.append("%s=%s" % (k, v))
+        return sha1("%s?%s" % (apiurl, "&".join(items))).hexdigest()
+
+    def get_ttl(self, params):
+        """return number of seconds the response to the request with
+        params may be cached or None if it never expires"""
+        if "siteinfo" in str(params.get("meta", "")).split("|"):
+            return self.siteinfo_ttl
+        if params.get("action") != "query":
+            return self.ttl
+        props = str(params.get("prop", "")).split("|")
+        if [p for p in props if p not in _revision_props]:
+            return self.ttl
+        for k in _revision_params:
+            if k in params:
+                return None
+        return self.ttl
+
+    def get(self, apiurl, params):
+        key = self.make_key(apiurl, params)
+        row = self.conn.execute("SELECT expires, data FROM responses WHERE key=?", (key,)).fetchone()
+        if row is None or (row[0] and row[0] < time.time()):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return zlib.decompress(str(row[1]))
+
+    def set(self, apiurl, params, data):
+        ttl = self.get_ttl(params)
+        if ttl is not None and ttl <= 0:
+            return
+        expires = time.time() + ttl if ttl is not None else 0
+        key = self.make_key(apiurl, params)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, expires, data) VALUES (?, ?, ?)",
+                              (key, expires, sqlite3.Binary(zlib.compress(data))))
+
+    def __repr__(self):
+        return "<apicache %s hits=%s misses=%s>" % (self.path, self.hits, self.misses)
+
+
+_path2cache = {}
+
+
+def get_apicache():
+    """return the cache configured with fetch.apicache or None"""
+    path = conf.get("fetch", "apicache", "")
+    if not path:
+        return None
+    if path not in _path2cache:
+        _path2cache[path] = apicache(path,
+                                     ttl=conf.get("fetch", "apicache_ttl", 300, int),
+                                     siteinfo_ttl=conf.get("fetch", "apicache_siteinfo_ttl", 3600, int))
+    return _path2cache[path]
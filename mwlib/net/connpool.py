@@ -0,0 +1,171 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""persistent http connections for urllib2.
+
+connections are kept open after a response has been read completely
+and are reused for the next request to the same host. all state is
+modified without yielding to other greenlets, so a single pool can be
+shared by all greenlets of a process.
+"""
+
+import socket, httplib, urllib, urllib2
+
+from mwlib import conf
+
+
+class connpool(object):
+    """per host pool of idle httplib connections"""
+
+    def __init__(self, maxsize=20):
+        self.maxsize = maxsize
+        self.key2idle = {}
+        self.created = 0
+        self.reused = 0
+
+    def get(self, key, timeout=None):
+        """return (connection, reused) for key, which is a tuple of
+        scheme and host"""
+        idle = self.key2idle.get(key)
+        if idle:
+            self.reused += 1
+            return idle.pop(), True
+        return self.new(key, timeout=timeout), False
+
+    def new(self, key, timeout=None):
+        scheme, host = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=timeout)
+        self.created += 1
+        return conn
+
+    def put(self, key, conn):
+        idle = self.key2idle.setdefault(key, [])
+        if len(idle) < self.maxsize:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    def clear(self):
+        for idle in self.key2idle.values():
+            for conn in idle:
+                conn.close()
+        self.key2idle.clear()
+
+    def __repr__(self):
+        return "<connpool created=%s reused=%s>" % (self.created, self.reused)
+
+
+class pooled_response(object):
+    """file like wrapper of a httplib response, which hands the
+    connection back to the pool once the response has been read"""
+
+    def __init__(self, pool, key, conn, resp):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+
+    def _release(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        if self.resp.will_close:
+            conn.close()
+        else:
+            self.pool.put(self.key, conn)
+
+    def read(self, amt=None):
+        if self.conn is None and self.resp.isclosed():
+            return ""
+        data = self.resp.read(amt)
+        if self.resp.isclosed():
+            self._release()
+        return data
+
+    def readline(self):
+        lines = []
+        while 1:
+            c = self.read(1)
+            lines.append(c)
+            if not c or c == "\n":
+                break
+        return "".join(lines)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.resp.isclosed():
+            self._release()
+        else:
+            # the connection can't be reused with unread data pending
+            self.resp.close()
+            self.conn.close()
+            self.conn = None
+
+
+class keepalive_handler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """urllib2 handler for http and https urls using pooled connections"""
+
+    def __init__(self, pool=None):
+        urllib2.AbstractHTTPHandler.__init__(self)
+        self._context = None
+        self.pool = pool if pool is not None else get_pool()
+
+    def http_open(self, req):
+        return self.do_keepalive_open("http", req)
+
+    def https_open(self, req):
+        if getattr(req, "_tunnel_host", None):
+            return urllib2.HTTPSHandler.https_open(self, req)
+        return self.do_keepalive_open("https", req)
+
+    def _send(self, conn, req, headers):
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        return conn.getresponse(buffering=True)
+
+    def do_keepalive_open(self, scheme, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers["Connection"] = "keep-alive"
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        key = (scheme, host)
+        conn, reused = self.pool.get(key, timeout=req.timeout)
+        try:
+            try:
+                r = self._send(conn, req, headers)
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, try a fresh one
+                conn = self.pool.new(key, timeout=req.timeout)
+                r = self._send(conn, req, headers)
+        except socket.error, err:
+            conn.close()
+            raise urllib2.URLError(err)
+
+        fp = pooled_response(self.pool, key, conn, r)
+        resp = urllib.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+_pool = None
+
+
+def get_pool():
+    """return the connection pool shared by all users in this process.
+    it keeps up to fetch.max_connections idle connections per host"""
+    global _pool
+    if _pool is None:
+        _pool = connpool(conf.get("fetch", "max_connections", 20, int))
+    return _pool
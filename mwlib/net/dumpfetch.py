@@ -0,0 +1,218 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""build a nuwiki from a mediawiki xml dump instead of the api.
+
+the dump is read in passes. every pass takes the pages still needed
+and queues the templates and redirect targets they use, which may be
+found later in the same pass. pages, which had already been passed,
+are looked for in the next pass, up to the position at which they were
+queued. when nothing is left, the articles are expanded with the pages
+read to find templates with computed names and the images they use.
+"""
+
+import os, shutil
+from hashlib import md5
+
+from mwlib import nshandling
+from mwlib.dumpparser import DumpParser, complete_siteinfo
+from mwlib.expander import Expander, get_templates
+from mwlib.net.fetch import shared_progress, sourcedb
+from mwlib.net.imageusage import find_usages
+
+
+def find_image_file(imagedir, name):
+    """return the path of the file for image name (without namespace)
+    in imagedir or None. imagedir is either flat or uses mediawiki's
+    hashed upload directory layout"""
+    fn = name.replace(" ", "_").encode("utf-8")
+    h = md5(fn).hexdigest()
+    for p in [(h[0], h[:2], fn), (fn,), (name.encode("utf-8"),)]:
+        path = os.path.join(imagedir, *p)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+class dumpfetcher(object):
+    """fills fsout with the pages listed in pages, the templates and
+    redirects they need and the images they use, read from the xml dump
+    at path dump and the files in imagedir"""
+
+    def __init__(self, dump, fsout, pages, licenses,
+                 imagedir=None, fetch_images=True, status=None, progress=None):
+        if isinstance(dump, basestring):
+            dump = DumpParser(dump)
+        self.dump = dump
+        self.fsout = fsout
+        self.pages = pages
+        self.licenses = licenses
+        self.imagedir = imagedir
+        self.fetch_images = fetch_images and imagedir is not None
+        self.progress = progress or shared_progress(status=status)
+
+        siteinfo = complete_siteinfo(dump.read_siteinfo())
+        self.fsout.write_siteinfo(siteinfo)
+        self.nshandler = nshandling.nshandler(siteinfo)
+
+        self.sources = {}  # title -> raw text
+        self.revids = {}  # title -> revid
+        self.redirects = {}
+        self.missing = set()
+        self.expanded = {}  # article title -> expanded text
+        self.images = set()
+        self.passes = 0
+
+        # title -> position in the dump up to which it still has to be
+        # looked for or None for the whole dump
+        self.todo = {}
+        self.later = {}  # title -> position it was queued at in the current pass
+
+        self.articles = []
+        for title, revid in pages:
+            fqname = self.nshandler.get_fqname(title)
+            self.articles.append((fqname, revid))
+            self.todo[fqname] = None
+
+    def report(self):
+        done = len(self.sources) + len(self.missing)
+        self.progress.set_count(self, done, done + len(self.todo) + len(self.later))
+
+    def want(self, fqname, pos=None):
+        """queue page fqname, which is needed by the page at position
+        pos of the current pass"""
+        if fqname in self.sources or fqname in self.missing:
+            return
+        if fqname in self.todo or fqname in self.later:
+            return
+        if pos is None:
+            self.todo[fqname] = None
+        else:
+            self.later[fqname] = pos
+
+    def read_pass(self):
+        """read the dump once and take the pages in todo"""
+        self.passes += 1
+        todo = self.todo
+        self.later = {}
+        limit = max(todo.values()) if None not in todo.values() else None
+
+        for pos, page in enumerate(self.dump):
+            if limit is not None and pos > limit and not self.later:
+                break
+            fqname = page.title
+            if todo.pop(fqname, False) is False and self.later.pop(fqname, False) is False:
+                continue
+            self.add_page(page, pos)
+            self.report()
+
+        self.missing.update(todo)
+        self.todo = self.later
+        self.later = {}
+        self.report()
+
+    def add_page(self, page, pos):
+        fqname = page.title
+        txt = getattr(page, "text", None) or u""
+        self.sources[fqname] = txt
+        self.revids[fqname] = getattr(page, "revid", None)
+
+        redirect = self.nshandler.redirect_matcher(txt)
+        if redirect:
+            target = self.nshandler.get_fqname(redirect)
+            self.redirects[fqname] = target
+            self.want(target, pos)
+            return
+
+        for name in get_templates(txt, fqname):
+            name = name.strip()
+            if not name or name.startswith("#"):
+                continue
+            self.want(self.nshandler.get_fqname(name, defaultns=10), pos)
+
+    def expand_articles(self):
+        """expand the articles, which have not been expanded yet, and
+        queue the pages they still need. return True if there are any."""
+        db = sourcedb(self.nshandler.siteinfo, self.nshandler, self.sources, self.redirects, self.missing)
+        for fqname, revid in self.articles:
+            fqname = self.redirects.get(fqname, fqname)
+            if fqname in self.expanded or fqname not in self.sources:
+                continue
+
+            txt = self.sources[fqname]
+            db.unknown = set()
+            try:
+                res = Expander(txt, pagename=fqname, wikidb=db).expandTemplates()
+            except Exception, err:
+                print "expansion of %r failed: %s" % (fqname, err)
+                res = txt
+
+            if self.fetch_images:
+                for image, u in find_usages(res, self.nshandler):
+                    self.images.add(image)
+                    self.want(image)
+
+            unknown = [x for x in db.unknown
+                       if not x.startswith("#") and x not in self.sources and x not in self.missing]
+            if unknown:
+                for x in unknown:
+                    self.want(x)
+                continue
+            self.expanded[fqname] = res
+
+        return bool(self.todo)
+
+    def copy_images(self):
+        count = 0
+        for title in sorted(self.images):
+            partial = self.nshandler.splitname(title, defaultns=6)[1]
+            src = find_image_file(self.imagedir, partial)
+            if src is None:
+                continue
+            dst = self.fsout.get_imagepath(title)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copyfile(src, dst)
+            count += 1
+        print "copied %d of %d images from %r" % (count, len(self.images), self.imagedir)
+
+    def write_pages(self):
+        for fqname, txt in sorted(self.sources.items()):
+            ns = self.nshandler.splitname(fqname)[0]
+            revid = self.revids.get(fqname)
+            if fqname in self.expanded:
+                self.fsout.write_expanded_page(fqname, ns, self.expanded[fqname], revid=revid)
+                continue
+            rev = {"*": txt}
+            if revid is not None:
+                rev["revid"] = revid
+            self.fsout.write_pages({"pages": {fqname: dict(title=fqname, ns=ns, revisions=[rev])}})
+
+    def _sanity_check(self):
+        for fqname, revid in self.articles:
+            target = self.redirects.get(fqname, fqname)
+            if target not in self.sources:
+                print "WARNING: %r is not in the dump" % (fqname,)
+            elif revid is not None and self.revids.get(target) != int(revid):
+                print "WARNING: dump has revision %s of %r, not %s" % (self.revids.get(target), fqname, revid)
+
+    def run(self):
+        while 1:
+            while self.todo:
+                self.read_pass()
+            if not self.expand_articles():
+                break
+
+        print "read %d pages in %d passes, %d not in the dump" % (
+            len(self.sources), self.passes, len(self.missing))
+        if self.fetch_images:
+            self.copy_images()
+        self.finish()
+
+    def finish(self):
+        self._sanity_check()
+        self.write_pages()
+        self.fsout.write_redirects(self.redirects)
+        self.fsout.write_licenses(self.licenses)
+        self.fsout.close()
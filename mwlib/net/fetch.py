@@ -3,14 +3,25 @@
 # Copyright (c) 2007-2011 PediaPress GmbH
 # See README.rst for additional licensing information.
 
-import os, sys, urlparse, urllib2, time, traceback
-import gevent, gevent.pool, gevent.coros, gevent.event
+import os, sys, urlparse, urllib2, time, traceback, shutil, copy
+import gevent, gevent.pool, gevent.event
 
 import sqlite3dbm
 from lxml import etree
 
 from mwlib import utils, nshandling, conf, myjson as json
-from mwlib.net import sapi as mwapi
+from mwlib.expander import Expander
+from mwlib.templ import misc as templ_misc
+from mwlib._conf import as_bool
+from mwlib.net import sapi as mwapi, connpool
+from mwlib.net.imagestore import get_imagestore
+from mwlib.net.imageusage import find_usages, get_sizer
+from mwlib.net.replay import get_recorder
+from mwlib.refine.util import ImageMod
+from mwlib.net.throttle import aimd, is_congestion, retry_budget, retry_delay
+from mwlib.log import Log
+
+log = Log("fetch")
 
 
 class shared_progress(object):
@@ -19,6 +30,9 @@ class shared_progress(object):
 
     def __init__(self, status=None):
         self.key2count = {}
+        self.key2windows = {}
+        self.key2retries = {}
+        self.key2finished = {}
         self.status = status
         self.stime = time.time()
 
@@ -46,6 +60,12 @@ class shared_progress(object):
 
         if isatty and isatty():
             msg = "%s/%s %.2f %.2fs" % (done, total, percent, needed)
+            windows = self.get_windows()
+            if windows:
+                msg += " " + " ".join("%s=%.1f" % x for x in sorted(windows.items()))
+            retries = self.get_retries()
+            if retries:
+                msg += " retries=%d" % retries
             if sys.platform in ("linux2", "linux3"):
                 from mwlib import linuxmem
                 msg += " %.1fMB" % linuxmem.resident()
@@ -56,14 +76,45 @@ class shared_progress(object):
             try:
                 s = self.status.stdout
                 self.status.stdout = None
-                self.status(status="fetching", progress=percent)
+                self.status(status="fetching", progress=percent, retries=self.get_retries(),
+                            windows=self.get_windows(), fetched=self.get_finished())
             finally:
                 self.status.stdout = s
 
-    def set_count(self, key, done, total):
+    def set_count(self, key, done, total, windows=None, retries=None):
         self.key2count[key] = (done, total)
+        if windows is not None:
+            self.key2windows[key] = windows
+        if retries is not None:
+            self.key2retries[key] = retries
+        self.report()
+
+    def set_finished(self, key, classes):
+        self.key2finished[key] = list(classes)
         self.report()
 
+    def get_finished(self):
+        """return the priority classes, which all fetchers are done with"""
+        if not self.key2finished:
+            return []
+        res = None
+        for classes in self.key2finished.values():
+            if res is None:
+                res = list(classes)
+            else:
+                res = [c for c in res if c in classes]
+        return res
+
+    def get_retries(self):
+        return sum(self.key2retries.values())
+
+    def get_windows(self):
+        """return dict mapping hosts to their current concurrency window"""
+        res = {}
+        for windows in self.key2windows.values():
+            res.update(windows)
+        return res
+
     def get_count(self):
         done = 0
         total = 0
@@ -78,7 +129,9 @@ class fsoutput(object):
         self.path = os.path.abspath(path)
         assert not os.path.exists(self.path)
         os.makedirs(os.path.join(self.path, "images"))
-        self.revfile = open(os.path.join(self.path, "revisions-1.txt"), "wb")
+        self.revfile_name = "revisions-1.txt"
+        self.revfile = open(os.path.join(self.path, self.revfile_name), "wb")
+        self.revindex = []
         self.seen = dict()
         self.imgcount = 0
         self.nfo = None
@@ -99,6 +152,7 @@ class fsoutput(object):
             self.dump_json(nfo=self.nfo)
         self.revfile.close()
         self.revfile = None
+        self.dump_json(revindex=self.revindex)
 
     def get_imagepath(self, title):
         p = os.path.join(self.path, "images", "%s" % (utils.fsescape(title),))
@@ -124,11 +178,18 @@ class fsoutput(object):
         if revid is not None:
             rev["revid"] = revid
 
-        header = "\n --page-- %s\n" % json.dumps(rev, sort_keys=True)
-        self.revfile.write(header)
-        self.revfile.write(txt.encode("utf-8"))
+        self._write_revision(rev, txt)
         self.seen[title] = rev
 
+    def _write_revision(self, rev, txt):
+        """append revision text txt with metadata rev to the revisions
+        file and record its position in the revision index
+        """
+        header = "\n --page-- %s\n" % json.dumps(rev, sort_keys=True)
+        self.revfile.write(header)
+        txt = txt.encode("utf-8")
+        self.revindex.append([self.revfile_name, self.revfile.tell(), len(txt), rev])
+        self.revfile.write(txt)
 
     def write_pages(self, data):
         pages = data.get("pages", {}).values()
@@ -150,10 +211,7 @@ class fsoutput(object):
                         self.seen[revid] = rev
                         rev["revid"] = revid
                     self.seen[title] = rev
-
-                    header = "\n --page-- %s\n" % json.dumps(rev, sort_keys=True)
-                    self.revfile.write(header)
-                    self.revfile.write(txt.encode("utf-8"))
+                    self._write_revision(rev, txt)
                 # else:
                 #     print "fsoutput: skipping duplicate:", dict(revid=revid, title=title)
 
@@ -198,14 +256,23 @@ def callwhen(event, fun):
             pass
 
 
-def download_to_file(url, path, temp_path):
-    opener = urllib2.build_opener()
-    opener.addheaders = [('User-Agent', conf.user_agent)]
+_download_opener = None
+
 
+def get_download_opener():
+    global _download_opener
+    if _download_opener is None:
+        _download_opener = urllib2.build_opener(connpool.keepalive_handler())
+        _download_opener.addheaders = [('User-Agent', conf.user_agent)]
+    return _download_opener
+
+
+def _download(url, temp_path):
+    opener = get_download_opener()
+    out = None
+    size_read = 0
+    f = opener.open(url)
     try:
-        out = None
-        size_read = 0
-        f = opener.open(url)
         while 1:
             data = f.read(16384)
             if not data:
@@ -214,15 +281,302 @@ def download_to_file(url, path, temp_path):
             if out is None:
                 out = open(temp_path, "wb")
             out.write(data)
-
+    finally:
+        f.close()
         if out is not None:
             out.close()
-            os.rename(temp_path, path)
-        # print "GOT", url, size_read
 
-    except Exception, err:
-        print "ERROR DOWNLOADING", url, err
-        raise
+    rec = get_recorder()
+    if rec is not None and size_read:
+        rec.add(url, open(temp_path, "rb").read(), kind="file")
+    return size_read
+
+
+def _limited_download(url, temp_path, limiter):
+    if limiter is None:
+        return _download(url, temp_path)
+
+    with limiter:
+        start = time.time()
+        try:
+            size_read = _download(url, temp_path)
+        except Exception, err:
+            if is_congestion(err):
+                limiter.failure(start)
+            raise
+        limiter.success(start)
+        return size_read
+
+
+def download_to_file(url, path, temp_path, max_retries=None, budget=None, limiter=None):
+    """download url to path. retry with exponential backoff up to
+    max_retries times (default: fetch.max_retry_count) on transient
+    errors, each retry is taken from throttle.retry_budget budget.
+    every attempt holds a slot of limiter, a throttle.aimd, which is
+    told about its outcome. no slot is held while waiting for a retry.
+    """
+    if max_retries is None:
+        max_retries = conf.get("fetch", "max_retry_count", 2, int)
+
+    attempt = 0
+    while 1:
+        try:
+            size_read = _limited_download(url, temp_path, limiter)
+            break
+        except Exception, err:
+            delay = retry_delay(err, attempt, max_retries, budget)
+            if delay is None:
+                print "ERROR DOWNLOADING", url, err
+                raise
+        attempt += 1
+        print "retrying download of %s in %.1fs after: %s" % (url, delay, err)
+        time.sleep(delay)
+
+    if size_read:
+        os.rename(temp_path, path)
+    # print "GOT", url, size_read
+
+
+# priority classes of the fetcher's work in their default order
+priority_classes = ("articles", "templates", "imageinfo", "images", "authors")
+
+# classes whose work may create work of a class
+_class_feeders = {
+    "articles": ("templates",),  # redirects found in raw pages
+    "templates": ("articles",),
+    "imageinfo": ("articles",),
+    "images": ("articles", "imageinfo"),
+    "authors": ("articles", "imageinfo"),
+}
+
+
+def get_priorities():
+    """return the priority classes in the order configured with
+    fetch.priorities, a comma separated list of class names. classes
+    not listed come last"""
+    names = conf.get("fetch", "priorities", ",".join(priority_classes))
+    names = [x.strip() for x in names.split(",") if x.strip()]
+    unknown = [x for x in names if x not in priority_classes]
+    if unknown:
+        raise ValueError("unknown priority classes in fetch.priorities: %s" % ", ".join(unknown))
+    return names + [x for x in priority_classes if x not in names]
+
+
+def free_slots(sem):
+    """return the number of requests, which may be started without
+    waiting for semaphore sem"""
+    if sem is None:
+        return sys.maxint
+    return max(0, sem.limit - sem.active)
+
+
+class sourcedb(object):
+    """wikidb for expanding templates with the raw pages fetched so far.
+
+    lookups of parser functions mwlib does not know (e.g. #invoke) and
+    of templates the api did not list as used are recorded in unknown:
+    the expansion of such a page differs from the one on the server.
+    """
+
+    def __init__(self, siteinfo, nshandler, sources, redirects, known):
+        self.siteinfo = siteinfo
+        self.nshandler = nshandler
+        self.sources = sources  # title -> raw text
+        self.redirects = redirects
+        self.known = known
+        self.unknown = set()
+
+    def get_siteinfo(self):
+        return self.siteinfo
+
+    def normalize_and_get_page(self, name, defaultns):
+        if name.startswith("#"):
+            self.unknown.add(name)
+            return None
+        fqname = self.nshandler.get_fqname(name, defaultns=defaultns)
+        fqname = self.redirects.get(fqname, fqname)
+        txt = self.sources.get(fqname)
+        if txt is not None:
+            redirect = self.nshandler.redirect_matcher(txt)
+            if redirect:
+                txt = self.sources.get(self.nshandler.get_fqname(redirect, defaultns=defaultns))
+        if txt is None:
+            if fqname not in self.known:
+                self.unknown.add(fqname)
+            return None
+        return templ_misc.page(txt)
+
+
+class query_planner(object):
+    """merges action=query requests, which different greenlets make at
+    the same time, into fewer api calls.
+
+    requests for the same titles or revids get their prop modules
+    merged into one request. requests which differ only in the revids
+    they ask for are sent as one request for up to limit revids. every
+    caller gets back the part of the result it asked for.
+    """
+
+    # parameters changing the meaning of the result for all modules
+    _exact = ("action", "titles", "revids", "pageids", "redirects", "converttitles")
+
+    def __init__(self, api, limit=None):
+        self.api = api
+        self.limit = limit or api.api_request_limit
+        self.pending = []
+        self.flushing = False
+        self.count_requests = 0
+        self.count_calls = 0
+
+    def accepts(self, kwargs):
+        if kwargs.get("action") != "query" or "prop" not in kwargs:
+            return False
+        for k in ("list", "meta", "generator", "merge_data", "query_continue", "max_continue"):
+            if k in kwargs:
+                return False
+        return "titles" in kwargs or "revids" in kwargs
+
+    def query(self, **kwargs):
+        ar = gevent.event.AsyncResult()
+        self.pending.append((kwargs, ar))
+        self.count_requests += 1
+        if not self.flushing:
+            self.flushing = True
+            gevent.spawn(self._flush)
+        return ar.get()
+
+    def _merge(self, a, b):
+        """merge the prop modules of request b into request a if both
+        ask for the same pages and their parameters don't conflict"""
+        for k in self._exact:
+            if a.get(k) != b.get(k):
+                return False
+        for k, v in b.items():
+            if k != "prop" and k in a and a[k] != v:
+                return False
+
+        props = a["prop"].split("|")
+        for x in b["prop"].split("|"):
+            if x not in props:
+                props.append(x)
+        for k, v in b.items():
+            a.setdefault(k, v)
+        a["prop"] = "|".join(props)
+        return True
+
+    def _batchable(self, kwargs):
+        return ("revids" in kwargs and "titles" not in kwargs
+                and "revisions" in kwargs["prop"].split("|")
+                and "rvlimit" not in kwargs and "rvstartid" not in kwargs)
+
+    def plan(self, pending):
+        """return list of (kwargs, parts) for the api calls to make for
+        the pending (kwargs, result) pairs. parts is a list of
+        (kwargs, results) of the merged requests, which are served by
+        that call"""
+        merged = []
+        for kwargs, ar in pending:
+            for m in merged:
+                if self._merge(m[0], kwargs):
+                    m[1].append(ar)
+                    break
+            else:
+                merged.append((dict(kwargs), [ar]))
+
+        calls = []
+        batches = {}
+        for kwargs, ars in merged:
+            if self._batchable(kwargs):
+                key = tuple(sorted((k, v) for k, v in kwargs.items() if k != "revids"))
+                batches.setdefault(key, []).append((kwargs, ars))
+            else:
+                calls.append((kwargs, [(kwargs, ars)]))
+
+        for parts in batches.values():
+            while parts:
+                chunk = []
+                revids = []
+                while parts:
+                    ids = str(parts[0][0]["revids"]).split("|")
+                    if chunk and len(revids) + len(ids) > self.limit:
+                        break
+                    chunk.append(parts.pop(0))
+                    revids.extend(ids)
+
+                kwargs = dict(chunk[0][0])
+                kwargs["revids"] = "|".join(revids)
+                rvprop = kwargs.get("rvprop", "ids").split("|")
+                if "ids" not in rvprop:
+                    kwargs["rvprop"] = "|".join(rvprop + ["ids"])
+                calls.append((kwargs, chunk))
+
+        return calls
+
+    def _split(self, res, kwargs):
+        """return part of result res of a batched request, which was
+        asked for with kwargs"""
+        wanted = set(int(x) for x in str(kwargs["revids"]).split("|"))
+        part = {}
+        for k, v in res.items():
+            if k == "pages":
+                pages = {}
+                for pageid, p in v.items():
+                    revisions = [r for r in p.get("revisions", []) if r.get("revid") in wanted]
+                    if revisions:
+                        p = dict(p)
+                        p["revisions"] = revisions
+                        pages[pageid] = p
+                part[k] = pages
+            elif k == "badrevids":
+                part[k] = dict((x, y) for x, y in v.items() if int(x) in wanted)
+            else:
+                part[k] = v
+        return part
+
+    def _flush(self):
+        # let the greenlets, which are ready to run, add their requests
+        count = -1
+        for i in range(10):
+            if len(self.pending) == count:
+                break
+            count = len(self.pending)
+            gevent.sleep(0)
+
+        pending, self.pending = self.pending, []
+        self.flushing = False
+        for kwargs, parts in self.plan(pending):
+            gevent.spawn(self._call, kwargs, parts)
+
+    def _call(self, kwargs, parts):
+        self.count_calls += 1
+        try:
+            res = self.api.do_retrying_request(**kwargs)
+        except Exception, err:
+            for _, ars in parts:
+                for ar in ars:
+                    ar.set_exception(err)
+            return
+
+        single = len(parts) == 1 and len(parts[0][1]) == 1
+        for part_kwargs, ars in parts:
+            part = res if len(parts) == 1 else self._split(res, part_kwargs)
+            for ar in ars:
+                ar.set(part if single else copy.deepcopy(part))
+
+    def __repr__(self):
+        return "<query_planner %s requests in %s calls>" % (self.count_requests, self.count_calls)
+
+
+def get_planner(api):
+    """return a query_planner for api or None if merging queries has
+    been turned off with fetch.merge_queries or api records its
+    requests: merged queries depend on timing and couldn't be replayed
+    """
+    if getattr(api, "recorder", None) is not None:
+        return None
+    if not conf.get("fetch", "merge_queries", True, as_bool):
+        return None
+    return query_planner(api)
 
 
 class fetcher(object):
@@ -230,21 +584,25 @@ class fetcher(object):
                  status=None,
                  progress=None,
                  cover_image=None,
-                 imagesize=800, fetch_images=True):
+                 imagesize=800, fetch_images=True,
+                 previous=None):
 
         self.dispatch_event = gevent.event.Event()
-        self.api_semaphore = gevent.coros.Semaphore(20)
 
         self.cover_image = cover_image
 
         self.pages = pages
 
-        self.image_download_pool = gevent.pool.Pool(10)
+        self.host2limiter = {}  # image host -> aimd
 
         self.fatal_error = "stopped by signal"
 
+        self.retry_budget = retry_budget(conf.get("fetch", "retry_budget", 100, int))
+
         self.api = api
         self.api.report = self.report
+        self.api.retry_budget = self.retry_budget
+        self.api.planner = get_planner(self.api)
         self.api_cache = {self.api.apiurl: self.api,}
 
         self.fsout = fsout
@@ -254,6 +612,15 @@ class fetcher(object):
 
         self.imagesize = imagesize
         self.fetch_images = fetch_images
+        self.previous = previous
+        self.imagestore = get_imagestore()
+        self.sizer = get_sizer(imagesize) if fetch_images else None
+        self.image_widths = {}  # image title -> thumbnail width needed
+        self.image2users = {}  # image title -> pages using it, which are not expanded yet
+        self.user2images = {}  # page title -> images it uses
+        self.expanded_titles = set()
+        self.used_running = 0  # fetch_used_block calls, which may find more users
+        self.imagemod = None
 
         self.scheduled = set()
 
@@ -265,11 +632,26 @@ class fetcher(object):
         self.img_max_retries = 2
 
         self.title2latest = {}
+        self.title2lastrev = {}  # title -> id of its latest revision, if known
 
         self.pages_todo = []
         self.revids_todo = []
         self.imageinfo_todo = []
         self.imagedescription_todo = {}  # base path -> list
+        self.contributors_todo = {}  # mwapi -> list of (title, local title)
+        self.batch_authors = conf.get("fetch", "batch_authors", True, as_bool)
+        self.expand_locally = conf.get("fetch", "expand_locally", False, as_bool)
+        self.sources = {}  # title -> raw text, kept for local expansion
+        self.revid2source = {}  # revid -> (title, ns, raw text)
+        self.used_templates = set()
+        self.page2used = {}  # page title -> templates and images it uses
+        self.local_titles = []
+        self.local_revids = []
+
+        self.priorities = get_priorities()
+        self.class2todo = dict((c, []) for c in priority_classes)  # queued (sem, fun, args)
+        self.class2running = dict((c, 0) for c in priority_classes)
+        self.finished_classes = []
         self._nshandler = None
 
         siteinfo = self.get_siteinfo_for(self.api)
@@ -286,24 +668,38 @@ class fetcher(object):
         self.pool = gevent.pool.Pool()
         self.refcall_pool = gevent.pool.Pool(1024)
 
-        self._refcall(self.fetch_html, "page", titles)
-        self._refcall(self.fetch_html, "oldid", revids)
+        # expanding locally needs the raw text of articles and templates
+        expanded = not self.expand_locally
+        self._refcall_class("articles", self.fetch_used, "titles", titles, expanded)
+        self._refcall_class("articles", self.fetch_used, "revids", revids, expanded)
+
+        if self.previous is not None:
+            titles, revids = self.reuse_articles(titles, revids)
+
+        self.fetch_html("page", titles)
+        self.fetch_html("oldid", revids)
 
-        self._refcall(self.fetch_used, "titles", titles, True)
-        self._refcall(self.fetch_used, "revids", revids, True)
+        if self.expand_locally:
+            # expanded in run() when all templates have been fetched
+            self.local_titles, self.local_revids = titles, revids
+            return
 
         for t in titles:
-            self._refcall(self.expand_templates_from_title, t)
+            self._schedule("articles", self.api.limit_fetch_semaphore, self.expand_templates_from_title, t)
 
         for r in revids:
-            self._refcall(self.expand_templates_from_revid, int(r))
+            self._schedule("articles", self.api.limit_fetch_semaphore, self.expand_templates_from_revid, int(r))
 
-    def expand_templates_from_revid(self, revid):
-        res = self.api.do_request(action="query", prop="revisions", rvprop="content", revids=str(revid))
-        page = res["pages"].values()[0]
+    def expand_templates_from_revid(self, revid, edits=True):
+        if revid in self.revid2source:
+            title, ns, text = self.revid2source[revid]
+            page = dict(title=title, ns=ns)
+        else:
+            res = self.api.do_request(action="query", prop="revisions", rvprop="content", revids=str(revid))
+            page = res["pages"].values()[0]
 
-        title = page["title"]
-        text = page["revisions"][0]["*"]
+            title = page["title"]
+            text = page["revisions"][0]["*"]
         res = self.api.do_request(use_post=True, action="expandtemplates", title=title, text=text).get("expandtemplates", {})
 
         txt = res.get("*")
@@ -311,13 +707,14 @@ class fetcher(object):
             redirect = self.nshandler.redirect_matcher(txt)
             if redirect:
                 self.redirects[title] = redirect
-                self._refcall(self.expand_templates_from_title, redirect)
-                self._refcall(self.fetch_used, "titles", [redirect], True)
+                self._schedule("articles", self.api.limit_fetch_semaphore, self.expand_templates_from_title, redirect)
+                self._refcall_class("articles", self.fetch_used, "titles", [redirect], True)
 
-            self.fsout.write_expanded_page(title, page["ns"], txt, revid=revid)
-            self.get_edits(title, revid)
+            self.write_expanded_page(title, page["ns"], txt, revid=revid)
+            if edits:
+                self._schedule("authors", self.api.limit_fetch_semaphore, self.get_edits, title, revid)
 
-    def expand_templates_from_title(self, title):
+    def expand_templates_from_title(self, title, edits=True):
         nsnum, suffix, fqname = self.nshandler.splitname(title)
 
         if nsnum == 0:
@@ -328,14 +725,247 @@ class fetcher(object):
         res = self.api.do_request(action="expandtemplates", title=title, text=text)
         txt = res.get("*")
         if txt:
-            self.fsout.write_expanded_page(title, nsnum, txt)
-            self.get_edits(title, None)
+            self.write_expanded_page(title, nsnum, txt)
+            if edits:
+                self._schedule("authors", self.api.limit_fetch_semaphore, self.get_edits, title, None)
+
+    def write_expanded_page(self, title, ns, txt, revid=None):
+        if self.sizer is not None:
+            if self.imagemod is None:
+                self.imagemod = ImageMod(self.nshandler.siteinfo.get("magicwords"))
+            for image, u in find_usages(txt, self.nshandler, self.imagemod):
+                width = self.sizer.get_width(u)
+                self.image_widths[image] = max(width, self.image_widths.get(image, 0))
+
+            # the widths of the images used by title are known now
+            key = self._page_key(title)
+            self.expanded_titles.add(key)
+            for image in self.user2images.pop(key, ()):
+                self.image2users[image].discard(key)
+            self.dispatch_event.set()
+        self.fsout.write_expanded_page(title, ns, txt, revid=revid)
+
+    def _page_key(self, title):
+        fqname = self.nshandler.get_fqname(title)
+        return self.redirects.get(fqname, fqname)
+
+    def _add_image_users(self, pages):
+        for p in pages:
+            key = self._page_key(p.get("title", u""))
+            if key in self.expanded_titles:
+                continue
+            for image in self._extract_title(p.get("images", [])):
+                self.image2users.setdefault(image, set()).add(key)
+                self.user2images.setdefault(key, set()).add(image)
+
+    def expand_locally_or_remote(self):
+        """expand the articles with the templates fetched. ask the
+        server to expand those, which can't be expanded here. their
+        authors are fetched by fetch_used.
+        """
+        db = sourcedb(self.nshandler.siteinfo, self.nshandler, self.sources, self.redirects, self.used_templates)
+        done = failed = 0
+        todo = [(t, None) for t in self.local_titles] + [(None, r) for r in self.local_revids]
+        while todo:
+            title, revid = todo.pop(0)
+            if revid is not None:
+                title, ns, txt = self.revid2source.get(int(revid), (None, None, None))
+            else:
+                ns, partial, fqname = self.nshandler.splitname(title)
+                txt = self.sources.get(self.redirects.get(fqname, fqname))
+
+            res = None
+            if txt is not None:
+                db.unknown = set()
+                try:
+                    res = Expander(txt, pagename=title, wikidb=db).expandTemplates()
+                except Exception, err:
+                    print "local expansion of %r failed: %s" % (title, err)
+                if db.unknown:
+                    res = None
+
+            done += 1
+            if not res:
+                failed += 1
+                sem = self.api.limit_fetch_semaphore
+                if revid is not None:
+                    self._schedule("articles", sem, self.expand_templates_from_revid, int(revid), False)
+                else:
+                    self._schedule("articles", sem, self.expand_templates_from_title, title, False)
+                continue
+
+            if revid is not None:
+                redirect = self.nshandler.redirect_matcher(res)
+                if redirect:
+                    self.redirects[title] = redirect
+                    todo.append((redirect, None))
+            self.write_expanded_page(title, ns, res, revid=revid)
+
+        print "expanded %d articles locally, %d on the server" % (done - failed, failed)
+        self.sources.clear()
+        self.revid2source.clear()
+        self.local_titles, self.local_revids = [], []
+
+    def fetch_latest_revids(self, titles):
+        latest = {}
+        for bl in splitblocks(sorted(titles), self.api.api_request_limit):
+            latest.update(self.api.fetch_latest_revids(bl))
+        return latest
+
+    def reuse_articles(self, titles, revids):
+        """copy the articles, which did not change since the previous
+        nuwiki has been built, from there and return the titles and
+        revids which still need to be fetched. neither the article nor
+        the templates and images it uses may have changed.
+        """
+        prev = self.previous
+        candidates = []  # (key, page, todo list)
+        todo_revids = []
+        for r in revids:
+            page = prev.nuwiki.revisions.get(int(r))
+            if page is None:
+                todo_revids.append(r)
+            else:
+                candidates.append((r, page, todo_revids))
+
+        latest = self.fetch_latest_revids(titles)
+        self.title2lastrev.update(latest)
+
+        todo_titles = []
+        for t in titles:
+            html = prev.html.get(t)
+            page = prev.nuwiki.revisions.get(t)
+            if page is not None and html and latest.get(t) is not None and html.get("revid") == latest[t]:
+                candidates.append((t, page, todo_titles))
+            else:
+                todo_titles.append(t)
+
+        changed = self._changed_deps([page.title for key, page, todo in candidates])
+        for key, page, todo in candidates:
+            if page.title in changed or not self._copy_article(key, page):
+                todo.append(key)
+
+        print "reusing %d of %d articles from previous nuwiki" % (
+            len(titles) + len(revids) - len(todo_titles) - len(todo_revids),
+            len(titles) + len(revids))
+        return todo_titles, todo_revids
+
+    def _changed_deps(self, titles):
+        """return the set of titles, which use templates or images that
+        changed since the previous nuwiki has been built or for which
+        this is unknown
+        """
+        prev = self.previous
+        deps = prev.nuwiki.get_data("deps") or {}
+        title2deps = {}
+        for t in titles:
+            fqname = self.nshandler.get_fqname(t)
+            title2deps[t] = deps.get(prev.nuwiki.redirects.get(fqname, fqname))
+
+        used = set()
+        for d in title2deps.values():
+            if d:
+                used.update(d)
+        latest = self.fetch_latest_revids(used)
+
+        changed = set()
+        for t, d in title2deps.items():
+            if d is None or [u for u, revid in d.items() if latest.get(u) != revid]:
+                changed.add(t)
+        return changed
+
+    def write_deps(self):
+        """record the latest revisions of the templates and images each
+        page uses, so that a later fetch can tell, whether the page
+        changed
+        """
+        used = set()
+        for titles in self.page2used.values():
+            used.update(titles)
+        latest = self.fetch_latest_revids(used)
+
+        deps = {}
+        for title, titles in self.page2used.items():
+            deps[title] = dict((t, latest.get(t)) for t in titles)
+        self.fsout.dump_json(deps=deps)
+
+    def _copy_article(self, key, page):
+        prev = self.previous
+        if page is None or not page.expanded or not page.rawtext:
+            return False
+        if self.nshandler.redirect_matcher(page.rawtext):
+            return False
+
+        html = prev.html.get(key)
+        if not html:
+            return False
+
+        self.write_expanded_page(page.title, page.ns, page.rawtext, revid=page.revid)
+        self.fsout.set_db_key('html', key, html)
+        for url in self.extension_img_urls(html):
+            fn = url.rsplit('/', 1)[1]
+            title = self.nshandler.splitname(fn, defaultns=6)[2]
+            if not self._copy_image(title):
+                self.schedule_download_image(str(url), title)
+
+        authors = None
+        if prev.authors is not None:
+            authors = prev.authors[page.title]
+        if authors is None:
+            self._schedule("authors", self.api.limit_fetch_semaphore, self.get_edits, page.title, page.revid)
+        else:
+            self.fsout.set_db_key('authors', page.title, authors)
+        return True
+
+    def _copy_image(self, title):
+        src = self.previous.nuwiki.normalize_and_get_image_path(title)
+        if src is None or not os.path.exists(src):
+            return False
+
+        src = os.path.realpath(src)
+        dst = self.fsout.get_imagepath(title)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+        return True
+
+    def reuse_image(self, title, ii):
+        """copy image, description page and authors of title from the
+        previous nuwiki if the image did not change
+        """
+        prev = self.previous
+        old = prev.imageinfo.get(title)
+        if not old or not ii.get("sha1"):
+            return False
+        if old.get("sha1") != ii.get("sha1") or old.get("thumburl") != ii.get("thumburl"):
+            return False
+
+        page = prev.nuwiki.revisions.get(title)
+        if page is None or page.rawtext is None:
+            return False
+
+        if not self._copy_image(title):
+            return False
+
+        self.scheduled.add("-d-" + title)
+        self.fsout.write_pages({"pages": {title: {"title": page.title, "ns": page.ns,
+                                                  "revisions": [{"*": page.rawtext}]}}})
+        authors = None
+        if prev.authors is not None:
+            authors = prev.authors[title]
+        if authors is not None:
+            self.fsout.set_db_key('authors', title, authors)
+        return True
 
     def run(self):
         self.report()
         dispatch_gr = gevent.spawn(callwhen, self.dispatch_event, self.dispatch)
         try:
-            self.pool.join()
+            self._join()
+            if self.expand_locally:
+                self.expand_locally_or_remote()
+                self._join()
         finally:
             dispatch_gr.kill()
 
@@ -344,6 +974,8 @@ class fetcher(object):
         assert not self.imageinfo_todo
         assert not self.revids_todo
         assert not self.pages_todo
+        assert not [x for x in self.contributors_todo.values() if x]
+        assert not [x for x in self.class2todo.values() if x]
 
     def extension_img_urls(self, data):
         html = data['text']['*']
@@ -363,10 +995,9 @@ class fetcher(object):
 
     def fetch_html(self, name, lst):
         def fetch(c):
-            with self.api_semaphore:
-                kw = {name: c}
-                res = self.api.do_request(action="parse", redirects="1", **kw)
-                res[name] = c
+            kw = {name: c}
+            res = self.api.do_request(action="parse", redirects="1", **kw)
+            res[name] = c
 
             self.fsout.set_db_key('html', c, res)
             img_urls = self.extension_img_urls(res)
@@ -375,9 +1006,8 @@ class fetcher(object):
                 title = self.nshandler.splitname(fn, defaultns=6)[2]
                 self.schedule_download_image(str(url), title)
 
-        self.count_total += len(lst)
         for c in lst:
-            self._refcall_noinc(fetch, c)
+            self._schedule("articles", self.api.limit_fetch_semaphore, fetch, c)
 
     def fetch_used(self, name, lst, expanded=False):
         limit = self.api.api_request_limit
@@ -393,34 +1023,51 @@ class fetcher(object):
 
         items = self.title2latest.items()
         self.title2latest = {}
-        self.count_total += len(items)
         for title, rev in items:
-            self._refcall_noinc(self.get_edits, title, rev)
+            self._schedule("authors", self.api.limit_fetch_semaphore, self.get_edits, title, rev)
 
     def fetch_used_block(self, name, lst, expanded):
+        self.used_running += 1
+        try:
+            self._fetch_used_block(name, lst, expanded)
+        finally:
+            self.used_running -= 1
+
+    def _fetch_used_block(self, name, lst, expanded):
         kw = {name: lst, "fetch_images": self.fetch_images, "expanded": expanded}
         used = self.api.fetch_used(**kw)
 
         self._update_redirects(used.get("redirects", []))
 
         pages = used.get("pages", {}).values()
+        if self.sizer is not None:
+            self._add_image_users(pages)
 
         revids = set()
         for p in pages:
+            if "lastrevid" in p:
+                self.title2lastrev[p.get("title")] = p["lastrevid"]
             tmp = self._extract_attribute(p.get("revisions", []), "revid")
             if tmp:
                 latest = max(tmp)
                 title = p.get("title", None)
                 old = self.title2latest.get(title, 0)
                 self.title2latest[title] = max(old, latest)
+                if name == "titles":
+                    # asked by title, the server returns the latest revision
+                    self.title2lastrev.setdefault(title, latest)
 
             revids.update(tmp)
 
         templates = set()
         images = set()
         for p in pages:
-            images.update(self._extract_title(p.get("images", [])))
-            templates.update(self._extract_title(p.get("templates", [])))
+            page_images = self._extract_title(p.get("images", []))
+            page_templates = self._extract_title(p.get("templates", []))
+            self.page2used.setdefault(p.get("title"), set()).update(page_images + page_templates)
+            images.update(page_images)
+            if not expanded:
+                templates.update(page_templates)
 
         if self.cover_image:
             images.add(self.nshandler.get_fqname(self.cover_image, 6))
@@ -436,6 +1083,7 @@ class fetcher(object):
                 self.revids_todo.append(r)
                 self.scheduled.add(r)
 
+        self.used_templates.update(templates)
         for t in templates:
             if t not in self.scheduled:
                 self.pages_todo.append(t)
@@ -463,19 +1111,56 @@ class fetcher(object):
         return titles, revids
 
     def get_edits(self, title, rev):
+        if self._is_latest(title, rev) and self._schedule_contributors(self.api, title, title):
+            return
         inspect_authors = self.api.get_edits(title, rev)
         authors = inspect_authors.get_authors()
         # print "GOT_EDITS:", title, authors
         self.fsout.set_db_key('authors', title, authors)
 
+    def _is_latest(self, title, rev):
+        """return True if rev is None or the latest revision of title.
+        prop=contributors only knows the authors up to the latest one.
+        """
+        return rev is None or self.title2lastrev.get(title) == rev
+
+    def _schedule_contributors(self, api, title, localtitle):
+        """queue title for fetching its authors in a batch, which get
+        stored under localtitle. return False if api can't do that.
+        """
+        if not self.batch_authors or getattr(api, "has_contributors", False) is False:
+            return False
+        self.contributors_todo.setdefault(api, []).append((title, localtitle))
+        self.dispatch_event.set()
+        return True
+
+    def fetch_contributors(self, api, entries):
+        title2authors = api.fetch_contributors([x[0] for x in entries])
+        for title, localtitle in entries:
+            authors = None
+            if title2authors is not None:
+                authors = title2authors.get(title)
+            if authors is None:
+                # no prop=contributors on this wiki: walk the revisions
+                self._schedule("authors", api.limit_fetch_semaphore, self._get_edits_walk, api, title, localtitle)
+            else:
+                self.fsout.set_db_key('authors', localtitle, authors)
+
+    def _get_edits_walk(self, api, title, localtitle):
+        authors = api.get_edits(title, None).get_authors()
+        self.fsout.set_db_key('authors', localtitle, authors)
+
     def report(self):
         qc = self.api.qccount
 
         limit = self.api.api_request_limit
         jt = self.count_total + len(self.pages_todo) // limit + len(self.revids_todo) // limit
         jt += len(self.title2latest)
+        jt += sum([len(x) for x in self.class2todo.values()])
+        jt += sum([len(x) for x in self.contributors_todo.values()]) // limit
 
-        self.progress.set_count(self, self.count_done + qc,  jt + qc)
+        self.progress.set_count(self, self.count_done + qc,  jt + qc, windows=self.get_windows(),
+                                retries=self.retry_budget.retries)
 
     def _add_catmember(self, title, entry):
         try:
@@ -521,6 +1206,16 @@ class fetcher(object):
         if targets:
             self.fetch_used("titles", targets)
 
+    def _remember_sources(self, data):
+        for p in data.get("pages", {}).values():
+            for r in p.get("revisions", []):
+                txt = r.get("*")
+                if txt is None:
+                    continue
+                self.sources[p["title"]] = txt
+                if r.get("revid") is not None:
+                    self.revid2source[r["revid"]] = (p["title"], p.get("ns", 0), txt)
+
     def _extract_attribute(self, lst, attr):
         res = []
         for x in lst:
@@ -540,21 +1235,49 @@ class fetcher(object):
             if t and f:
                 self.redirects[f] = t
 
-    def schedule_download_image(self, url, title):
+    def schedule_download_image(self, url, title, sha1=None, width=None):
         key = (url, title)
         if key in self.scheduled:
             return
         self.scheduled.add(key)
-        self._refcall(self._download_image, url, title)
+        self._schedule("images", self._get_image_limiter(url), self._download_image, url, title, sha1, width)
 
-    def _download_image(self, url, title):
+    def _download_image(self, url, title, sha1=None, width=None):
         path = self.fsout.get_imagepath(title)
+        store = self.imagestore
+        if store is not None and store.get(sha1, width, path):
+            return
+
         temp_path = (path + u'\xb7').encode("utf-8")
-        gr = self.image_download_pool.spawn(download_to_file, url, path, temp_path)
-        self.pool.add(gr)
+        download_to_file(url, path, temp_path, budget=self.retry_budget,
+                         limiter=self._get_image_limiter(url))
+
+        if store is not None:
+            store.add(sha1, width, path)
+
+    def _get_image_limiter(self, url):
+        host = urlparse.urlsplit(url)[1]
+        limiter = self.host2limiter.get(host)
+        if limiter is None:
+            limiter = self.host2limiter[host] = aimd(
+                initial=conf.get("fetch", "image_concurrency", 4, int),
+                maximum=conf.get("fetch", "image_max_concurrency", 20, int))
+        return limiter
+
+    def get_windows(self):
+        """return dict mapping api and image hosts to the current
+        number of allowed parallel requests"""
+        res = {}
+        for api in self.api_cache.values():
+            sem = api.limit_fetch_semaphore
+            if sem is not None:
+                res[urlparse.urlsplit(api.apiurl)[1]] = sem.window
+        for host, limiter in self.host2limiter.items():
+            res["img:" + host] = limiter.window
+        return res
 
-    def fetch_imageinfo(self, titles):
-        data = self.api.fetch_imageinfo(titles=titles, iiurlwidth=self.imagesize)
+    def fetch_imageinfo(self, titles, width=None):
+        data = self.api.fetch_imageinfo(titles=titles, iiurlwidth=width or self.imagesize)
         infos = data.get("pages", {}).values()
         # print infos[0]
         new_basepaths = set()
@@ -567,6 +1290,9 @@ class fetcher(object):
                 continue
             ii = ii[0]
             self.fsout.set_db_key('imageinfo', title, ii)
+            if self.previous is not None and self.reuse_image(title, ii):
+                continue
+
             thumburl = ii.get("thumburl", None)
 
             if thumburl is None:  # fallback for old mediawikis
@@ -577,7 +1303,7 @@ class fetcher(object):
                 # FIXME: add Callback that checks correct file size
                 if thumburl.startswith('/'):
                     thumburl = urlparse.urljoin(self.api.baseurl, thumburl)
-                self.schedule_download_image(thumburl, title)
+                self.schedule_download_image(thumburl, title, ii.get("sha1"), ii.get("thumbwidth"))
 
                 descriptionurl = ii.get("descriptionurl", "")
                 if not descriptionurl:
@@ -593,7 +1319,7 @@ class fetcher(object):
                         self.imagedescription_todo[path] = [t]
 
         for path in new_basepaths:
-            self._refcall(self.handle_new_basepath, path)
+            self._refcall_class("imageinfo", self.handle_new_basepath, path)
 
     def _get_nshandler(self):
         if self._nshandler is not None:
@@ -651,19 +1377,18 @@ class fetcher(object):
             local_names.append("%s:%s" % (nsname, partial))
 
         for bl in splitblocks(local_names, api.api_request_limit):
-            self._refcall(self.fetch_image_page, bl, api)
+            self._refcall_class("imageinfo", self.fetch_image_page, bl, api)
 
         for title in local_names:
-            self._refcall(self.get_image_edits, title, api)
+            self._schedule("authors", api.limit_fetch_semaphore, self.get_image_edits, title, api)
 
     def get_image_edits(self, title, api):
-        get_authors = api.get_edits(title, None)
         local_nsname = self.nshandler.get_nsname_by_number(6)
         # change title prefix to make them look like local pages
         prefix, partial = title.split(":", 1)
-        title = '%s:%s' % (local_nsname, partial)
-        authors = get_authors.get_authors()
-        self.fsout.set_db_key('authors', title, authors)
+        localtitle = '%s:%s' % (local_nsname, partial)
+        if not self._schedule_contributors(api, title, localtitle):
+            self._get_edits_walk(api, title, localtitle)
 
     def _get_mwapi_for_path(self, path):
         urls = mwapi.guess_api_urls(path)
@@ -675,6 +1400,8 @@ class fetcher(object):
                 api = mwapi.mwapi(url)
                 api.ping()
                 api.set_limit()
+                api.retry_budget = self.retry_budget
+                api.planner = get_planner(api)
                 self.api_cache[url] = api
                 return api
             except Exception:
@@ -693,23 +1420,141 @@ class fetcher(object):
             self._update_redirects(r)
             self._handle_categories(data)
             self.fsout.write_pages(data)
+            if self.expand_locally:
+                self._remember_sources(data)
+
+        # free request slots per semaphore, shared by all classes
+        sem2slots = {}
 
-        def doit(name, lst):
-            while lst and self.api.idle():
+        def take(sem):
+            if sem not in sem2slots:
+                sem2slots[sem] = free_slots(sem)
+            if sem2slots[sem] <= 0:
+                return False
+            sem2slots[sem] -= 1
+            return True
+
+        sem = self.api.limit_fetch_semaphore
+
+        def doit(cls, name, lst):
+            while lst and take(sem):
                 bl = getblock(lst, limit)
                 self.scheduled.update(bl)
                 kw = {name: bl}
-                self._refcall(fetch_pages, **kw)
+                self._refcall_class(cls, fetch_pages, **kw)
+
+        # lower classes wait until higher classes have started all their work
+        for cls in self.priorities:
+            waiting = 0  # queued work of cls, which can't be started yet
+            if cls == "articles":
+                doit(cls, "revids", self.revids_todo)
+            elif cls == "templates":
+                doit(cls, "titles", self.pages_todo)
+            elif cls == "imageinfo":
+                ready = self._sized_images()
+                while ready and take(sem):
+                    bl, width = self._get_imageinfo_block(limit, ready)
+                    self.scheduled.update(bl)
+                    self._refcall_class(cls, self.fetch_imageinfo, bl, width)
+                waiting = len(self.imageinfo_todo) - len(ready)
+            elif cls == "authors":
+                for api, todo in self.contributors_todo.items():
+                    while todo and take(api.limit_fetch_semaphore):
+                        self._refcall_class(cls, self.fetch_contributors, api, getblock(todo, api.api_request_limit))
+
+            todo = self.class2todo[cls]
+            while todo and take(todo[0][0]):
+                fun, args = todo.pop(0)[1:]
+                self._refcall_class(cls, fun, *args)
+
+            if self._class_queued(cls) > waiting:
+                break
 
-        while self.imageinfo_todo and self.api.idle():
-            bl = getblock(self.imageinfo_todo, limit)
-            self.scheduled.update(bl)
-            self._refcall(self.fetch_imageinfo, bl)
+        self._report_finished()
+        self.report()
 
-        doit("revids", self.revids_todo)
-        doit("titles", self.pages_todo)
+    def _imageinfo_ready(self):
+        """images are sized by their use in the articles. return True
+        if all of them are done"""
+        return self.sizer is None or self._class_finished("articles")
+
+    def _sized_images(self):
+        """return the images in imageinfo_todo, whose thumbnail width
+        is known: all articles using them are expanded or they already
+        need the largest width"""
+        todo = self.imageinfo_todo
+        if self._imageinfo_ready():
+            return list(todo)
+        maxwidth = self.sizer.maxwidth
+        widths = self.image_widths
+        if self.used_running:
+            # more articles using an image may still be found
+            return [t for t in todo if widths.get(t, 0) >= maxwidth]
+        return [t for t in todo if not self.image2users.get(t) or widths.get(t, 0) >= maxwidth]
+
+    def _get_imageinfo_block(self, limit, ready):
+        """remove up to limit images needing the same thumbnail width
+        from ready and imageinfo_todo. return them and that width"""
+        widths = self.image_widths
+        width = widths.get(ready[0], self.imagesize)
+        bl = []
+        rest = []
+        for t in ready:
+            if len(bl) < limit and widths.get(t, self.imagesize) == width:
+                bl.append(t)
+            else:
+                rest.append(t)
+        ready[:] = rest
+        taken = set(bl)
+        self.imageinfo_todo[:] = [t for t in self.imageinfo_todo if t not in taken]
+        return bl, width
+
+    def _class_queued(self, cls):
+        """return the number of calls of class cls waiting to be started"""
+        n = len(self.class2todo[cls])
+        if cls == "articles":
+            n += len(self.revids_todo)
+        elif cls == "templates":
+            n += len(self.pages_todo)
+        elif cls == "imageinfo":
+            n += len(self.imageinfo_todo)
+        elif cls == "authors":
+            n += sum([len(x) for x in self.contributors_todo.values()])
+        return n
+
+    def _class_pending(self, cls):
+        """return True if class cls has work, which is not done yet"""
+        if self._class_queued(cls) or self.class2running[cls]:
+            return True
+        if cls == "articles":
+            return bool(self.local_titles or self.local_revids)
+        if cls == "imageinfo":
+            return bool(self.imagedescription_todo)
+        if cls == "authors":
+            return bool(self.title2latest)
+        return False
+
+    def _class_finished(self, cls):
+        """return True if class cls and all classes, which may create
+        work for it, are done"""
+        todo = [cls]
+        seen = set()
+        while todo:
+            c = todo.pop()
+            if c in seen:
+                continue
+            seen.add(c)
+            if self._class_pending(c):
+                return False
+            todo.extend(_class_feeders[c])
+        return True
 
-        self.report()
+    def _report_finished(self):
+        for cls in self.priorities:
+            if cls not in self.finished_classes and self._class_finished(cls):
+                self.finished_classes.append(cls)
+                log.debug("fetched all %s after %.2fs" % (cls, time.time() - self.progress.stime))
+                self.progress.set_finished(self, self.finished_classes)
 
 
     def _sanity_check(self):
@@ -729,10 +1574,50 @@ class fetcher(object):
 
     def finish(self):
         self._sanity_check()
+        if self.imagestore is not None:
+            log.debug("imagestore: %d hits, %d misses" % (self.imagestore.hits, self.imagestore.misses))
+        log.debug("connections: %r" % (connpool.get_pool(),))
+        if self.api.planner is not None:
+            log.debug("queries: %r" % (self.api.planner,))
+        received = sum(api.bytes_received for api in self.api_cache.values())
+        decoded = sum(api.bytes_decoded for api in self.api_cache.values())
+        retries = sum(api.retry_count for api in self.api_cache.values())
+        log.debug("api: %d bytes received, %d bytes decoded, %d retries" % (received, decoded, retries))
+        if self.api.cache is not None:
+            log.debug("api cache: %d hits, %d misses" % (self.api.cache.hits, self.api.cache.misses))
+        self.write_deps()
         self.fsout.write_redirects(self.redirects)
         self.fsout.write_licenses(self.licenses)
         self.fsout.close()
 
+    def _schedule(self, cls, sem, fun, *args):
+        """queue call of fun in priority class cls. dispatch starts it
+        when all classes of higher priority have been started and sem,
+        the limiter of the server fun talks to, has a free slot.
+        """
+        self.class2todo[cls].append((sem, fun, args))
+        self.dispatch_event.set()
+
+    def _refcall_class(self, cls, fun, *args, **kw):
+        """like _refcall, counting fun as running work of class cls"""
+        self.class2running[cls] += 1
+
+        def class_fun():
+            try:
+                fun(*args, **kw)
+            finally:
+                self.class2running[cls] -= 1
+
+        return self._refcall(class_fun)
+
+    def _join(self):
+        """wait until all work, including queued calls, has been done"""
+        while 1:
+            self.pool.join()
+            self.dispatch()
+            if not len(self.pool):
+                break
+
     def _refcall(self, fun, *args, **kw):
         """Increment refcount, schedule call of fun
         decrement refcount after fun has finished.
@@ -0,0 +1,176 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""content addressed store for downloaded images, which is shared by
+all fetches on a machine.
+
+blobs are keyed by the sha1 mediawiki reports for the image and the
+width of the thumbnail and are hard linked into the nuwiki image
+directories. the store is bounded in size, least recently used blobs
+get evicted first. the size of the store is recorded in the file .size,
+so that only adding a blob, which makes it too large, has to look at
+all blobs.
+"""
+
+import os, re, shutil, tempfile, fcntl
+from mwlib import conf
+
+_sha1_rex = re.compile("^[0-9a-f]{40}$")
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class imagestore(object):
+    # adding blobs to a full store evicts down to this share of maxsize
+    lowwater = 0.9
+
+    def __init__(self, path, maxsize):
+        self.path = os.path.abspath(path)
+        self.maxsize = maxsize
+        self.sizepath = os.path.join(self.path, ".size")
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:  # created by another process
+                if not os.path.isdir(self.path):
+                    raise
+
+    def blobpath(self, sha1, width):
+        """return path of the blob for sha1 and width or None if sha1
+        isn't usable as a key"""
+        if not sha1:
+            return None
+        sha1 = str(sha1).lower()
+        if not _sha1_rex.match(sha1):
+            return None
+        return os.path.join(self.path, sha1[:2], "%s-%s" % (sha1, width or "orig"))
+
+    def get(self, sha1, width, dst):
+        """link the blob for sha1 and width to dst. return True on
+        success, False if it is not in the store"""
+        p = self.blobpath(sha1, width)
+        if p is None:
+            return False
+        try:
+            os.link(p, dst)
+        except OSError:
+            if not os.path.exists(p):
+                self.misses += 1
+                return False
+            try:
+                shutil.copyfile(p, dst)
+            except (IOError, OSError):  # evicted meanwhile
+                self.misses += 1
+                return False
+        try:
+            os.utime(p, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return True
+
+    def add(self, sha1, width, src):
+        """add the file src as the blob for sha1 and width"""
+        p = self.blobpath(sha1, width)
+        if p is None or not os.path.exists(src) or os.path.exists(p):
+            return
+
+        d = os.path.dirname(p)
+        if not os.path.isdir(d):
+            try:
+                os.mkdir(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+
+        fd, tmp = tempfile.mkstemp(dir=d, prefix=".tmp-")
+        os.close(fd)
+        try:
+            os.unlink(tmp)
+            link_or_copy(src, tmp)
+            size = os.path.getsize(tmp)
+            os.rename(tmp, p)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return
+
+        def added(total):
+            if total is None:
+                total = self._evict(None)  # counts the new blob
+            else:
+                total += size
+            if total > self.maxsize:
+                total = self._evict(int(self.maxsize * self.lowwater))
+            return total
+
+        self._update_size(added)
+
+    def evict(self):
+        """remove least recently used blobs until the store is not
+        larger than maxsize bytes"""
+        self._update_size(lambda total: self._evict(self.maxsize))
+
+    def _update_size(self, fun):
+        """call fun with the recorded size of the store or None while
+        holding a lock on it and record the size fun returns"""
+        f = os.fdopen(os.open(self.sizepath, os.O_RDWR | os.O_CREAT, 0644), "r+")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                total = int(f.read().strip())
+            except ValueError:
+                total = None
+            total = fun(total)
+            f.seek(0)
+            f.truncate()
+            f.write(str(total))
+        finally:
+            f.close()
+
+    def _evict(self, maxsize):
+        """remove least recently used blobs until the store is not
+        larger than maxsize bytes. return the size of the store"""
+        entries = []
+        total = 0
+        for dirpath, dirnames, files in os.walk(self.path):
+            for fn in files:
+                if fn.startswith("."):
+                    continue
+                p = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+                total += st.st_size
+
+        if maxsize is None or total <= maxsize:
+            return total
+
+        entries.sort()
+        for mtime, size, p in entries:
+            if total <= maxsize:
+                break
+            try:
+                os.unlink(p)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+
+def get_imagestore():
+    """return the imagestore configured in the fetch section or None"""
+    path = conf.get("fetch", "imagestore", "")
+    if not path:
+        return None
+    maxsize = conf.get("fetch", "imagestore_maxsize", 2048, int) * 1024 * 1024
+    return imagestore(path, maxsize)
@@ -0,0 +1,130 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""find the images used in wikitext and compute the width of the
+thumbnails needed to print them.
+
+the widths follow mwlib.writer.imageutils: an image shown w pixels wide
+on the wiki is printed w/print_width_px of the print width and needs
+enough pixels to reach the target resolution there.
+"""
+
+import re, math
+
+from mwlib import conf
+from mwlib._conf import as_bool
+from mwlib.refine.util import ImageMod, handle_imagemod, parseParams
+
+_link_rx = re.compile(r"\[\[([^\[\]|]*)((?:\|(?:[^\[\]]|\[\[[^\[\]]*\]\])*)?)\]\]")
+_gallery_rx = re.compile(r"<gallery([^>]*)>(.*?)</gallery>", re.IGNORECASE | re.DOTALL)
+
+
+class usage(object):
+    """modifiers of one image link, set by refine.util.handle_imagemod"""
+    width = 0
+    height = 0
+    thumb = False
+    frame = None
+    align = None
+    upright = None
+    gallery = False
+
+
+def _get_width(val, default):
+    try:
+        return int(str(val).lower().replace("px", "").strip()) or default
+    except ValueError:
+        return default
+
+
+def find_usages(txt, nshandler, imagemod=None):
+    """yield (title, usage) for every image link and gallery entry in
+    wikitext txt"""
+    if imagemod is None:
+        imagemod = ImageMod(nshandler.siteinfo.get("magicwords"))
+
+    def get_image_title(target):
+        nsnum, partial, fqname = nshandler.splitname(target.strip())
+        if nsnum == -2:  # Media:
+            return nshandler.get_fqname(partial, 6)
+        if nsnum == 6 and not target.strip().startswith(":"):
+            return fqname
+        return None
+
+    for mo in _gallery_rx.finditer(txt):
+        width = _get_width(parseParams(mo.group(1)).get("widths"), 120)
+        for line in mo.group(2).split("\n"):
+            target = line.split("|", 1)[0].strip()
+            if not target:
+                continue
+            if ":" not in target:
+                target = nshandler.get_fqname(target, 6)
+            title = get_image_title(target)
+            if title is not None:
+                u = usage()
+                u.gallery = True
+                u.width = width
+                yield title, u
+
+    for mo in _link_rx.finditer(txt):
+        title = get_image_title(mo.group(1))
+        if title is None:
+            continue
+        u = usage()
+        for mod in mo.group(2).split("|")[1:]:
+            mod_type, match = imagemod.parse(mod)
+            if mod_type is not None:
+                handle_imagemod(u, mod_type, match)
+        yield title, u
+
+
+class sizer(object):
+    """computes the thumbnail width needed to print an image at dpi
+    from how articles use it. a page print_width points wide shows
+    print_width_px pixels of the wiki. widths are rounded up to
+    multiples of step, so images of similar size can be requested
+    together, and never exceed maxwidth.
+    """
+
+    def __init__(self, maxwidth, print_width=470, print_width_px=800, dpi=300,
+                 thumb_width=180, step=50):
+        self.maxwidth = maxwidth
+        self.print_width = print_width
+        self.print_width_px = print_width_px
+        self.dpi = dpi
+        self.thumb_width = thumb_width
+        self.step = step
+
+    def display_width(self, u):
+        """return the width the wiki shows the image with or None for
+        its original size"""
+        if u.gallery:
+            return u.width
+        w = u.width or None
+        if u.thumb or u.frame or u.align in ("left", "right"):
+            w = w or self.thumb_width
+            if u.upright:
+                w *= u.upright
+        return w
+
+    def get_width(self, u):
+        w = self.display_width(u)
+        if w is None:
+            return self.maxwidth
+        w = min(w, self.print_width_px)
+        px = w / float(self.print_width_px) * self.print_width / 72.0 * self.dpi
+        px = int(math.ceil(px / self.step)) * self.step
+        return max(self.step, min(px, self.maxwidth))
+
+
+def get_sizer(maxwidth):
+    """return the sizer configured in the fetch section or None if
+    images should be fetched with maxwidth"""
+    if not conf.get("fetch", "size_images", True, as_bool):
+        return None
+    return sizer(maxwidth,
+                 print_width=conf.get("fetch", "print_width", 470, float),
+                 print_width_px=conf.get("fetch", "print_width_px", 800, int),
+                 dpi=conf.get("fetch", "print_dpi", 300, int),
+                 thumb_width=conf.get("fetch", "thumb_width", 180, int))
+
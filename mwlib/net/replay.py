@@ -0,0 +1,408 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""record the responses of mediawiki and image servers and replay them
+from a local http server.
+
+recordings are files with one json object per request. the replay
+server serves every recorded host below /-/HOST/ and rewrites urls in
+api responses to point there, so that images are downloaded from it,
+too. latency, bandwidth and server errors can be simulated.
+
+which pages the fetcher asks for in one action=query request depends
+on timing and the fetcher merges concurrent requests (see
+fetch.query_planner). requests for combinations of titles, revids or
+prop modules, which have not been recorded together, are answered with
+the parts of the recorded responses for each of them.
+"""
+
+import random, base64, urllib, urlparse
+import gevent, gevent.pywsgi
+
+from mwlib import conf, myjson as json
+
+
+def split_request(url, data=None):
+    """return host and path of a request for url with post data and
+    its sorted parameters without maxlag"""
+    scheme, host, path, query, fragment = urlparse.urlsplit(url)
+    params = urlparse.parse_qsl(query, keep_blank_values=True)
+    if data:
+        params += urlparse.parse_qsl(data, keep_blank_values=True)
+    params = sorted([(k, v) for k, v in params if k != "maxlag"])
+    return "%s%s" % (host, urllib.unquote(path)), params
+
+
+def request_key(url, data=None):
+    """return the key, which identifies a request for url with post
+    data: host, path and the sorted parameters without maxlag"""
+    location, params = split_request(url, data)
+    return "%s?%s" % (location, urllib.urlencode(params))
+
+
+def split_query(location, params):
+    """return (location, name, values, rest) for an action=query
+    request, which asks for the titles or revids values and nothing to
+    continue. rest is the dict of the other parameters. return None for
+    other requests"""
+    d = dict(params)
+    if d.get("action") != "query" or ("titles" in d) == ("revids" in d):
+        return None
+    if [k for k in d if k.endswith("continue")]:
+        return None
+    name = "titles" if "titles" in d else "revids"
+    values = d.pop(name).split("|")
+    return location, name, values, d
+
+
+# parameters, which change the result of every prop module
+_exact = ("action", "format", "redirects", "converttitles")
+
+
+def _splitset(params, name):
+    return set([x for x in params.get(name, "").split("|") if x])
+
+
+def part_matches(recorded, wanted):
+    """return True if the response to a request with parameters
+    recorded contains the answer for some of the prop modules of a
+    request with parameters wanted for the same titles or revids"""
+    for k in _exact:
+        if recorded.get(k) != wanted.get(k):
+            return False
+    if not _splitset(recorded, "prop") <= _splitset(wanted, "prop"):
+        return False
+    for k, v in recorded.items():
+        if k not in ("prop", "rvprop") and wanted.get(k) != v:
+            return False
+    if "revisions" in _splitset(recorded, "prop"):
+        if not _splitset(wanted, "rvprop") <= _splitset(recorded, "rvprop"):
+            return False
+    return True
+
+
+def _merge_revisions(a, b):
+    res = [dict(r) for r in a]
+    for r in b:
+        for x in res:
+            # the latest revision may be listed with and without its id
+            if r.get("revid") == x.get("revid") or (
+                    len(a) == len(b) == 1 and None in (r.get("revid"), x.get("revid"))):
+                x.update(r)
+                break
+        else:
+            res.append(r)
+    return res
+
+
+def _add_page(pages, pageid, page):
+    if pageid not in pages:
+        pages[pageid] = page
+    elif int(pageid) < 0:  # another missing page
+        title = page.get("title")
+        for k, p in pages.items():
+            if int(k) < 0 and p.get("title") == title:
+                pages[k] = dict(p, **page)
+                break
+        else:
+            pages[str(min([0] + [int(x) for x in pages]) - 1)] = page
+    else:
+        p = pages[pageid] = dict(pages[pageid])
+        for k, v in page.items():
+            if k == "revisions" and k in p:
+                p[k] = _merge_revisions(p[k], v)
+            else:
+                p.setdefault(k, v)
+
+
+def merge_parts(name, parts, revid2pageid={}):
+    """return the response to an action=query request for the titles
+    or revids (name) of parts, a list of (value, response) with
+    responses of requests, which asked for value among others. the
+    same value may occur in several parts, which have answered
+    different prop modules. pages without revisions are found for
+    revids with revid2pageid"""
+    res = {}
+    query = res["query"] = {}
+    pages = {}
+    for value, data in parts:
+        for k, v in data.items():
+            if k != "query":
+                res.setdefault(k, v)
+        q = data.get("query", {})
+
+        if name == "titles":
+            title = value.decode("utf-8")
+            for k in ("normalized", "converted", "redirects"):
+                for x in q.get(k, []):
+                    if x.get("from") == title:
+                        if x not in query.get(k, []):
+                            query.setdefault(k, []).append(x)
+                        title = x.get("to")
+            for pageid, p in q.get("pages", {}).items():
+                if p.get("title") == title:
+                    _add_page(pages, pageid, p)
+        else:
+            revid = int(value)
+            for pageid, p in q.get("pages", {}).items():
+                revisions = [r for r in p.get("revisions", []) if r.get("revid") == revid]
+                if revisions:
+                    p = dict(p)
+                    p["revisions"] = revisions
+                    _add_page(pages, pageid, p)
+                elif "revisions" not in p and revid2pageid.get(value) == pageid:
+                    _add_page(pages, pageid, p)
+            bad = q.get("badrevids", {})
+            if value in bad:
+                query.setdefault("badrevids", {})[value] = bad[value]
+
+    if pages:
+        query["pages"] = pages
+    return res
+
+
+def _set_revid(data, revid):
+    """set the ids of the revisions in data, the response to a request
+    for the single revision revid"""
+    for p in data.get("query", {}).get("pages", {}).values():
+        for r in p.get("revisions", []):
+            r.setdefault("revid", revid)
+
+
+class recorder(object):
+    """appends request/response pairs to the recording at path"""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.out = open(path, "ab")
+
+    def add(self, url, body, data=None, kind="api"):
+        """record body as response to url. kind is api or file, only
+        urls in api responses are rewritten on replay"""
+        if isinstance(url, unicode):
+            url = url.encode("utf-8")
+        rec = dict(key=request_key(url, data), kind=kind, body=base64.b64encode(body))
+        self.out.write(json.dumps(rec) + "\n")
+        self.out.flush()
+        self.count += 1
+
+    def close(self):
+        self.out.close()
+
+    def __repr__(self):
+        return "<recorder %s: %s requests>" % (self.path, self.count)
+
+
+_path2recorder = {}
+
+
+def get_recorder():
+    """return the recorder for the file configured with fetch.record
+    or None"""
+    path = conf.get("fetch", "record", "")
+    if not path:
+        return None
+    if path not in _path2recorder:
+        _path2recorder[path] = recorder(path)
+    return _path2recorder[path]
+
+
+def read_recording(path):
+    """return list of (key, kind, body) recorded in path"""
+    res = []
+    for line in open(path, "rb"):
+        line = line.strip()
+        if not line:
+            continue
+        rec = json.loads(line)
+        res.append((str(rec["key"]), rec["kind"], base64.b64decode(rec["body"])))
+    return res
+
+
+class replay_server(object):
+    """wsgi application and server replaying a recording.
+
+    latency is added to every request (seconds), bandwidth limits the
+    transfer rate of every response (bytes per second) and error_rate
+    is the share of requests answered with 503 Service Unavailable.
+    """
+
+    chunksize = 16384
+
+    def __init__(self, path, latency=0.0, bandwidth=None, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+        self.key2response = {}
+        # (location, name, value) -> list of (parameters, key, number of values)
+        self.parts = {}
+        self.revid2pageid = {}
+        for key, kind, body in read_recording(path):
+            self.key2response[key] = (kind, body)
+            self._add_parts(key, kind, body)
+        self.hosts = set([k.split("/", 1)[0] for k in self.key2response])
+
+        self.server = None
+        self.prefix = None
+        self.requests = 0
+        self.bytes_sent = 0
+        self.errors = 0
+        self.missing = 0
+        self.merged = 0
+
+    def _add_parts(self, key, kind, body):
+        if kind != "api":
+            return
+        location, query = key.split("?", 1)
+        sq = split_query(location, urlparse.parse_qsl(query, keep_blank_values=True))
+        if sq is None:
+            return
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return
+        if "query-continue" in data or "continue" in data or "error" in data:
+            return
+        location, name, values, rest = sq
+        pages = data.get("query", {}).get("pages", {})
+        for pageid, p in pages.items():
+            for r in p.get("revisions", []):
+                if "revid" in r:
+                    self.revid2pageid[str(r["revid"])] = pageid
+        if name == "revids" and len(values) == 1 and len(pages) == 1:
+            self.revid2pageid[values[0]] = pages.keys()[0]
+        if name == "revids" and len(values) == 1 and "revisions" in _splitset(rest, "prop"):
+            # the id of the only revision is known, see _set_revid
+            rest["rvprop"] = "|".join(_splitset(rest, "rvprop") | set(["ids"]))
+        for v in values:
+            self.parts.setdefault((location, name, v), []).append((rest, key, len(values)))
+
+    def _find_parts(self, location, name, value, wanted):
+        """return list of (key, number of values) of recorded responses,
+        which together answer all prop modules of a request with
+        parameters wanted for value or None"""
+        candidates = [(len(_splitset(params, "prop")), key, count, params)
+                      for params, key, count in self.parts.get((location, name, value), [])
+                      if part_matches(params, wanted)]
+        candidates.sort(reverse=True)
+        props = _splitset(wanted, "prop")
+        res = []
+        for n, key, count, params in candidates:
+            if res and not props & _splitset(params, "prop"):
+                continue
+            props -= _splitset(params, "prop")
+            res.append((key, count))
+            if not props:
+                return res
+        return None
+
+    def _merged_response(self, url, data):
+        """return the body of a response to a request for url, which
+        has not been recorded, made from parts of recorded responses or
+        None"""
+        sq = split_query(*split_request(url, data))
+        if sq is None:
+            return None
+        location, name, values, wanted = sq
+        parts = []
+        for v in values:
+            found = self._find_parts(location, name, v, wanted)
+            if found is None:
+                return None
+            for key, count in found:
+                part = json.loads(self.key2response[key][1])
+                if name == "revids" and count == 1:
+                    _set_revid(part, int(v))
+                parts.append((v, part))
+        self.merged += 1
+        return json.dumps(merge_parts(name, parts, self.revid2pageid))
+
+    def start(self, port=0):
+        self.server = gevent.pywsgi.WSGIServer(("127.0.0.1", port), self, log=None)
+        self.server.start()
+        self.prefix = "http://127.0.0.1:%s/-/" % (self.server.server_port,)
+        self._rewrite_responses()
+
+    def stop(self):
+        self.server.stop()
+
+    def local_url(self, url):
+        """return the url, which replays url"""
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        url = self.prefix + host + path
+        if query:
+            url += "?" + query
+        return url
+
+    def _rewrite_responses(self):
+        replacements = []
+        for host in self.hosts:
+            for scheme in ("https:", "http:", ""):
+                src = "%s//%s/" % (scheme, host)
+                dst = "%s%s/" % (self.prefix, host)
+                replacements.append((src, dst))
+                # json may escape slashes
+                replacements.append((src.replace("/", "\\/"), dst.replace("/", "\\/")))
+
+        for key, (kind, body) in self.key2response.items():
+            if kind != "api":
+                continue
+            for src, dst in replacements:
+                body = body.replace(src, dst)
+            self.key2response[key] = (kind, body)
+
+    def _respond(self, start_response, status, body, content_type="text/plain"):
+        start_response(status, [("Content-Type", content_type),
+                                ("Content-Length", str(len(body))),
+                                ("Retry-After", "0")])
+        if not self.bandwidth:
+            self.bytes_sent += len(body)
+            return [body]
+        return self._throttled(body)
+
+    def _throttled(self, body):
+        for i in range(0, len(body), self.chunksize):
+            chunk = body[i:i + self.chunksize]
+            gevent.sleep(len(chunk) / float(self.bandwidth))
+            self.bytes_sent += len(chunk)
+            yield chunk
+
+    def __call__(self, environ, start_response):
+        self.requests += 1
+        if self.latency:
+            gevent.sleep(self.latency)
+
+        path = environ.get("PATH_INFO", "")
+        if not path.startswith("/-/"):
+            self.missing += 1
+            return self._respond(start_response, "404 Not Found", "not recorded")
+
+        data = None
+        if environ.get("REQUEST_METHOD") == "POST":
+            data = environ["wsgi.input"].read()
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return self._respond(start_response, "503 Service Unavailable", "injected error")
+
+        url = "http://%s?%s" % (path[3:], environ.get("QUERY_STRING", ""))
+        response = self.key2response.get(request_key(url, data))
+        if response is None:
+            body = self._merged_response(url, data)
+            if body is not None:
+                response = ("api", body)
+        if response is None:
+            self.missing += 1
+            return self._respond(start_response, "404 Not Found", "not recorded")
+
+        kind, body = response
+        if kind == "api":
+            return self._respond(start_response, "200 OK", body, "application/json; charset=utf-8")
+        return self._respond(start_response, "200 OK", body, "application/octet-stream")
+
+    def __repr__(self):
+        return "<replay_server %s requests=%s bytes=%s errors=%s missing=%s merged=%s>" % (
+            self.prefix, self.requests, self.bytes_sent, self.errors, self.missing, self.merged)
@@ -5,7 +5,7 @@
 
 """api.php client"""
 
-import urllib, urllib2, urlparse, cookielib, re
+import urllib, urllib2, urlparse, cookielib, re, zlib, time
 
 try:
     import simplejson as json
@@ -13,6 +13,10 @@ except ImportError:
     import json
 
 from mwlib import conf, authors
+from mwlib.net.connpool import keepalive_handler
+from mwlib.net.apicache import get_apicache
+from mwlib.net.replay import get_recorder
+from mwlib.net.throttle import aimd, is_congestion, maxlag_error, retry_delay
 
 
 def loads(s):
@@ -39,6 +43,32 @@ def merge_data(dst, src):
                     dst[k] = v
 
 
+class decoder(object):
+    """streaming decompression of gzip or deflate encoded data"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding in ("gzip", "x-gzip"):
+            self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.d = zlib.decompressobj()
+        self.started = False
+
+    def decompress(self, data):
+        if not self.started and self.encoding == "deflate":
+            # some servers send raw deflate data without zlib header
+            self.started = True
+            try:
+                return self.d.decompress(data)
+            except zlib.error:
+                self.d = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.started = True
+        return self.d.decompress(data)
+
+    def flush(self):
+        return self.d.flush()
+
+
 class mwapi(object):
     def __init__(self, apiurl, username=None, password=None):
         self.apiurl = apiurl
@@ -48,16 +78,29 @@ class mwapi(object):
             passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
             passman.add_password(None, apiurl, username, password)
             auth_handler = urllib2.HTTPBasicAuthHandler(passman)
-            self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()), auth_handler)
+            self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()), auth_handler, keepalive_handler())
         else:
-            self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
-        self.opener.addheaders = [('User-Agent', conf.user_agent)]
+            self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()), keepalive_handler())
+        self.opener.addheaders = [('User-Agent', conf.user_agent),
+                                  ('Accept-Encoding', 'gzip, deflate')]
         self.edittoken = None
         self.qccount = 0
+        self.bytes_received = 0  # as transferred
+        self.bytes_decoded = 0  # after decompression
         self.api_result_limit = conf.get("fetch", "api_result_limit", 500, int)
         self.api_request_limit = conf.get("fetch", "api_request_limit", 15, int)
         self.max_connections = conf.get("fetch", "max_connections", 20, int)
         self.max_retry_count = conf.get("fetch", "max_retry_count", 2, int)
+        self.maxlag = conf.get("fetch", "maxlag", 0, int)
+        self.retry_budget = None  # throttle.retry_budget shared by a job
+        self.retry_count = 0
+        self.recorder = get_recorder()
+        # responses for logged in users may not be shared, recordings
+        # need the server's responses
+        self.cache = get_apicache() if not (username or self.recorder) else None
+        self.planner = None  # merges concurrent queries, see fetch.query_planner
+        self.has_contributors = None  # unknown until the first fetch_contributors
+        self.max_history_depth = conf.get("fetch", "max_history_depth", 0, int)
         self.rvlimit = conf.get("fetch", "rvlimit", 500, int)
         self.limit_fetch_semaphore = None
 
@@ -65,25 +108,70 @@ class mwapi(object):
         pass
 
     def set_limit(self, limit=None):
+        """limit the number of parallel requests. the limit adapts to
+        the server's latency and errors, starting with limit requests.
+        """
         assert self.limit_fetch_semaphore is None, "limit already set"
 
+        maximum = conf.get("fetch", "api_max_concurrency", 32, int)
         if limit is None:
-            limit = self.api_request_limit
+            limit = conf.get("fetch", "api_concurrency", self.api_request_limit, int)
+        else:
+            maximum = max(limit, maximum)
 
-        from gevent import coros
-        self.limit_fetch_semaphore = coros.Semaphore(limit)
+        self.limit_fetch_semaphore = aimd(initial=limit, maximum=maximum)
 
     def __repr__(self):
         return "<mwapi %s at %s>" % (self.apiurl, hex(id(self)))
 
     def _fetch(self, url):
+        sem = self.limit_fetch_semaphore
+        start = time.time()
+        try:
+            data = self._read(url)
+        except Exception, err:
+            if sem is not None and is_congestion(err):
+                sem.failure(start)
+            raise
+
+        if sem is not None:
+            sem.success(start)
+        if self.recorder is not None:
+            if isinstance(url, urllib2.Request):
+                self.recorder.add(url.get_full_url(), data, url.get_data())
+            else:
+                self.recorder.add(url, data)
+        return data
+
+    def _read(self, url):
         f = self.opener.open(url)
-        data = f.read()
+        encoding = f.info().get("Content-Encoding", "").strip().lower()
+        if encoding in ("gzip", "x-gzip", "deflate"):
+            d = decoder(encoding)
+        else:
+            d = None
+
+        chunks = []
+        while 1:
+            data = f.read(16384)
+            if not data:
+                break
+            self.bytes_received += len(data)
+            if d is not None:
+                data = d.decompress(data)
+            chunks.append(data)
         f.close()
+        if d is not None:
+            chunks.append(d.flush())
+
+        data = "".join(chunks)
+        self.bytes_decoded += len(data)
         return data
 
     def _build_url(self, **kwargs):
         args = {'format': 'json'}
+        if self.maxlag:
+            args['maxlag'] = self.maxlag
         args.update(**kwargs)
         for k, v in args.items():
             if isinstance(v, unicode):
@@ -101,6 +189,8 @@ class mwapi(object):
 
     def _post(self, **kwargs):
         args = {'format': 'json'}
+        if self.maxlag:
+            args['maxlag'] = self.maxlag
         args.update(**kwargs)
         for k, v in args.items():
             if isinstance(v, unicode):
@@ -115,6 +205,29 @@ class mwapi(object):
         return res
 
     def do_request(self, use_post=False, **kwargs):
+        planner = self.planner
+        if planner is not None and not use_post and planner.accepts(kwargs):
+            return planner.query(**kwargs)
+        return self.do_retrying_request(use_post, **kwargs)
+
+    def do_retrying_request(self, use_post=False, **kwargs):
+        """send request, retrying up to max_retry_count times with
+        exponential backoff if the server is overloaded or unreachable
+        """
+        attempt = 0
+        while 1:
+            try:
+                return self._do_limited_request(use_post, **kwargs)
+            except Exception, err:
+                delay = retry_delay(err, attempt, self.max_retry_count, self.retry_budget)
+                if delay is None:
+                    raise
+            attempt += 1
+            self.retry_count += 1
+            print "retrying %s in %.1fs after: %s" % (kwargs.get("action"), delay, err)
+            time.sleep(delay)
+
+    def _do_limited_request(self, use_post=False, **kwargs):
         sem = self.limit_fetch_semaphore
         if sem is not None:
             sem.acquire()
@@ -128,7 +241,7 @@ class mwapi(object):
             if sem is not None:
                 sem.release()
 
-    def _do_request(self, query_continue=True, merge_data=merge_data, **kwargs):
+    def _do_request(self, query_continue=True, merge_data=merge_data, max_continue=None, **kwargs):
         last_qc = None
         action = kwargs["action"]
         retval = {}
@@ -137,15 +250,33 @@ class mwapi(object):
             kwargs = todo
             todo = None
 
-            data = loads(self._request(**kwargs))
+            start = time.time()
+            raw = None
+            if self.cache is not None:
+                raw = self.cache.get(self.apiurl, kwargs)
+            from_cache = raw is not None
+            if raw is None:
+                raw = self._request(**kwargs)
+
+            data = loads(raw)
             error = data.get("error")
             if error:
-                raise RuntimeError("%s: [fetching %s]" % (error.get("info", ""), self._build_url(**kwargs)))
+                msg = "%s: [fetching %s]" % (error.get("info", ""), self._build_url(**kwargs))
+                if error.get("code") == "maxlag":
+                    if self.limit_fetch_semaphore is not None:
+                        self.limit_fetch_semaphore.failure(start)
+                    # mediawiki asks for a retry after 5 seconds
+                    raise maxlag_error(msg, retry_after=5.0)
+                raise RuntimeError(msg)
+            if self.cache is not None and not from_cache:
+                self.cache.set(self.apiurl, kwargs, raw)
             merge_data(retval, data[action])
 
             qc = data.get("query-continue", {}).values()
 
-            if qc and query_continue:
+            if qc and query_continue and max_continue != 0:
+                if max_continue is not None:
+                    max_continue -= 1
                 self.qccount += 1
                 self.report()
                 kw = kwargs.copy()
@@ -153,6 +284,12 @@ class mwapi(object):
                     for k, v in d.items():  # dict of len(1)
                         kw[str(k)] = v
 
+                # only continue the prop modules, which are not done yet
+                modules = data["query-continue"].keys()
+                props = kwargs.get("prop", "").split("|")
+                if "generator" not in kwargs and set(modules) <= set(props):
+                    kw["prop"] = "|".join([x for x in props if x in modules])
+
                 if qc == last_qc:
                     print "warning: cannot continue this query:",  self._build_url(**kw)
                     return retval
@@ -180,6 +317,8 @@ class mwapi(object):
         raise RuntimeError("could not get siteinfo")
 
     def login(self, username, password, domain=None, lgtoken=None):
+        # responses for logged in users may not be shared
+        self.cache = None
         args = dict(action="login",
                     lgname=username.encode("utf-8"),
                     lgpassword=password.encode("utf-8"),
@@ -202,16 +341,19 @@ class mwapi(object):
         raise RuntimeError("login failed: %r" % res)
 
     def fetch_used(self, titles=None, revids=None, fetch_images=True, expanded=False):
+        # info tells, whether the revisions asked for are the latest ones.
+        # templates are listed for expanded pages, too, as the nuwiki
+        # records, which templates its articles depend on
         if fetch_images:
             if expanded:
-                prop = "images"
+                prop = "templates|images|info"
             else:
-                prop = "revisions|templates|images"
+                prop = "revisions|templates|images|info"
         else:
             if expanded:
-                prop = ""
+                prop = "templates|info"
             else:
-                prop = "revisions|templates"
+                prop = "revisions|templates|info"
 
         kwargs = dict(prop=prop,
                       rvprop='ids',
@@ -223,6 +365,79 @@ class mwapi(object):
         self._update_kwargs(kwargs, titles, revids)
         return self.do_request(action="query", **kwargs)
 
+    def fetch_latest_revids(self, titles):
+        """return dict mapping each of titles to the id of the latest
+        revision of the page it (possibly via a redirect) refers to
+        """
+        kwargs = dict(prop="info", redirects=1)
+        self._update_kwargs(kwargs, titles, [])
+        data = self.do_request(action="query", **kwargs)
+
+        latest = {}
+        for p in data.get("pages", {}).values():
+            if "lastrevid" in p:
+                latest[p["title"]] = p["lastrevid"]
+
+        res = {}
+        for t, target in self._resolve_titles(data, titles).items():
+            if target in latest:
+                res[t] = latest[target]
+        return res
+
+    def fetch_contributors(self, titles):
+        """return dict mapping each of titles to its list of authors as
+        returned by authors.inspect_authors.get_authors. the authors of
+        many titles are fetched with one prop=contributors query.
+        return None if the wiki doesn't know prop=contributors.
+
+        prop=contributors only tells the number of anonymous users, not
+        of their edits. the lists end with ANONCONTRIBUTORS:N instead of
+        ANONIPEDITS:N. max_history_depth doesn't apply.
+        """
+        if self.has_contributors is False:
+            return None
+
+        kwargs = dict(prop="contributors", pclimit=self.api_result_limit,
+                      pcexcludegroup="bot", redirects=1)
+        self._update_kwargs(kwargs, titles, [])
+        data = self.do_request(action="query", **kwargs)
+
+        pages = [p for p in data.get("pages", {}).values() if "missing" not in p and "invalid" not in p]
+        if pages and not [p for p in pages if "contributors" in p or "anoncontributors" in p]:
+            self.has_contributors = False
+            return None
+        self.has_contributors = True
+
+        target2authors = {}
+        for p in pages:
+            inspect = authors.inspect_authors()
+            inspect.scan_edits([dict(user=c.get("name", u"")) for c in p.get("contributors", [])])
+            inspect.num_anon_contributors = p.get("anoncontributors", 0)
+            target2authors[p["title"]] = inspect.get_authors()
+
+        res = {}
+        for t, target in self._resolve_titles(data, titles).items():
+            if target in target2authors:
+                res[t] = target2authors[target]
+        return res
+
+    def _resolve_titles(self, data, titles):
+        """return dict mapping titles to the titles of the pages in the
+        query result data they got normalized or redirected to"""
+        title2target = {}
+        for x in data.get("normalized", []) + data.get("redirects", []):
+            title2target[x["from"]] = x["to"]
+
+        res = {}
+        for t in titles:
+            target = t
+            seen = set()
+            while target in title2target and target not in seen:
+                seen.add(target)
+                target = title2target[target]
+            res[t] = target
+        return res
+
     def _update_kwargs(self, kwargs, titles, revids):
         assert titles or revids and not (titles and revids), 'either titles or revids must be set'
 
@@ -245,26 +460,14 @@ class mwapi(object):
         return not sem.locked()
 
     def fetch_pages(self, titles=None, revids=None):
-        kwargs = dict(prop="revisions",
+        kwargs = dict(prop="revisions|categories",
                       rvprop='ids|content|timestamp|user',
-                      imlimit=self.api_result_limit,
-                      tllimit=self.api_result_limit)
-        if titles:
-            kwargs['redirects'] = 1
-
-        self._update_kwargs(kwargs, titles, revids)
-
-        rev_result = self.do_request(action="query", **kwargs)
-
-        kwargs = dict(prop="categories",
                       cllimit=self.api_result_limit)
         if titles:
             kwargs['redirects'] = 1
 
         self._update_kwargs(kwargs, titles, revids)
-        cat_result = self.do_request(action="query", **kwargs)
-        merge_data(rev_result, cat_result)
-        return rev_result
+        return self.do_request(action="query", **kwargs)
 
     def fetch_imageinfo(self, titles, iiurlwidth=800):
         kwargs = dict(prop="imageinfo|info",
@@ -278,6 +481,9 @@ class mwapi(object):
 
     def get_edits(self, title, revision, rvlimit=None):
         rvlimit = rvlimit or self.rvlimit
+        depth = self.max_history_depth
+        if depth:
+            rvlimit = min(rvlimit, depth)
         kwargs = {
             'titles': title,
             'redirects': 1,
@@ -311,6 +517,8 @@ class mwapi(object):
                 revs = e["revisions"]
                 get_authors.scan_edits(revs)
 
+        if depth:
+            kwargs["max_continue"] = (depth - 1) // rvlimit
         self.do_request(action="query", merge_data=merge_data, **kwargs)
         return get_authors
 
@@ -0,0 +1,155 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""adaptive limits for the number of parallel requests to a server and
+retries of failed requests"""
+
+import time, random, socket, httplib, urllib2, rfc822
+import gevent.event
+
+
+class maxlag_error(RuntimeError):
+    """mediawiki refused a request because its database replication lag
+    is higher than the maxlag parameter"""
+
+    def __init__(self, msg, retry_after=None):
+        RuntimeError.__init__(self, msg)
+        self.retry_after = retry_after
+
+
+def is_congestion(err):
+    """return True if exception err signals an overloaded server"""
+    if isinstance(err, maxlag_error):
+        return True
+    if isinstance(err, urllib2.HTTPError):
+        return err.code >= 500 or err.code == 429
+    if isinstance(err, urllib2.URLError):
+        err = err.reason
+    return isinstance(err, (socket.timeout, socket.error, httplib.BadStatusLine))
+
+
+class aimd(object):
+    """semaphore with additive increase/multiplicative decrease of
+    its size.
+
+    the window grows by increase for every window successful requests
+    as long as their latency stays below tolerance times the lowest
+    latency seen and shrinks by factor decrease when the server reports
+    congestion. failures of requests started before the last decrease
+    are not counted again.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, increase=1.0, decrease=0.5, tolerance=2.0):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.window = float(min(max(initial, minimum), self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.active = 0
+        self._event = gevent.event.Event()
+
+    @property
+    def limit(self):
+        return max(self.minimum, int(self.window))
+
+    def locked(self):
+        return self.active >= self.limit
+
+    def acquire(self):
+        while self.locked():
+            self._event.clear()
+            self._event.wait()
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._event.set()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+    def success(self, start):
+        """record a successful request started at time start"""
+        latency = time.time() - start
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            # let the baseline follow slowly changing conditions
+            self.baseline += (latency - self.baseline) * 0.01
+
+        if latency <= self.baseline * self.tolerance + 0.01:
+            self.window = min(self.maximum, self.window + self.increase / self.window)
+
+    def failure(self, start):
+        """record a request started at time start, which failed because
+        of congestion"""
+        if start < self.last_decrease:
+            return
+        self.window = max(self.minimum, self.window * self.decrease)
+        self.last_decrease = time.time()
+        self._event.set()
+
+    def __repr__(self):
+        return "<aimd window=%.1f active=%s>" % (self.window, self.active)
+
+
+def get_retry_after(err):
+    """return the number of seconds to wait according to the
+    Retry-After header of a response or None"""
+    if isinstance(err, maxlag_error):
+        return err.retry_after
+
+    hdrs = getattr(err, "hdrs", None)
+    if hdrs is None:
+        return None
+    val = hdrs.get("Retry-After")
+    if not val:
+        return None
+    try:
+        return max(0.0, float(val))
+    except ValueError:
+        pass
+    t = rfc822.parsedate_tz(val)
+    if t is None:
+        return None
+    return max(0.0, rfc822.mktime_tz(t) - time.time())
+
+
+class retry_budget(object):
+    """limits the number of retries of all requests of a job"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.retries = 0
+
+    def take(self):
+        if self.retries >= self.budget:
+            return False
+        self.retries += 1
+        return True
+
+    def __repr__(self):
+        return "<retry_budget %s/%s>" % (self.retries, self.budget)
+
+
+def retry_delay(err, attempt, max_retries, budget=None, base=0.5, cap=30.0):
+    """return the number of seconds to wait before retrying a request,
+    which failed with exception err on its attempt'th retry, or None if
+    it should not be retried. delays grow exponentially with random
+    jitter unless the server asks for a specific delay.
+    """
+    if attempt >= max_retries or not is_congestion(err):
+        return None
+    if budget is not None and not budget.take():
+        return None
+
+    delay = get_retry_after(err)
+    if delay is not None:
+        return min(delay, cap * 4) + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** (attempt + 1)))
@@ -285,6 +285,10 @@ class Application(object):
 
         params.collection_id = collection_id
 
+        previous_collection_id = g('previous_collection_id')
+        if previous_collection_id and collection_id_rex.match(previous_collection_id):
+            params.previous_collection_id = previous_collection_id
+
         return params
 
     def do_render(self, collection_id, post_data, is_new=False):
@@ -117,7 +117,7 @@ class commands(object):
         return 'qserve://%s:%s/%s' % (host, port, self.jobid)
 
     def rpc_makezip(self, params=None):
-        def doit(metabook_data=None, collection_id=None, base_url=None, **kw):
+        def doit(metabook_data=None, collection_id=None, base_url=None, previous_collection_id=None, **kw):
             dir = get_collection_dir(collection_id)
 
             def getpath(p):
@@ -136,6 +136,11 @@ class commands(object):
             if base_url:
                 args.extend(['--config', base_url])
 
+            if previous_collection_id and previous_collection_id != collection_id:
+                previous_zip = os.path.join(get_collection_dir(previous_collection_id), "collection.zip")
+                if os.path.exists(previous_zip):
+                    args.extend(["--previous", previous_zip])
+
             args.extend(_get_args(zip_only=True, **params))
 
             if metabook_data:
@@ -202,11 +207,14 @@ def main():
     http_address = '0.0.0.0'
     http_port = 8898
     serve_files = True
+    imagestore = None
     from mwlib import argv
-    opts, args = argv.parse(sys.argv[1:], "--no-serve-files --serve-files-port= --serve-files-address= --serve-files --cachedir= --url= --numprocs=")
+    opts, args = argv.parse(sys.argv[1:], "--no-serve-files --serve-files-port= --serve-files-address= --serve-files --cachedir= --url= --numprocs= --imagestore=")
     for o, a in opts:
         if o == "--cachedir":
             cachedir = a
+        elif o == "--imagestore":
+            imagestore = a
         elif o == "--url":
             cacheurl = a
         elif o == "--numprocs":
@@ -232,6 +240,12 @@ def main():
         sys.exit("--url option missing")
 
     make_cachedir(cachedir)
+
+    # share downloaded images between all mw-zip processes we start
+    if imagestore is None:
+        imagestore = os.environ.get("MWLIB_FETCH_IMAGESTORE") or os.path.join(cachedir, "imagestore")
+    os.environ["MWLIB_FETCH_IMAGESTORE"] = os.path.abspath(imagestore)
+
     from mwlib.async import slave
     slave.main(commands, numgreenlets=numgreenlets, argv=args)
 
@@ -3,42 +3,214 @@
 # See README.rst for additional licensing information.
 
 import os
+import mmap
+import bisect
+import heapq
 import zipfile
 import shutil
 import tempfile
 import urllib
+import cPickle
 import sqlite3dbm
+from hashlib import md5
 from mwlib import myjson as json
 
-from mwlib import nshandling, utils
+from mwlib import nshandling, utils, conf
+from mwlib._conf import as_bool
+from mwlib.lrucache import lrucache, mt_lrucache
 from mwlib.log import Log
 
 log = Log('nuwiki')
 
 
 class page(object):
-    expanded = 0
-    def __init__(self, meta, rawtext):
-        self.__dict__.update(meta)
-        self.rawtext = rawtext
+    """a single revision of a page.
+
+    the wikitext is stored as utf-8 encoded str or as (revfile, offset,
+    length) tuple and decoded whenever rawtext is read. the decoded
+    texts of recently used pages are kept in decoded_cache, which is
+    shared by the pages of a nuwiki. pages without cache decode their
+    text every time. the cache is not pickled.
+    """
+
+    __slots__ = ("title", "ns", "revid", "expanded", "_data", "decoded_cache")
+
+    def __init__(self, meta, rawtext=None, source=None, cache=None):
+        self.title = meta.get("title")
+        self.ns = meta.get("ns", 0)
+        self.revid = meta.get("revid")
+        self.expanded = meta.get("expanded", 0)
+        self.decoded_cache = cache
+        if source is not None:
+            self._data = source
+        else:
+            self.rawtext = rawtext
+
+    def _get_rawtext(self):
+        data = self._data
+        if data is None:
+            return None
+
+        cache = self.decoded_cache
+        if cache is not None:
+            try:
+                return cache[data]
+            except KeyError:
+                pass
+
+        if isinstance(data, tuple):
+            rf, offset, length = data
+            res = unicode(rf.read(offset, length), "utf-8")
+        else:
+            res = unicode(data, "utf-8")
+
+        if cache is not None:
+            cache[data] = res
+        return res
+
+    def _set_rawtext(self, rawtext):
+        if isinstance(rawtext, unicode):
+            rawtext = rawtext.encode("utf-8")
+        self._data = rawtext
+
+    rawtext = property(_get_rawtext, _set_rawtext)
+
+    def __getstate__(self):
+        return tuple(getattr(self, x) for x in self.__slots__[:-1])
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+        self.decoded_cache = None
+
+
+class revfile(object):
+    """read-only memory mapped revisions-N.txt file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            f = open(self.path, "rb")
+            try:
+                if os.fstat(f.fileno()).st_size:
+                    self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self._data = ""  # empty files cannot be mapped
+            finally:
+                f.close()
+        return self._data
+
+    def read(self, offset, length):
+        return self.data[offset:offset + length]
+
+    def __getstate__(self):
+        return dict(path=self.path, _data=None)
+
 
 class DumbJsonDB(object):
+    """read-only sqlite3dbm database with json encoded values.
 
-    def __init__(self, fn, allow_pickle=False):
+    decoded values are kept in a bounded LRU cache, whose size can be
+    set with the db_cachesize option of the nuwiki config section.
+    prefetched values are kept apart from it until they are read for
+    the first time, so that they are not evicted before.
+    """
+
+    def __init__(self, fn, allow_pickle=False, cachesize=None):
         self.fn = fn
         self.allow_pickle = allow_pickle
+        if cachesize is None:
+            cachesize = conf.get("nuwiki", "db_cachesize", 1000, int)
+        self.cachesize = cachesize
         self.read_db()
 
     def read_db(self):
         self.db = sqlite3dbm.open(self.fn)
+        self.cache = lrucache(self.cachesize)
+        self.prefetched = {}
+        self.prefetch_hits = self.prefetch_misses = 0
 
-    def __getitem__(self, key):
-        v = self.db.get(key, '')
+    @property
+    def hits(self):
+        return self.cache.hits + self.prefetch_hits
+
+    @property
+    def misses(self):
+        return self.cache.misses + self.prefetch_misses
+
+    def _decode(self, v):
         if v:
             return json.loads(v)
         else:
             return None
 
+    def __getitem__(self, key):
+        if key in self.prefetched:
+            self.prefetch_hits += 1
+            res = self.cache[key] = self.prefetched.pop(key)
+            return res
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        res = self.cache[key] = self._decode(self.db.get(key, ''))
+        return res
+
+    def _read_many(self, keys, blocksize):
+        """return dict mapping keys to their decoded values. they are
+        read with one SELECT ... IN query per blocksize keys.
+        """
+        def dbkey(k):
+            # sqlite3dbm's text_factory is str
+            if isinstance(k, unicode):
+                return k.encode("utf-8")
+            return str(k)
+
+        res = {}
+        keys = list(keys)
+        while keys:
+            block = keys[:blocksize]
+            del keys[:blocksize]
+            query = "SELECT key, val FROM kv_table WHERE key IN (%s)" % ",".join("?" * len(block))
+            found = dict(self.db.conn.execute(query, [dbkey(k) for k in block]))
+            for k in block:
+                res[k] = self._decode(found.get(dbkey(k)))
+        return res
+
+    def get_many(self, keys, blocksize=500):
+        """return list of decoded values for keys, None for missing keys.
+
+        keys, which are not cached, are fetched with one SELECT ... IN
+        query per blocksize keys and added to the cache.
+        """
+        res = {}
+        todo = []
+        for k in keys:
+            if k in self.prefetched:
+                res[k] = self[k]
+                continue
+            try:
+                res[k] = self.cache[k]
+            except KeyError:
+                todo.append(k)
+
+        for k, v in self._read_many(todo, blocksize).items():
+            res[k] = self.cache[k] = v
+
+        return [res[k] for k in keys]
+
+    def prefetch(self, keys, blocksize=500):
+        """read the values of keys, which are neither cached nor
+        prefetched, and keep them until they are read
+        """
+        todo = [k for k in set(keys) if k not in self.prefetched and k not in self.cache.cache]
+        self.prefetch_misses += len(todo)
+        self.prefetched.update(self._read_many(todo, blocksize))
+
     def get(self, key, default=None):
         res = self[key]
         if res == None:
@@ -55,6 +227,8 @@ class DumbJsonDB(object):
         assert self.allow_pickle, 'ERROR: pickling not allowed for zip files. Use unzipped zip file instead'
         d = self.__dict__.copy()
         del d['db']
+        del d['cache']
+        del d['prefetched']
         return d
 
     def __setstate__(self, d):
@@ -64,7 +238,9 @@ class DumbJsonDB(object):
 
 
 class nuwiki(object):
-    def __init__(self, path, allow_pickle=False):
+    snapshot_version = 1
+
+    def __init__(self, path, allow_pickle=False, snapshot=None):
         self.path = os.path.abspath(path)
         d = os.path.join(self.path, "images", "safe")
         if not os.path.exists(d):
@@ -73,98 +249,233 @@ class nuwiki(object):
             except OSError, exc:
                 if exc.errno != 17: # file exists
                     raise
-            
-        self.excluded = set(x.get("title") for x in self._loadjson("excluded.json", []))            
+
+        self._revfiles = {}
+        # decoded texts of recently used pages, see page. pages may be
+        # read from several threads
+        self.decoded_cache = mt_lrucache(100)
+        meta = None
+        use_snapshot = snapshot
+        if use_snapshot is None:
+            # off by default: the snapshot is written next to the nuwiki
+            # and unpickled when opening it again
+            use_snapshot = conf.get("nuwiki", "snapshot", False, as_bool)
+        if use_snapshot:
+            checksum = self._snapshot_checksum()
+            meta = self._load_snapshot(checksum)
+        if meta is None:
+            meta = self._read_metadata()
+            if use_snapshot:
+                self._write_snapshot(checksum, meta)
+
+        self.excluded = meta["excluded"]
+        self.redirects = meta["redirects"]
+        self.siteinfo = meta["siteinfo"]
+        self.nshandler = meta["nshandler"]
+        self.nfo = meta["nfo"]
 
         self.revisions = {}
-        self._read_revisions()
+        self._title_index = None
+        self._read_revisions(meta["revindex"])
 
         fn = os.path.join(self.path, 'authors.db')
-        if not os.path.exists(fn):
+        if not self._exists(fn):
             self.authors = None
             log.warn('no authors present. parsing revision info instead')
         else:
-            self.authors = DumbJsonDB(fn, allow_pickle=allow_pickle)
+            self.authors = DumbJsonDB(self._localpath(fn), allow_pickle=allow_pickle)
 
         fn = os.path.join(self.path, 'html.db')
-        if not os.path.exists(fn):
+        if not self._exists(fn):
             self.html = self.extractHTML(self._loadjson("parsed_html.json", {}))
             log.warn('no html present. parsing revision info instead')
         else:
-            self.html = DumbJsonDB(fn, allow_pickle=allow_pickle)
+            self.html = DumbJsonDB(self._localpath(fn), allow_pickle=allow_pickle)
 
         fn = os.path.join(self.path, 'imageinfo.db')
-        if not os.path.exists(fn):
+        if not self._exists(fn):
             self.imageinfo = self._loadjson("imageinfo.json", {})
             log.warn('loading imageinfo from pickle')
         else:
-            self.imageinfo = DumbJsonDB(fn, allow_pickle=allow_pickle)
+            self.imageinfo = DumbJsonDB(self._localpath(fn), allow_pickle=allow_pickle)
 
-        self.redirects = self._loadjson("redirects.json", {})
-        self.siteinfo = self._loadjson("siteinfo.json", {})
-        self.nshandler = nshandling.nshandler(self.siteinfo)        
         self.en_nshandler = nshandling.get_nshandler_for_lang('en') 
-        self.nfo = self._loadjson("nfo.json", {})
 
+        self._read_image_manifest()
         self.set_make_print_template()
 
     def __getstate__(self):
         d = self.__dict__.copy()
         del d['make_print_template']
+        del d['decoded_cache']
         return d
 
     def __setstate__(self, d):
         self.__dict__ = d
+        self.decoded_cache = mt_lrucache(100)
+        for pg in self.revisions.values():
+            pg.decoded_cache = self.decoded_cache
         self.set_make_print_template()
 
     def set_make_print_template(self):
         self.make_print_template = None
 
+    def _read_metadata(self):
+        """read everything needed to open the nuwiki except for the
+        databases and images. this is what gets stored in the snapshot.
+        """
+        siteinfo = self._loadjson("siteinfo.json", {})
+        return dict(
+            excluded=set(x.get("title") for x in self._loadjson("excluded.json", [])),
+            redirects=self._loadjson("redirects.json", {}),
+            siteinfo=siteinfo,
+            nshandler=nshandling.nshandler(siteinfo),
+            nfo=self._loadjson("nfo.json", {}),
+            revindex=self._read_revindex())
+
+    def _snapshot_path(self):
+        return self._pathjoin("nuwiki.snapshot")
+
+    def _snapshot_checksum(self):
+        """return checksum over name, size and modification time of the
+        top-level files of the nuwiki
+        """
+        snapshot_name = os.path.basename(self._snapshot_path())
+        h = md5()
+        for fn in sorted(os.listdir(self.path)):
+            if fn.startswith(snapshot_name):
+                continue
+            p = self._pathjoin(fn)
+            if os.path.isfile(p):
+                st = os.stat(p)
+                h.update(repr((fn, st.st_size, st.st_mtime)))
+        return h.hexdigest()
+
+    def _load_snapshot(self, checksum):
+        path = self._snapshot_path()
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            version, snapshot_checksum, meta = cPickle.load(open(path, "rb"))
+        except Exception, err:
+            log.warn("could not load snapshot %r: %s" % (path, err))
+            return None
+        if version != self.snapshot_version or snapshot_checksum != checksum:
+            return None
+        return meta
+
+    def _write_snapshot(self, checksum, meta):
+        path = self._snapshot_path()
+        if path is None:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path))
+            f = os.fdopen(fd, "wb")
+            cPickle.dump((self.snapshot_version, checksum, meta), f, cPickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError), err:
+            log.warn("could not write snapshot %r: %s" % (path, err))
+
     def _loadjson(self, path, default=None):
         path = self._pathjoin(path)
         if self._exists(path):
-            return json.load(open(path, "rb"))
+            return json.loads(self._read(path))
         return default
         
-    def _read_revisions(self):
+    def _get_revfile(self, fn):
+        try:
+            return self._revfiles[fn]
+        except KeyError:
+            rf = self._revfiles[fn] = revfile(self._pathjoin(fn))
+            return rf
+
+    def _scan_revisions(self):
+        """build the revision index by scanning the revisions-N.txt files
+        for page headers. used for collections without revindex.json
+        """
+        marker = "\n --page-- "
+        index = []
         count = 1
         while 1:
-            fn = self._pathjoin("revisions-%s.txt" % count)
-            if not os.path.exists(fn):
+            fn = "revisions-%s.txt" % count
+            if not self._exists(self._pathjoin(fn)):
                 break
             count += 1
-            print "reading", fn
-            d=unicode(open(self._pathjoin(fn), "rb").read(), "utf-8")
-            pages = d.split("\n --page-- ")
-
-            for p in pages[1:]:
-                jmeta, rawtext = p.split("\n", 1)
-                meta = json.loads(jmeta)
-                pg = Page(meta, rawtext)
-                if pg.title in self.excluded and pg.ns!=0:
-                    pg.rawtext = unichr(0xebad)
-                revid = meta.get("revid")
-                if revid is None:
-                    self.revisions[pg.title] = pg
-                    continue
-
-                self.revisions[meta["revid"]] = pg
-
-                # else:
-                #     print "excluding:", repr(pg.title)
-                
-        tmp = self.revisions.items()
-        tmp.sort(reverse=True)
-        for revid, p in tmp:
-            title = p.title
-            if title not in self.revisions:
-                self.revisions[title] = p
-                
+            print "scanning", self._pathjoin(fn)
+            data = self._get_revfile(fn).data
+            pos = data.find(marker)
+            while pos != -1:
+                start = pos + len(marker)
+                eol = data.find("\n", start)
+                meta = json.loads(unicode(data[start:eol], "utf-8"))
+                pos = data.find(marker, eol)
+                if pos == -1:
+                    end = len(data)
+                else:
+                    end = pos
+                index.append([fn, eol + 1, end - eol - 1, meta])
+        return index
+
+    def _read_revindex(self):
+        path = self._pathjoin("revindex.json")
+        if self._exists(path):
+            # decode first, titles should be unicode like in _scan_revisions
+            return json.loads(unicode(self._read(path), "utf-8"))
+        return self._scan_revisions()
+
+    def _read_revisions(self, index):
+        for fn, offset, length, meta in index:
+            pg = Page(meta, source=(self._get_revfile(fn), offset, length), cache=self.decoded_cache)
+            if pg.title in self.excluded and pg.ns!=0:
+                pg.rawtext = unichr(0xebad)
+            self.add_page(pg)
+
+    def add_page(self, pg):
+        """add page pg under its revid and its title.
+
+        the title refers to the page without revid or, if there is
+        none, to the one with the highest revid.
+        """
+        revid = getattr(pg, "revid", None)
+        old = self.revisions.get(pg.title)
+        if revid is not None:
+            self.revisions[revid] = pg
+            if old is not None and getattr(old, "revid", None) is None:
+                return
+            if old is not None and old.revid > revid:
+                return
+        self.revisions[pg.title] = pg
+
+        if old is None and self._title_index is not None:
+            bisect.insort(self._title_index.setdefault(pg.ns, []), pg.title)
+
+    def _get_title_index(self):
+        """return dict mapping namespace number to the sorted list of
+        titles in that namespace. built on first use.
+        """
+        if self._title_index is None:
+            index = {}
+            for key, p in self.revisions.items():
+                if isinstance(key, basestring):
+                    index.setdefault(p.ns, []).append(key)
+            for titles in index.values():
+                titles.sort()
+            self._title_index = index
+        return self._title_index
+
     def _pathjoin(self, *p):
         return os.path.join(self.path, *p)
     
     def _exists(self, p):
         return os.path.exists(p)
+
+    def _read(self, p):
+        return open(p, "rb").read()
+
+    def _localpath(self, p):
+        """return filesystem path for p, which must exist"""
+        return p
     
     def get_siteinfo(self):
         return self.siteinfo
@@ -197,6 +508,36 @@ class nuwiki(object):
         fqname = self.nshandler.get_fqname(name, defaultns=defaultns)
         return self.get_page(fqname)
 
+    def _list_images(self):
+        d = self._pathjoin("images")
+        return [fn for fn in os.listdir(d) if not os.path.isdir(os.path.join(d, fn))]
+
+    def _read_image_manifest(self):
+        """map the fsescaped names of all images to their path in
+        images/safe and create the missing symlinks there
+        """
+        self.image_manifest = {}
+        safedir = self._pathjoin("images", "safe")
+        existing = set(os.listdir(safedir))
+        for fn in self._list_images():
+            if isinstance(fn, unicode):
+                fn = fn.encode("utf-8")
+            if fn.endswith(u'\xb7'.encode("utf-8")):  # incomplete download
+                continue
+            ext = os.path.splitext(fn)[-1]
+            ext = ext.replace(' ', '')
+            # mediawiki gives us png's for these extensions. let's change them here.
+            if ext.lower() in (".gif", ".svg", '.tif', '.tiff'):
+                ext = ".png"
+            hd = md5(fn).hexdigest() + ext
+            if hd not in existing:
+                try:
+                    os.symlink(os.path.join("..", fn), os.path.join(safedir, hd))
+                except OSError, exc:
+                    if exc.errno != 17: # File exists
+                        raise
+            self.image_manifest[fn] = os.path.join(safedir, hd)
+
     def normalize_and_get_image_path(self, name):
         assert isinstance(name, basestring)
         name = unicode(name)
@@ -206,55 +547,45 @@ class nuwiki(object):
 
         if "/" in fqname:
             return None
-        
-        
-        
-        
-        p = self._pathjoin("images", utils.fsescape(fqname))
-        if not self._exists(p):
-            fqname = 'File:' + partial # Fallback to default language english
-            p = self._pathjoin("images", utils.fsescape(fqname))
-            if not self._exists(p):
+
+        fn = utils.fsescape(fqname)
+        if fn not in self.image_manifest:
+            fn = utils.fsescape('File:' + partial) # Fallback to default language english
+            if fn not in self.image_manifest:
                 return None
 
-        if 1:
-            from hashlib import md5
-            
-            hd = md5(fqname.encode("utf-8")).hexdigest()
-            ext = os.path.splitext(p)[-1]
-            ext = ext.replace(' ', '')
-            # mediawiki gives us png's for these extensions. let's change them here.
-            if ext.lower() in (".gif", ".svg", '.tif', '.tiff'):
-                # print "change xt:", ext
-                ext = ".png"
-            hd += ext
-                
-            safe_path = self._pathjoin("images", "safe", hd)
-            if not os.path.exists(safe_path):
-                try:
-                    os.symlink(os.path.join("..", utils.fsescape(fqname)), safe_path)
-                except OSError, exc:
-                    if exc.errno != 17: # File exists
-                        raise
-            return safe_path
-        return p
+        self._localpath(self._pathjoin("images", fn))
+        return self.image_manifest[fn]
 
     def get_data(self, name):
         return self._loadjson(name+".json")
 
+    def iter_titles(self, start=None, end=None, ns=None):
+        """yield titles between start and end (inclusive) in sorted
+        order, optionally restricted to namespace number ns
+        """
+        index = self._get_title_index()
+        if ns is None:
+            lists = index.values()
+        else:
+            lists = [index.get(ns, [])]
+
+        def titles_in_range(titles):
+            lo, hi = 0, len(titles)
+            if start is not None:
+                lo = bisect.bisect_left(titles, start)
+            if end is not None:
+                hi = bisect.bisect_right(titles, end)
+            for i in xrange(lo, hi):
+                yield titles[i]
+
+        return heapq.merge(*[titles_in_range(x) for x in lists])
+
     def articles(self):
-        res = list(set([p.title for p in self.revisions.values() if p.ns==0]))
-        res.sort()
-        return res
+        return list(self.iter_titles(ns=0))
 
     def select(self, start, end):
-        res = set()
-        for p in self.revisions.values():
-            if start <= p.title <= end:
-                res.add(p.title)
-        res = list(res)
-        res.sort()
-        return res
+        return list(self.iter_titles(start, end))
 
     def extractHTML(self, parsed_html):
         html = {}
@@ -266,11 +597,109 @@ class nuwiki(object):
 NuWiki = nuwiki
 Page = page
 
-def extract_member(zipfile, member, dstdir):
+
+class zipmember(object):
+    """revisions-N.txt file read from a zip archive"""
+
+    def __init__(self, zf, name):
+        self.zf = zf
+        self.name = name
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.zf.read(self.name)
+        return self._data
+
+    def read(self, offset, length):
+        return self.data[offset:offset + length]
+
+
+class zipnuwiki(nuwiki):
+    """nuwiki reading its members on demand from a zipfile.ZipFile
+
+    Only members that need a real filesystem path, i.e. the sqlite
+    databases and the images handed to the writers, are extracted into
+    a temporary cache directory, which is used as path of the nuwiki.
+    """
+
+    def __init__(self, zf, prefix="", cachedir=None):
+        self.zf = zf
+        self.prefix = prefix
+        self._extracted = set()
+        self.members = {}
+        for zi in zf.infolist():
+            fn = zi.filename
+            if isinstance(fn, str):
+                fn = unicode(fn, "utf-8")
+            if fn.startswith(prefix) and not fn.endswith("/"):
+                self.members[fn[len(prefix):]] = zi
+        if cachedir is None:
+            cachedir = tempfile.mkdtemp()
+        nuwiki.__init__(self, cachedir)
+
+    def __getstate__(self):
+        raise RuntimeError("pickling zip based nuwikis not supported. Use unzipped zip file instead")
+
+    def _snapshot_path(self):
+        if not self.zf.filename:
+            return None
+        path = self.zf.filename
+        if self.prefix:
+            path += "-" + self.prefix.strip("/")
+        return path + ".snapshot"
+
+    def _snapshot_checksum(self):
+        h = md5()
+        for fn in sorted(self.members):
+            if "/" not in fn:
+                zi = self.members[fn]
+                h.update(repr((fn, zi.CRC, zi.file_size)))
+        return h.hexdigest()
+
+    def _member(self, p):
+        p = os.path.relpath(p, self.path).replace(os.path.sep, "/")
+        if isinstance(p, str):
+            p = unicode(p, "utf-8")
+        return self.members.get(p)
+
+    def _exists(self, p):
+        return self._member(p) is not None or os.path.exists(p)
+
+    def _read(self, p):
+        zi = self._member(p)
+        if zi is None:
+            return nuwiki._read(self, p)
+        return self.zf.read(zi)
+
+    def _localpath(self, p):
+        if p not in self._extracted:
+            if not os.path.exists(p):
+                extract_member(self.zf, self._member(p), self.path + os.path.sep, prefix=self.prefix)
+            self._extracted.add(p)
+        return p
+
+    def _list_images(self):
+        res = []
+        for fn in self.members:
+            if fn.startswith("images/") and "/" not in fn[len("images/"):]:
+                res.append(fn[len("images/"):])
+        return res
+
+    def _get_revfile(self, fn):
+        try:
+            return self._revfiles[fn]
+        except KeyError:
+            rf = self._revfiles[fn] = zipmember(self.zf, self._member(self._pathjoin(fn)))
+            return rf
+
+def extract_member(zipfile, member, dstdir, prefix=""):
     """Copied and adjusted from Python 2.6 stdlib zipfile.py module.
 
        Extract the ZipInfo object 'member' to a physical
-       file on the path targetpath.
+       file on the path targetpath. prefix is stripped from
+       the member's filename.
     """
 
     assert dstdir.endswith(os.path.sep), "/ missing at end"
@@ -278,6 +707,7 @@ def extract_member(zipfile, member, dstdir):
     fn = member.filename
     if isinstance(fn, str):
         fn = unicode(fn, 'utf-8')
+    fn = fn[len(prefix):]
     targetpath = os.path.normpath(os.path.join(dstdir, fn))
     
     if not targetpath.startswith(dstdir):
@@ -307,12 +737,9 @@ class adapt(object):
     interwikimap = None
     was_tmpdir = False
     
-    def __init__(self, path_or_instance):
+    def __init__(self, path_or_instance, prefix=""):
         if isinstance(path_or_instance, zipfile.ZipFile):
-            zf = path_or_instance
-            tmpdir = tempfile.mkdtemp()
-            extractall(zf, tmpdir)
-            path_or_instance = tmpdir
+            path_or_instance = zipnuwiki(path_or_instance, prefix=prefix)
             self.was_tmpdir = True
             
         if isinstance(path_or_instance, basestring):
@@ -379,6 +806,29 @@ class adapt(object):
 
             return authors
     
+    def prefetch(self, titles=(), images=()):
+        """read the authors and imageinfo for the given article titles
+        and image names ahead with a single query per database. they
+        are kept until they are read.
+        """
+        authors = getattr(self.nuwiki, 'authors', None)
+        imageinfo = getattr(self.nuwiki, 'imageinfo', None)
+
+        keys = set()
+        for title in titles:
+            fqname = self.nshandler.get_fqname(title)
+            keys.add(fqname)
+            keys.add(self.redirects.get(fqname, fqname))
+
+        imagenames = set(self.nshandler.get_fqname(name, nshandling.NS_FILE) for name in images)
+        keys.update(imagenames)
+
+        if keys and isinstance(authors, DumbJsonDB):
+            authors.prefetch(keys)
+
+        if imagenames and isinstance(imageinfo, DumbJsonDB):
+            imageinfo.prefetch(imagenames)
+
     def getSource(self, title, revision=None):
         from mwlib.metabook import make_source
 
@@ -25,7 +25,7 @@ class PODClient(object):
             headers = {}
         return urllib2.urlopen(urllib2.Request(self.posturl, data, headers=headers)).read()
     
-    def post_status(self, status=None, progress=None, article=None, error=None):
+    def post_status(self, status=None, progress=None, article=None, error=None, **kw):
         post_data = {}
 
         def setv(name, val):
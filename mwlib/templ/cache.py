@@ -0,0 +1,135 @@
+# Copyright (c) 2007-2011 PediaPress GmbH
+# See README.rst for additional licensing information.
+
+"""parsed templates shared by all expanders of a wikidb.
+
+templates are keyed by their normalized name and revision or, for
+pages without revision, the digest of their text. tags replaced while
+parsing a template are stored along with the parse tree and added to
+the uniquifier of the expander using it.
+"""
+
+import threading, weakref
+from collections import deque
+from hashlib import sha1 as digest
+
+from mwlib import conf
+
+
+class templatecache(object):
+    """lru cache of parsed templates. the sum of the lengths of the
+    cached templates' texts is at most maxsize. like mwlib.lrucache
+    it keeps the access order in a queue of keys, which may contain a
+    key multiple times."""
+
+    def __init__(self, maxsize=None):
+        if maxsize is None:
+            maxsize = conf.get("expander", "template_cache_size", 16, int) * 1024 * 1024
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = {}  # key -> (parsed, uniq2repl, size)
+        self.queue = deque()  # order that keys have been accessed
+        self.refcount = {}  # number of times each key is in the queue
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_key(fqname, page):
+        revid = getattr(page, "revid", None)
+        if revid:
+            return fqname, revid
+        return fqname, digest(page.rawtext.encode("utf-8")).digest()
+
+    def get(self, key):
+        """return (parsed, uniq2repl) or None"""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._record_key(key)
+            self.hits += 1
+            return entry[:2]
+        finally:
+            self.lock.release()
+
+    def put(self, key, parsed, uniq2repl, size):
+        if size > self.maxsize:
+            return
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (parsed, uniq2repl, size)
+            self.size += size
+            self._record_key(key)
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def _record_key(self, key):
+        self.queue.append(key)
+        self.refcount[key] = self.refcount.get(key, 0) + 1
+
+        # compact the queue by removing duplicate keys
+        if len(self.queue) > 4 * len(self.entries) + 16:
+            queue, refcount = self.queue, self.refcount
+            for i in [None] * len(queue):
+                k = queue.popleft()
+                if refcount[k] == 1:
+                    queue.append(k)
+                else:
+                    refcount[k] -= 1
+
+    def _evict(self):
+        queue, refcount = self.queue, self.refcount
+        while self.size > self.maxsize:
+            k = queue.popleft()
+            refcount[k] -= 1
+            if not refcount[k]:
+                del refcount[k]
+                self.size -= self.entries.pop(k)[2]
+                self.evictions += 1
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.queue.clear()
+            self.refcount.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(self.entries), size=self.size, maxsize=self.maxsize,
+                    hitrate=float(self.hits) / total if total else 0.0)
+
+    def __repr__(self):
+        return "<templatecache %(entries)d templates, %(size)d/%(maxsize)d bytes, hits=%(hits)d misses=%(misses)d>" % self.stats()
+
+
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def get_template_cache(wikidb):
+    """return the templatecache of wikidb, which lives as long as
+    wikidb, or None if wikidb can't be weakly referenced"""
+    _caches_lock.acquire()
+    try:
+        try:
+            cache = _caches.get(wikidb)
+            if cache is None:
+                cache = _caches[wikidb] = templatecache()
+        except TypeError:
+            return None
+        return cache
+    finally:
+        _caches_lock.release()
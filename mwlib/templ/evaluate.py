@@ -4,6 +4,7 @@
 
 from mwlib.templ import magics, log, DEBUG, parser, mwlocals
 from mwlib.uniq import Uniquifier
+from mwlib.templ.cache import get_template_cache
 from mwlib import nshandling, siteinfo, metabook
 
 
@@ -249,6 +250,7 @@ class Expander(object):
         self.parsed = parser.parse(txt, included=False, replace_tags=self.replace_tags, siteinfo=self.siteinfo)
         #show(self.parsed)
         self.parsedTemplateCache = {}
+        self.template_cache = get_template_cache(wikidb)
 
     def resolve_magic_alias(self, name):
         return self.aliasmap.resolve_magic_alias(name)
@@ -279,12 +281,34 @@ class Expander(object):
 
         if raw is None:
             res = None
-        else:
+        elif self.template_cache is None:
             res = self._parse_raw_template(name=name, raw=raw)
+        else:
+            res = self._get_shared_template(name, ns, page)
 
         self.parsedTemplateCache[name] = res
         return res
 
+    def _get_shared_template(self, name, ns, page):
+        key = self.template_cache.get_key(self.nshandler.get_fqname(name, ns), page)
+        cached = self.template_cache.get(key)
+        if cached is not None:
+            res, uniq2repl = cached
+            self.uniquifier.uniq2repl.update(uniq2repl)
+            return res
+
+        # collect the tags replaced while parsing in a separate uniquifier
+        uniquifier = self.uniquifier
+        self.uniquifier = Uniquifier()
+        try:
+            res = self._parse_raw_template(name=name, raw=page.rawtext)
+            uniq2repl = self.uniquifier.uniq2repl
+        finally:
+            self.uniquifier = uniquifier
+        uniquifier.uniq2repl.update(uniq2repl)
+        self.template_cache.put(key, res, uniq2repl, len(page.rawtext))
+        return res
+
     def _parse_raw_template(self, name, raw):
         return parser.parse(raw, replace_tags=self.replace_tags)
 
@@ -7,7 +7,6 @@ from mwlib.templ.nodes import Node, Variable, Template, IfNode, SwitchNode
 from mwlib.templ.scanner import symbols, tokenize
 from mwlib.templ.marks import eqmark
 
-from hashlib import sha1 as digest
 
 class aliasmap(object):
     def __init__(self, siteinfo):
@@ -76,12 +75,7 @@ def optimize(node):
         
     return node
 
-from mwlib import lrucache
-
 class Parser(object):
-    use_cache = False
-    _cache = lrucache.mt_lrucache(2000)
-    
     def __init__(self, txt, included=True, replace_tags=None, siteinfo=None):
         if isinstance(txt, str):
             txt = unicode(txt)
@@ -316,14 +310,6 @@ class Parser(object):
         return n
         
     def parse(self):
-        if self.use_cache:
-            fp = digest(self.txt.encode('utf-8')).digest()     
-            try:
-                return self._cache[fp]
-            except KeyError:
-                pass
-        
-        
         self.tokens = tokenize(self.txt, included=self.included, replace_tags=self.replace_tags)
         self.pos = 0
         n = []
@@ -341,10 +327,6 @@ class Parser(object):
                 self.pos += 1
 
         n=optimize(n)
-        
-        if self.use_cache:
-            self._cache[fp] = n
-        
         return n
 
 def parse(txt, included=True, replace_tags=None, siteinfo=None):
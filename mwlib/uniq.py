@@ -4,10 +4,15 @@
 
 import os
 import re
+import itertools
 
 class Uniquifier(object):
     random_string = None
     rx = None
+    # numbers are unique within the process, so that parsed templates
+    # can be shared between expanders (see templ.cache)
+    _counter = itertools.count()
+
     def __init__(self):
         self.uniq2repl = {}
         if self.random_string is None:
@@ -17,7 +22,7 @@ class Uniquifier(object):
        
     def get_uniq(self, repl, name):
         r = self.random_string
-        count = len(self.uniq2repl)
+        count = self._counter.next()
         retval = "\x7fUNIQ-%s-%s-%s-QINU\x7f" % (name, count, r)
         self.uniq2repl[retval] = repl
         return retval
@@ -61,10 +61,14 @@ class MultiEnvironment(Environment):
     wiki = None
     images = None
     
-    def __init__(self, path):
+    def __init__(self, path, zf=None):
         Environment.__init__(self)
         self.path = path
-        self.metabook = myjson.load(open(os.path.join(self.path, "metabook.json")))
+        self.zf = zf
+        if zf is not None:
+            self.metabook = myjson.loads(zf.read("metabook.json"))
+        else:
+            self.metabook = myjson.load(open(os.path.join(self.path, "metabook.json")))
         self.id2env = {}
         
     def init_metabook(self):
@@ -80,7 +84,10 @@ class MultiEnvironment(Environment):
             
             if id not in self.id2env:
                 env = Environment()
-                env.images = env.wiki = nuwiki.adapt(os.path.join(self.path, id))
+                if self.zf is not None:
+                    env.images = env.wiki = nuwiki.adapt(self.zf, prefix=id + "/")
+                else:
+                    env.images = env.wiki = nuwiki.adapt(os.path.join(self.path, id))
                 self.id2env[id] = env
             else:
                 env = self.id2env[id]
@@ -170,12 +177,7 @@ def _makewiki(conf, metabook=None, **kw):
                 res.metabook = res.wiki.metabook
             return res
         elif format==u'multi-nuwiki':
-            from mwlib import nuwiki
-            import tempfile
-            tmpdir = tempfile.mkdtemp()
-            nuwiki.extractall(zf, tmpdir)
-            res = MultiEnvironment(tmpdir)
-            return res
+            return MultiEnvironment(conf, zf=zf)
         else:
             raise RuntimeError("unknown format %r" % (format,))
         
@@ -15,6 +15,18 @@ log = log.Log('mwlib.writerbase')
 class WriterError(RuntimeError):
     pass
 
+def _get_wiki(env, item):
+    if item._env:
+        return item._env.wiki
+    return env.wiki
+
+
+def _prefetch(wiki2names, kw):
+    for wiki, names in wiki2names.items():
+        if hasattr(wiki, "prefetch"):
+            wiki.prefetch(**{kw: names})
+
+
 def build_book(env, status_callback=None):
     book = parser.Book()
     progress = 0
@@ -24,6 +36,12 @@ def build_book(env, status_callback=None):
     num_articles = float(len(env.metabook.articles()))
     if num_articles > 0:
         progress_step = 100/num_articles
+
+    wiki2titles = {}
+    for item in env.metabook.articles():
+        wiki2titles.setdefault(_get_wiki(env, item), []).append(item.title)
+    _prefetch(wiki2titles, "titles")
+    wiki2images = {}
         
     lastChapter = None
     for item in env.metabook.walk():
@@ -35,14 +53,13 @@ def build_book(env, status_callback=None):
             status_callback(status='parsing', progress=progress, article=item.title)
             progress += progress_step
 
-            if item._env:
-                wiki = item._env.wiki
-            else:
-                wiki = env.wiki
+            wiki = _get_wiki(env, item)
             
             a = wiki.getParsedArticle(title=item.title, revision=item.revision)
             
             if a is not None:
+                images = wiki2images.setdefault(wiki, set())
+                images.update(x.target for x in a.find(parser.ImageLink) if x.target)
                 if item.displaytitle is not None:
                     a.caption = item.displaytitle
                 url = wiki.getURL(item.title, item.revision)                
@@ -64,5 +81,6 @@ def build_book(env, status_callback=None):
             else:
                 log.warn('No such article: %r' % item.title)
 
+    _prefetch(wiki2images, "images")
     status_callback(status='parsing', progress=progress, article='')
     return book
@@ -59,6 +59,9 @@ def main():
         "postman = mwlib.main_trampoline:postman_main",
         "nserve = mwlib.main_trampoline:nserve_main",
         "mw-zip = mwlib.apps.buildzip:main",
+        "mw-fetch-bench = mwlib.apps.fetchbench:main",
+        "mw-index-dump = mwlib.apps.indexdump:main",
+        "mw-bulkparse = mwlib.apps.bulkparse:main",
         "mw-version = mwlib._version:main",
         "mw-render = mwlib.apps.render:main",
         "mw-qserve = qs.qserve:main",
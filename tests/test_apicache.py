@@ -0,0 +1,48 @@
+#! /usr/bin/env py.test
+
+import time
+from mwlib.net.apicache import apicache
+
+url = "http://fake.wiki/w/api.php"
+
+
+def test_ttl(tmpdir):
+    c = apicache(tmpdir.join("cache.db").strpath, ttl=10, siteinfo_ttl=20)
+    assert c.get_ttl(dict(action="query", revids="1|2", prop="revisions")) is None
+    assert c.get_ttl(dict(action="query", titles="Foo", prop="revisions", rvstartid=5)) is None
+    # the latest revision, templates and categories change
+    assert c.get_ttl(dict(action="query", revids="1|2", prop="revisions|info")) == 10
+    assert c.get_ttl(dict(action="query", revids="1|2", prop="templates|images|info")) == 10
+    assert c.get_ttl(dict(action="query", revids="1", prop="revisions|categories")) == 10
+    assert c.get_ttl(dict(action="parse", oldid=3)) == 10
+    assert c.get_ttl(dict(action="query", titles="Foo", prop="revisions")) == 10
+    assert c.get_ttl(dict(action="query", meta="siteinfo", siprop="general|namespaces")) == 20
+
+
+def test_get_set(tmpdir):
+    path = tmpdir.join("cache.db").strpath
+    c = apicache(path, ttl=10)
+    params = dict(action="query", titles=u"M\xe4in")
+    assert c.get(url, params) is None
+    c.set(url, params, '{"query": {}}')
+    assert c.get(url, params) == '{"query": {}}'
+    assert c.get(url, dict(action="query", titles=u"Other")) is None
+    assert c.get("http://other.wiki/w/api.php", params) is None
+    assert (c.hits, c.misses) == (1, 3)
+
+    # visible to other users of the same file
+    assert apicache(path).get(url, params) == '{"query": {}}'
+
+
+def test_expiry(tmpdir, monkeypatch):
+    c = apicache(tmpdir.join("cache.db").strpath, ttl=10)
+    c.set(url, dict(action="query", titles="Foo"), "title")
+    c.set(url, dict(action="query", revids="1", prop="revisions"), "revid")
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    assert c.get(url, dict(action="query", titles="Foo")) is None
+    assert c.get(url, dict(action="query", revids="1", prop="revisions")) == "revid"
+
+    c = apicache(tmpdir.join("cache.db").strpath, ttl=10)
+    assert c.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 1
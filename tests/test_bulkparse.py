@@ -0,0 +1,114 @@
+#! /usr/bin/env py.test
+# -*- coding: utf-8 -*-
+
+from xml.sax.saxutils import escape
+
+from mwlib import dumpindex, myjson as json
+from mwlib.apps import bulkparse
+
+header = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.4/">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <base>http://en.wikipedia.org/wiki/Main_Page</base>
+    <namespaces>
+      <namespace key="0" case="first-letter" />
+      <namespace key="10" case="first-letter">Template</namespace>
+    </namespaces>
+  </siteinfo>
+"""
+
+pages = [
+    (u"Template:Greet", u"Hello {{{1}}}"),
+    (u"Main", u"{{greet|W\xf6rld}} and '''more'''"),
+    (u"Old", u"#REDIRECT [[Main]]"),
+    (u"Other", u"* one\n* two\n"),
+    (u"Third", u"[[Main|link]]"),
+]
+
+
+def write_dump(tmpdir):
+    xml = []
+    for i, (title, txt) in enumerate(pages):
+        xml.append((u"""  <page>
+    <title>%s</title>
+    <revision><id>%d</id><text xml:space="preserve">%s</text></revision>
+  </page>
+""" % (escape(title), 100 + i, escape(txt))).encode("utf-8"))
+    p = tmpdir.join("dump.xml")
+    p.write(header + "".join(xml) + "</mediawiki>\n", "wb")
+    return p.strpath
+
+
+def read_results(path):
+    return [json.loads(x) for x in open(path, "rb")]
+
+
+def test_stats(tmpdir):
+    dump = write_dump(tmpdir)
+    output = tmpdir.join("out.jsonl").strpath
+    res = bulkparse.bulkparse("dump", dump, output, processes=2)
+    assert res["parsed"] == 3
+    assert res["errors"] == 0
+    results = read_results(output)
+    assert [x["title"] for x in results] == [u"Main", u"Other", u"Third"]
+    assert [x["revid"] for x in results] == [101, 103, 104]
+    assert all(x["nodes"] > 1 for x in results)
+    assert json.load(open(output + ".checkpoint")) == dict(done=5, size=tmpdir.join("out.jsonl").size())
+
+
+def test_trees(tmpdir):
+    dump = write_dump(tmpdir)
+    output = tmpdir.join("out.jsonl").strpath
+
+    # not indexed: templates are not expanded
+    bulkparse.bulkparse("dump", dump, output, processes=1, results="trees")
+    tree = read_results(output)[0]["tree"]
+    assert "Hello" not in tree
+
+    dumpindex.index_dump(dump, processes=1)
+    bulkparse.bulkparse("dump", dump, output, processes=1, results="trees")
+    tree = read_results(output)[0]["tree"]
+    assert "Hello W" in tree
+
+
+def test_errors(tmpdir):
+    dump = write_dump(tmpdir)
+    output = tmpdir.join("out.jsonl").strpath
+    res = bulkparse.bulkparse("dump", dump, output, processes=2, results="errors")
+    assert res["parsed"] == 3
+    assert read_results(output) == []
+
+
+def test_resume(tmpdir):
+    dump = write_dump(tmpdir)
+    output = tmpdir.join("out.jsonl").strpath
+    bulkparse.bulkparse("dump", dump, output, processes=2, results="trees")
+    expected = open(output, "rb").read()
+
+    # interrupted after the first two items with a partially written result
+    first = expected.splitlines(True)[0]
+    open(output, "wb").write(first + '{"title": "Oth')
+    json.dump(dict(done=2, size=len(first)), open(output + ".checkpoint", "wb"))
+
+    res = bulkparse.bulkparse("dump", dump, output, processes=2, results="trees", resume=True)
+    assert res["parsed"] == 2
+    assert open(output, "rb").read() == expected
+
+
+def test_nuwiki(tmpdir, monkeypatch):
+    import os, shutil, tempfile
+    zipfile = tmpdir.join("nuwiki.zip").strpath
+    shutil.copy(os.path.join(os.path.dirname(__file__), "speisesalz-nuwiki.zip"), zipfile)
+    output = tmpdir.join("out.jsonl").strpath
+    temp = tmpdir.mkdir("temp")
+    monkeypatch.setattr(tempfile, "tempdir", temp.strpath)
+    monkeypatch.setenv("MWLIB_NUWIKI_SNAPSHOT", "yes")
+
+    res = bulkparse.bulkparse("nuwiki", zipfile, output, processes=2, maxtasksperchild=1)
+    assert res["parsed"] >= 1
+    assert res["errors"] == 0
+    assert u"Speisesalz" in [x["title"] for x in read_results(output)]
+
+    # the zip file is extracted once and removed afterwards, no snapshots are written
+    assert temp.listdir() == []
+    assert sorted(x.basename for x in tmpdir.listdir()) == ["nuwiki.zip", "out.jsonl", "out.jsonl.checkpoint", "temp"]
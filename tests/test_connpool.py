@@ -0,0 +1,69 @@
+#! /usr/bin/env py.test
+
+import threading, urllib2, BaseHTTPServer, SocketServer
+
+from mwlib.net import connpool, sapi
+
+
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        body = '{"query": {"path": "%s"}}' % self.path.split("?")[0]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def pytest_funcarg__httpd(request):
+    s = server(("127.0.0.1", 0), handler)
+    t = threading.Thread(target=s.serve_forever)
+    t.daemon = True
+    t.start()
+    request.addfinalizer(s.shutdown)
+    return s
+
+
+def test_mwapi_reuses_connection(httpd):
+    pool = connpool.connpool(2)
+    api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % httpd.server_address[1])
+    api.opener = urllib2.build_opener(connpool.keepalive_handler(pool))
+    for i in range(5):
+        assert api.do_request(action="query", titles="x") == {"path": "/w/api.php"}
+
+    assert (pool.created, pool.reused) == (1, 4)
+    assert httpd.connections == 1
+
+
+def test_stale_connection(httpd):
+    pool = connpool.connpool(2)
+    opener = urllib2.build_opener(connpool.keepalive_handler(pool))
+    url = "http://127.0.0.1:%s/" % httpd.server_address[1]
+    assert opener.open(url).read()
+
+    # the server went away while the connection was idle
+    for conn in pool.key2idle.values()[0]:
+        conn.sock.close()
+    assert opener.open(url).read()
+    assert (pool.created, pool.reused) == (2, 1)
+
+
+def test_unread_response_is_not_pooled(httpd):
+    pool = connpool.connpool(2)
+    opener = urllib2.build_opener(connpool.keepalive_handler(pool))
+    opener.open("http://127.0.0.1:%s/" % httpd.server_address[1]).close()
+    assert pool.key2idle.get(("http", "127.0.0.1:%s" % httpd.server_address[1]), []) == []
@@ -0,0 +1,79 @@
+#! /usr/bin/env py.test
+# -*- coding: utf-8 -*-
+
+from hashlib import md5
+from xml.sax.saxutils import escape
+
+from mwlib.net import fetch
+from mwlib.net.dumpfetch import dumpfetcher, find_image_file
+from mwlib.dumpparser import DumpParser
+from mwlib.nuwiki import adapt
+
+
+def make_dump(path, pages):
+    res = [u"""<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.4/">
+<siteinfo>
+<sitename>Wikipedia</sitename>
+<base>http://en.wikipedia.org/wiki/Main_Page</base>
+<case>first-letter</case>
+<namespaces>
+<namespace key="0" case="first-letter" />
+<namespace key="6" case="first-letter">File</namespace>
+<namespace key="10" case="first-letter">Template</namespace>
+</namespaces>
+</siteinfo>"""]
+    for i, (title, txt) in enumerate(pages):
+        res.append(u"""<page><title>%s</title><id>%d</id>
+<revision><id>%d</id><timestamp>2011-01-01T00:00:00Z</timestamp><text xml:space="preserve">%s</text></revision>
+</page>""" % (escape(title), i + 1, 100 + i, escape(txt)))
+    res.append(u"</mediawiki>")
+    path.write(u"\n".join(res).encode("utf-8"), "wb")
+    return path.strpath
+
+
+# ordered so that some templates are only found in a second pass
+pages = [
+    (u"Template:Inner", u"inner"),
+    (u"Template:Computed name", u"computed"),
+    (u"Physik", u"#REDIRECT [[Physics]]"),
+    (u"Template:Outer", u"{{Inner}} {{Computed {{Suffix}}}}"),
+    (u"Physics", u"{{outer}} [[File:Atom.png|thumb|an atom]]"),
+    (u"File:Atom.png", u"{{Inner}} description"),
+    (u"Template:Suffix", u"name"),
+    (u"Unrelated", u"{{Inner}}"),
+]
+
+
+def test_read_siteinfo(tmpdir):
+    si = DumpParser(make_dump(tmpdir.join("dump.xml"), pages)).read_siteinfo()
+    assert si["general"]["sitename"] == u"Wikipedia"
+    assert si["namespaces"]["10"]["*"] == u"Template"
+
+
+def test_find_image_file(tmpdir):
+    h = md5("Some_image.png").hexdigest()
+    tmpdir.join(h[0], h[:2], "Some_image.png").write("png", ensure=True)
+    assert find_image_file(tmpdir.strpath, u"Some image.png").endswith("Some_image.png")
+    assert find_image_file(tmpdir.strpath, u"Other.png") is None
+
+
+def test_dumpfetcher(tmpdir):
+    dump = make_dump(tmpdir.join("dump.xml"), pages)
+    h = md5("Atom.png").hexdigest()
+    tmpdir.join("images", h[0], h[:2], "Atom.png").write("png", ensure=True)
+
+    fsout = fetch.fsoutput(tmpdir.join("nuwiki").strpath)
+    fsout.nfo = dict(format="nuwiki", base_url="http://en.wikipedia.org/w/")
+    f = dumpfetcher(dump, fsout, [(u"physik", None)], [], imagedir=tmpdir.join("images").strpath)
+    f.run()
+    assert f.passes == 4
+    assert u"Unrelated" not in f.sources
+
+    nw = adapt(tmpdir.join("nuwiki").strpath)
+    assert nw.redirects == {u"Physik": u"Physics"}
+    p = nw.get_page(u"Physik")
+    assert p.expanded
+    assert p.rawtext.startswith(u"inner computed [[File:Atom.png")
+    assert nw.get_page(u"Template:Inner").rawtext == u"inner"
+    assert nw.get_page(u"File:Atom.png").rawtext == u"{{Inner}} description"
+    assert nw.normalize_and_get_image_path(u"File:Atom.png") is not None
@@ -0,0 +1,107 @@
+#! /usr/bin/env py.test
+# -*- coding: utf-8 -*-
+
+import bz2
+from xml.sax.saxutils import escape
+
+import py, pytest
+
+from mwlib import dumpindex
+from mwlib.expander import Expander
+from mwlib.refine.uparser import parseString
+
+header = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.4/">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <base>http://en.wikipedia.org/wiki/Main_Page</base>
+    <namespaces>
+      <namespace key="0" case="first-letter" />
+      <namespace key="10" case="first-letter">Template</namespace>
+    </namespaces>
+  </siteinfo>
+"""
+
+footer = "</mediawiki>\n"
+
+pages = [
+    (u"Template:Greet", u"Hello {{{1}}}"),
+    (u"Template:Hi", u"#REDIRECT [[Template:Greet]]"),
+    (u"Template:Hey", u"#REDIRECT [[Template:Hi]]"),
+    (u"Main", u"{{hey|W\xf6rld}} & <b>more</b>"),
+    (u"Old", u"#REDIRECT [[Main]]"),
+    (u"Broken", u"#REDIRECT [[Nowhere]]"),
+]
+
+
+def page_xml(i, title, txt):
+    return (u"""  <page>
+    <title>%s</title>
+    <id>%d</id>
+    <revision>
+      <id>%d</id>
+      <text xml:space="preserve">%s</text>
+    </revision>
+  </page>
+""" % (escape(title), i + 1, 100 + i, escape(txt))).encode("utf-8")
+
+
+def write_plain(path):
+    path.write(header + "".join(page_xml(i, t, txt) for i, (t, txt) in enumerate(pages)) + footer, "wb")
+    return path.strpath
+
+
+def write_multistream(path):
+    streams = [header]
+    for i in range(0, len(pages), 2):
+        streams.append("".join(page_xml(j, t, txt) for j, (t, txt) in enumerate(pages) if i <= j < i + 2))
+    streams.append(footer)
+    path.write("".join(bz2.compress(s) for s in streams), "wb")
+    return path.strpath
+
+
+@pytest.fixture(params=[(write_plain, "dump.xml"), (write_multistream, "dump.xml.bz2")])
+def dumpwiki(request, tmpdir):
+    write, name = request.param
+    path = write(tmpdir.join(name))
+    assert dumpindex.index_dump(path) == len(pages)
+    db = dumpindex.dumpwiki(path)
+    request.addfinalizer(db.close)
+    return db
+
+
+def test_get_page(dumpwiki):
+    p = dumpwiki.get_page(u"Main")
+    assert p.rawtext == u"{{hey|W\xf6rld}} & <b>more</b>"
+    assert p.revid == 103
+    assert dumpwiki.get_page(u"Missing") is None
+    assert dumpwiki.get_siteinfo()["general"]["sitename"] == u"Wikipedia"
+
+
+def test_redirects(dumpwiki):
+    assert dumpwiki.get_redirect(u"Template:Hey") == u"Template:Greet"
+    assert dumpwiki.get_page(u"Old").title == u"Main"
+    assert dumpwiki.normalize_and_get_page(u"hey", 10).rawtext == u"Hello {{{1}}}"
+    # redirect to a missing page
+    assert dumpwiki.get_page(u"Broken").rawtext == u"#REDIRECT [[Nowhere]]"
+
+
+def test_expand(dumpwiki):
+    raw = dumpwiki.normalize_and_get_page(u"main", 0).rawtext
+    assert Expander(raw, pagename=u"Main", wikidb=dumpwiki).expandTemplates() == u"Hello W\xf6rld & <b>more</b>"
+    assert parseString(title=u"Main", wikidb=dumpwiki) is not None
+
+
+def test_stale_index(tmpdir):
+    path = write_plain(tmpdir.join("dump.xml"))
+    dumpindex.index_dump(path)
+    tmpdir.join("dump.xml").write("changed", "ab")
+    py.test.raises(RuntimeError, dumpindex.dumpwiki, path)
+
+
+def test_not_multistream(tmpdir):
+    p = tmpdir.join("dump.xml.bz2")
+    p.write(bz2.compress(header + page_xml(0, u"A", u"a") + footer), "wb")
+    dumpindex.index_dump(p.strpath)  # one stream with everything is fine
+
+    p.write(bz2.compress(header + page_xml(0, u"A", u"a")[:20]) + bz2.compress(page_xml(0, u"A", u"a")[20:] + footer), "wb")
+    py.test.raises(ValueError, dumpindex.index_dump, p.strpath)
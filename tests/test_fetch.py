@@ -0,0 +1,526 @@
+#! /usr/bin/env py.test
+# -*- coding: utf-8 -*-
+
+import gevent, py
+
+from mwlib.net import fetch, throttle
+from mwlib.siteinfo import get_siteinfo
+from mwlib.nuwiki import adapt
+
+
+class fakeauthors(object):
+    def __init__(self, authors):
+        self.authors = authors
+
+    def get_authors(self):
+        return self.authors
+
+
+class fakeapi(object):
+    """in-memory stand-in for mwlib.net.sapi.mwapi, which records all requests"""
+
+    apiurl = "http://fake.wiki/w/api.php"
+    baseurl = "http://fake.wiki/w/"
+    api_request_limit = 15
+    qccount = 0
+    bytes_received = bytes_decoded = 0
+    retry_count = 0
+    limit_fetch_semaphore = None
+    cache = None
+    report = None
+
+    def __init__(self, pages, images=None, deps=None):
+        self.pages = pages  # title -> (revid, text)
+        self.images = images or {}  # title -> sha1
+        self.deps = deps or {}  # template title -> (revid, titles of the pages using it)
+        self.log = []
+
+    def idle(self):
+        return True
+
+    def get_siteinfo(self):
+        return get_siteinfo("en")
+
+    def _find(self, revid):
+        for title, (r, txt) in self.pages.items():
+            if r == revid:
+                return title, txt
+        raise KeyError(revid)
+
+    def fetch_used(self, titles=None, revids=None, fetch_images=True, expanded=False):
+        self.log.append(("used", tuple(titles or revids)))
+        images = [dict(title=t) for t in sorted(self.images)]
+        pages = {}
+        for i, t in enumerate(titles or [self._find(int(r))[0] for r in revids]):
+            templates = [dict(title=x) for x, (r, users) in sorted(self.deps.items()) if t in users]
+            pages[str(i)] = dict(title=t, images=images, templates=templates)
+        return dict(pages=pages)
+
+    def fetch_latest_revids(self, titles):
+        self.log.append(("latest", tuple(titles)))
+        res = dict((t, self.pages[t][0]) for t in titles if t in self.pages)
+        res.update((t, self.deps[t][0]) for t in titles if t in self.deps)
+        return res
+
+    def do_request(self, use_post=False, action=None, **kw):
+        self.log.append((action, kw.get("page") or kw.get("oldid") or kw.get("title") or kw.get("revids")))
+        if action == "parse":
+            if "page" in kw:
+                revid = self.pages[kw["page"]][0]
+            else:
+                revid = kw["oldid"]
+            return dict(revid=revid, text={"*": u"<p>html %s</p>" % revid})
+        if action == "expandtemplates":
+            if use_post:  # text of a revision, not unwrapped by _post
+                return dict(expandtemplates={"*": kw["text"]})
+            return {"*": self.pages[kw["title"]][1]}
+        if action == "query":
+            title, txt = self._find(int(kw["revids"]))
+            return dict(pages={"1": dict(title=title, ns=0, revisions=[{"*": txt}])})
+        raise ValueError(action)
+
+    def get_edits(self, title, revision, rvlimit=None):
+        self.log.append(("edits", title))
+        return fakeauthors([u"Alice"])
+
+    def fetch_imageinfo(self, titles, iiurlwidth=800):
+        self.log.append(("imageinfo", tuple(titles)))
+        pages = {}
+        for i, t in enumerate(titles):
+            pages[str(i)] = dict(title=t, imageinfo=[dict(
+                sha1=self.images[t],
+                thumburl="http://fake.wiki/thumb/%s" % self.images[t],
+                descriptionurl="http://fake.wiki/wiki/%s" % t)])
+        return dict(pages=pages)
+
+    def fetch_pages(self, titles=None, revids=None):
+        self.log.append(("pages", tuple(titles)))
+        return dict(pages=dict((str(i), dict(title=t, ns=6, revisions=[{"*": u"description"}]))
+                               for i, t in enumerate(titles)))
+
+
+class myfetcher(fetch.fetcher):
+    def _get_mwapi_for_path(self, path):
+        return self.api
+
+
+def fetch_nuwiki(path, api, pages, previous=None, monkeypatch=None):
+    downloads = []
+
+    def download_to_file(url, path, temp_path, **kw):
+        downloads.append(url)
+        open(path, "wb").write(url)
+
+    monkeypatch.setattr(fetch, "download_to_file", download_to_file)
+
+    fsout = fetch.fsoutput(path)
+    f = myfetcher(api, fsout, pages, licenses=[], previous=previous)
+    f.run()
+    return downloads
+
+
+def test_incremental(tmpdir, monkeypatch):
+    old = fakeapi({u"Same": (1, u"same text"), u"Changed": (2, u"old text"), u"Pinned": (3, u"pinned text")},
+                  images={u"File:Pic.png": "abc", u"File:New.png": "def"})
+    pages = [(u"Same", None), (u"Changed", None), (u"Pinned", 3)]
+    downloads = fetch_nuwiki(tmpdir.join("old").strpath, old, pages, monkeypatch=monkeypatch)
+    assert len(downloads) == 2
+
+    new = fakeapi({u"Same": (1, u"same text"), u"Changed": (4, u"new text"), u"Pinned": (3, u"pinned text")},
+                  images={u"File:Pic.png": "abc", u"File:New.png": "xyz"})
+    previous = adapt(tmpdir.join("old").strpath)
+    downloads = fetch_nuwiki(tmpdir.join("new").strpath, new, pages, previous=previous, monkeypatch=monkeypatch)
+    assert downloads == ["http://fake.wiki/thumb/xyz"]
+
+    assert ("expandtemplates", u"Changed") in new.log
+    assert ("parse", u"Changed") in new.log
+    for title in (u"Same", u"Pinned"):
+        assert ("expandtemplates", title) not in new.log
+        assert ("edits", title) not in new.log
+    assert ("pages", (u"File:Pic.png",)) not in new.log
+
+    nw = adapt(tmpdir.join("new").strpath)
+    assert nw.get_page(u"Same").rawtext == u"same text"
+    assert nw.get_page(u"Changed").rawtext == u"new text"
+    assert nw.get_page(u"Pinned", 3).rawtext == u"pinned text"
+    assert nw.get_page(u"File:Pic.png").rawtext == u"description"
+    assert nw.html[u"Same"]["revid"] == 1
+    assert nw.html[3]["revid"] == 3
+    assert nw.getAuthors(u"Same") == [u"Alice"]
+    assert nw.getAuthors(u"File:Pic.png") == [u"Alice"]
+    assert open(nw.getDiskPath(u"File:Pic.png")).read() == "http://fake.wiki/thumb/abc"
+
+
+def test_incremental_changed_template(tmpdir, monkeypatch):
+    pages = [(u"Same", None), (u"Other", None), (u"Pinned", 3)]
+    texts = {u"Same": (1, u"same text"), u"Other": (2, u"other text"), u"Pinned": (3, u"pinned text")}
+    old = fakeapi(texts, deps={u"Template:T": (10, [u"Same", u"Pinned"]), u"Template:U": (20, [u"Other"])})
+    fetch_nuwiki(tmpdir.join("old").strpath, old, pages, monkeypatch=monkeypatch)
+    assert adapt(tmpdir.join("old").strpath).get_data("deps")[u"Same"] == {u"Template:T": 10}
+
+    # Template:T has been edited, the articles using it are expanded again
+    new = fakeapi(texts, deps={u"Template:T": (11, [u"Same", u"Pinned"]), u"Template:U": (20, [u"Other"])})
+    previous = adapt(tmpdir.join("old").strpath)
+    fetch_nuwiki(tmpdir.join("new").strpath, new, pages, previous=previous, monkeypatch=monkeypatch)
+    assert ("expandtemplates", u"Same") in new.log
+    assert ("parse", u"Same") in new.log
+    assert ("parse", 3) in new.log
+    assert ("expandtemplates", u"Other") not in new.log
+    assert ("parse", u"Other") not in new.log
+    assert adapt(tmpdir.join("new").strpath).get_data("deps")[u"Same"][u"Template:T"] == 11
+
+
+def test_incremental_without_deps(tmpdir, monkeypatch):
+    import os
+    pages = [(u"Same", None)]
+    api = fakeapi({u"Same": (1, u"same text")})
+    fetch_nuwiki(tmpdir.join("old").strpath, api, pages, monkeypatch=monkeypatch)
+    # built before the dependencies were recorded
+    os.unlink(tmpdir.join("old", "deps.json").strpath)
+
+    previous = adapt(tmpdir.join("old").strpath)
+    fetch_nuwiki(tmpdir.join("new").strpath, api, pages, previous=previous, monkeypatch=monkeypatch)
+    assert api.log.count(("expandtemplates", u"Same")) == 2
+
+
+def test_imagestore(tmpdir, monkeypatch):
+    monkeypatch.setenv("MWLIB_FETCH_IMAGESTORE", tmpdir.join("store").strpath)
+    pages = [(u"Same", None)]
+    images = {u"File:Pic.png": "a" * 40, u"File:Other.png": "b" * 40}
+    downloads = fetch_nuwiki(tmpdir.join("first").strpath, fakeapi({u"Same": (1, u"text")}, images),
+                             pages, monkeypatch=monkeypatch)
+    assert len(downloads) == 2
+
+    downloads = fetch_nuwiki(tmpdir.join("second").strpath, fakeapi({u"Same": (1, u"text")}, images),
+                             pages, monkeypatch=monkeypatch)
+    assert downloads == []
+    nw = adapt(tmpdir.join("second").strpath)
+    assert open(nw.getDiskPath(u"File:Pic.png")).read() == "http://fake.wiki/thumb/" + "a" * 40
+
+
+class contributorsapi(fakeapi):
+    has_contributors = True
+
+    def fetch_contributors(self, titles):
+        self.log.append(("contributors", tuple(sorted(titles))))
+        if not self.has_contributors:
+            return None
+        return dict((t, [u"Bob"]) for t in titles if t != u"Gone")
+
+
+def test_batched_authors(tmpdir, monkeypatch):
+    api = contributorsapi({u"A": (1, u"a"), u"B": (2, u"b"), u"Gone": (3, u"c")},
+                          images={u"File:Pic.png": "abc"})
+    pages = [(u"A", None), (u"B", None), (u"Gone", None)]
+    fetch_nuwiki(tmpdir.join("nuwiki").strpath, api, pages, monkeypatch=monkeypatch)
+
+    requests = [x for x in api.log if x[0] == "contributors"]
+    assert sum([len(x[1]) for x in requests]) == 4
+    assert len(requests) <= 2
+    # not returned by prop=contributors: walk the revisions
+    assert [x for x in api.log if x[0] == "edits"] == [("edits", u"Gone")]
+
+    nw = adapt(tmpdir.join("nuwiki").strpath)
+    assert nw.getAuthors(u"A") == [u"Bob"]
+    assert nw.getAuthors(u"Gone") == [u"Alice"]
+    assert nw.getAuthors(u"File:Pic.png") == [u"Bob"]
+
+
+def test_batched_authors_unsupported(tmpdir, monkeypatch):
+    api = contributorsapi({u"A": (1, u"a"), u"B": (2, u"b")})
+    api.has_contributors = None
+    api.fetch_contributors = lambda titles: None
+    fetch_nuwiki(tmpdir.join("nuwiki").strpath, api, [(u"A", None), (u"B", None)], monkeypatch=monkeypatch)
+    assert sorted(x for x in api.log if x[0] == "edits") == [("edits", u"A"), ("edits", u"B")]
+    assert adapt(tmpdir.join("nuwiki").strpath).getAuthors(u"B") == [u"Alice"]
+
+
+class usedapi(contributorsapi):
+    """reports the latest revisions and a template used by the pages"""
+
+    lastrevids = {u"Cur": 5, u"Old": 7, u"Template:U": 9}
+
+    def fetch_used(self, titles=None, revids=None, fetch_images=True, expanded=False):
+        self.log.append(("used", tuple(titles or revids)))
+        pages = {}
+        for i, x in enumerate(titles or revids):
+            if titles:
+                title, revid = x, self.lastrevids.get(x, 1)
+            else:
+                title, revid = self._find(int(x))[0], int(x)
+            p = dict(title=title, lastrevid=self.lastrevids.get(title, revid),
+                     templates=[dict(title=u"Template:T")])
+            if not expanded:
+                p["revisions"] = [dict(revid=revid)]
+            pages[str(i)] = p
+        return dict(pages=pages)
+
+
+def test_batched_authors_latest_revisions(tmpdir, monkeypatch):
+    api = usedapi({u"A": (1, u"a"), u"Cur": (5, u"cur"), u"Old": (3, u"old")})
+    pages = [(u"A", None), (u"Cur", 5), (u"Old", 3)]
+    fetch_nuwiki(tmpdir.join("nuwiki").strpath, api, pages, monkeypatch=monkeypatch)
+
+    batched = set()
+    for x in api.log:
+        if x[0] == "contributors":
+            batched.update(x[1])
+    # the article asked for by title and the pinned latest revision
+    assert batched == set([u"A", u"Cur"])
+    # only the pinned old revision walks the history
+    assert [x for x in api.log if x[0] == "edits"] == [("edits", u"Old")]
+    # templates of expanded pages are recorded, but not fetched
+    assert not [x for x in api.log if x[0] == "pages"]
+
+    nw = adapt(tmpdir.join("nuwiki").strpath)
+    assert nw.getAuthors(u"Cur") == [u"Bob"]
+    assert nw.getAuthors(u"Old") == [u"Alice"]
+    assert nw.get_data("deps")[u"Cur"] == {u"Template:T": None}
+
+
+class rawapi(fakeapi):
+    """returns the raw text of articles and their templates"""
+
+    templates = {u"Template:Greet": u"Hello {{{1}}}"}
+
+    def fetch_used(self, titles=None, revids=None, fetch_images=True, expanded=False):
+        assert not expanded
+        self.log.append(("used", tuple(titles or revids)))
+        templates = [dict(title=t) for t in sorted(self.templates)]
+        pages = {}
+        for i, t in enumerate(titles or [self._find(r)[0] for r in revids]):
+            pages[str(i)] = dict(title=t, revisions=[dict(revid=self.pages[t][0])], templates=templates)
+        return dict(pages=pages)
+
+    def fetch_pages(self, titles=None, revids=None):
+        self.log.append(("pages", tuple(titles or revids)))
+        pages = {}
+        for i, t in enumerate(titles or []):
+            pages[str(i)] = dict(title=t, ns=10, revisions=[{"*": self.templates[t]}])
+        for r in revids or []:
+            title, txt = self._find(r)
+            pages[str(r)] = dict(title=title, ns=0, revisions=[{"revid": r, "*": txt}])
+        return dict(pages=pages)
+
+
+def test_expand_locally(tmpdir, monkeypatch):
+    monkeypatch.setenv("MWLIB_FETCH_EXPAND_LOCALLY", "1")
+    api = rawapi({u"A": (1, u"{{Greet|World}}"), u"B": (2, u"{{#invoke:Foo|bar}}"), u"C": (3, u"{{Greet|you}}")})
+    fetch_nuwiki(tmpdir.join("nuwiki").strpath, api, [(u"A", None), (u"B", None), (u"C", 3)],
+                 monkeypatch=monkeypatch)
+
+    assert [x for x in api.log if x[0] == "expandtemplates"] == [("expandtemplates", u"B")]
+
+    nw = adapt(tmpdir.join("nuwiki").strpath)
+    assert nw.get_page(u"A").rawtext == u"Hello World"
+    assert nw.get_page(u"A").expanded
+    assert nw.get_page(u"C", 3).rawtext == u"Hello you"
+    # expanded by the server
+    assert nw.get_page(u"B").rawtext == u"{{#invoke:Foo|bar}}"
+    assert nw.getAuthors(u"A") == [u"Alice"]
+
+
+class limitedapi(fakeapi):
+    """fakeapi, which handles one request at a time"""
+
+    def __init__(self, *args, **kw):
+        fakeapi.__init__(self, *args, **kw)
+        self.limit_fetch_semaphore = throttle.aimd(initial=1, maximum=1)
+
+    def idle(self):
+        return not self.limit_fetch_semaphore.locked()
+
+    def _limited(name):
+        def fun(self, *args, **kw):
+            with self.limit_fetch_semaphore:
+                gevent.sleep(0.001)
+                return getattr(fakeapi, name)(self, *args, **kw)
+        return fun
+
+    do_request = _limited("do_request")
+    get_edits = _limited("get_edits")
+    fetch_used = _limited("fetch_used")
+    fetch_imageinfo = _limited("fetch_imageinfo")
+    fetch_pages = _limited("fetch_pages")
+    del _limited
+
+
+def test_priorities(tmpdir, monkeypatch):
+    api = limitedapi(dict((u"A%d" % i, (i, u"text")) for i in range(1, 6)), images={u"File:Pic.png": "abc"})
+
+    def download_to_file(url, path, temp_path, **kw):
+        api.log.append(("download", url))
+        open(path, "wb").write(url)
+
+    monkeypatch.setattr(fetch, "download_to_file", download_to_file)
+    f = myfetcher(api, fetch.fsoutput(tmpdir.join("nuwiki").strpath),
+                  [(t, None) for t in sorted(api.pages)], licenses=[])
+    f.run()
+
+    kinds = [x[0] for x in api.log]
+    last_article = max([i for i, k in enumerate(kinds) if k in ("parse", "expandtemplates")])
+    assert kinds.index("imageinfo") > last_article
+    assert kinds.index("download") > kinds.index("imageinfo")
+    assert kinds.index("edits") > last_article
+    assert f.finished_classes == list(fetch.priority_classes)
+    assert f.progress.get_finished() == list(fetch.priority_classes)
+
+
+def test_get_priorities(monkeypatch):
+    assert fetch.get_priorities() == list(fetch.priority_classes)
+    monkeypatch.setenv("MWLIB_FETCH_PRIORITIES", "images, articles")
+    assert fetch.get_priorities() == ["images", "articles", "templates", "imageinfo", "authors"]
+    monkeypatch.setenv("MWLIB_FETCH_PRIORITIES", "articles,bogus")
+    py.test.raises(ValueError, fetch.get_priorities)
+
+
+def test_download_retry_releases_limiter(tmpdir, monkeypatch):
+    import socket
+    limiter = throttle.aimd(initial=2)
+    attempts = []
+
+    def download(url, temp_path):
+        attempts.append(limiter.active)
+        if len(attempts) == 1:
+            raise socket.error("connection refused")
+        open(temp_path, "wb").write("data")
+        return 4
+
+    sleeping = []
+    monkeypatch.setattr(fetch, "_download", download)
+    monkeypatch.setattr(fetch.time, "sleep", lambda delay: sleeping.append(limiter.active))
+
+    path = tmpdir.join("img").strpath
+    fetch.download_to_file("http://up.org/a.png", path, path + ".tmp", max_retries=2, limiter=limiter)
+    assert open(path).read() == "data"
+    assert attempts == [1, 1]
+    assert sleeping == [0]
+    assert limiter.last_decrease > 0
+
+
+def test_progress_status():
+    reports = []
+
+    class status(object):
+        stdout = None
+
+        def __call__(self, **kw):
+            reports.append(kw)
+
+    progress = fetch.shared_progress(status=status())
+    progress.set_count("a", 1, 10, windows={"w.org": 4.0}, retries=1)
+    progress.set_count("b", 2, 10, windows={"up.org": 2.5}, retries=2)
+    assert reports[-1]["windows"] == {"w.org": 4.0, "up.org": 2.5}
+    assert reports[-1]["retries"] == 3
+
+
+def test_image_sizes(tmpdir, monkeypatch):
+    api = fakeapi({u"A": (1, u"[[File:Flag.png|20px]] [[File:Pic.png|20px]]"),
+                   u"B": (2, u"[[File:Pic.png|thumb|caption]] [[Image:Big.png]]")},
+                  images={u"File:Flag.png": "a", u"File:Pic.png": "b", u"File:Big.png": "c"})
+    widths = []
+
+    def fetch_imageinfo(titles, iiurlwidth=800):
+        widths.append((iiurlwidth, tuple(sorted(titles))))
+        return fakeapi.fetch_imageinfo(api, titles, iiurlwidth)
+
+    api.fetch_imageinfo = fetch_imageinfo
+    fetch_nuwiki(tmpdir.join("nuwiki").strpath, api, [(u"A", None), (u"B", None)], monkeypatch=monkeypatch)
+    assert sorted(widths) == [(50, (u"File:Flag.png",)), (450, (u"File:Pic.png",)), (800, (u"File:Big.png",))]
+
+
+class slowapi(fakeapi):
+    """reports the images of every page. expanding B takes a while"""
+
+    def fetch_used(self, titles=None, revids=None, fetch_images=True, expanded=False):
+        self.log.append(("used", tuple(titles or revids)))
+        pages = {}
+        for i, t in enumerate(titles):
+            images = [dict(title=x) for x in sorted(self.images) if x.split(":", 1)[1] in self.pages[t][1]]
+            pages[str(i)] = dict(title=t, images=images)
+        return dict(pages=pages)
+
+    def do_request(self, use_post=False, action=None, **kw):
+        if action == "expandtemplates" and kw.get("title") == u"B":
+            gevent.sleep(0.05)
+            res = fakeapi.do_request(self, use_post, action, **kw)
+            self.log.append(("expanded", u"B"))
+            return res
+        return fakeapi.do_request(self, use_post, action, **kw)
+
+
+def test_image_sizes_early(tmpdir, monkeypatch):
+    api = slowapi({u"A": (1, u"[[File:Flag.png|20px]] [[File:Big.png]]"),
+                   u"B": (2, u"[[File:Pic.png|thumb]]"),
+                   u"C": (3, u"[[File:Big.png|20px]]")},
+                  images={u"File:Flag.png": "a", u"File:Pic.png": "b", u"File:Big.png": "c"})
+    fetch_nuwiki(tmpdir.join("nuwiki").strpath, api, [(u"A", None), (u"B", None), (u"C", None)],
+                 monkeypatch=monkeypatch)
+    log = [x for x in api.log if x[0] in ("imageinfo", "expanded")]
+    # Flag.png is only used by A and Big.png needs the full width anyway
+    assert sorted(log[:2]) == [("imageinfo", (u"File:Big.png",)), ("imageinfo", (u"File:Flag.png",))]
+    assert log[2:] == [("expanded", u"B"), ("imageinfo", (u"File:Pic.png",))]
+
+
+class recordingapi(object):
+    api_request_limit = 3
+
+    def __init__(self):
+        self.calls = []
+
+    def do_retrying_request(self, **kwargs):
+        self.calls.append(kwargs)
+        if "revids" in kwargs:
+            pages = {}
+            for r in kwargs["revids"].split("|"):
+                r = int(r)
+                p = pages.setdefault(str(r // 10), dict(title=u"P%s" % (r // 10), revisions=[]))
+                p["revisions"].append(dict(revid=r))
+            return dict(pages=pages)
+        return dict(pages={"1": dict(title=kwargs["titles"])}, prop=kwargs["prop"])
+
+
+def test_query_planner_merges_props():
+    import gevent
+    api = recordingapi()
+    planner = fetch.query_planner(api)
+    res = {}
+
+    def query(name, **kw):
+        res[name] = planner.query(action="query", **kw)
+
+    gevent.joinall([gevent.spawn(query, "images", titles="A|B", prop="images", imlimit=500, redirects=1),
+                    gevent.spawn(query, "info", titles="A|B", prop="info", redirects=1),
+                    gevent.spawn(query, "other", titles="C", prop="info", redirects=1),
+                    gevent.spawn(query, "noredirects", titles="A|B", prop="categories")])
+    assert len(api.calls) == 3
+    assert res["images"]["prop"] == res["info"]["prop"] == "images|info"
+    assert res["other"]["prop"] == "info"
+    assert res["noredirects"]["prop"] == "categories"
+    assert repr(planner) == "<query_planner 4 requests in 3 calls>"
+
+
+def test_query_planner_batches_revids():
+    import gevent
+    api = recordingapi()
+    planner = fetch.query_planner(api)
+    res = {}
+
+    def query(revid):
+        res[revid] = planner.query(action="query", prop="revisions", rvprop="content", revids=str(revid))
+
+    gevent.joinall([gevent.spawn(query, r) for r in (11, 12, 21, 31, 41)])
+    assert [c["revids"] for c in api.calls] == ["11|12|21", "31|41"]
+    assert api.calls[0]["rvprop"] == "content|ids"
+    for r in (11, 12, 21, 31, 41):
+        pages = res[r]["pages"].values()
+        assert len(pages) == 1
+        assert pages[0]["revisions"] == [dict(revid=r)]
+
+
+def test_query_planner_accepts():
+    planner = fetch.query_planner(recordingapi())
+    assert planner.accepts(dict(action="query", prop="revisions", titles="A"))
+    assert not planner.accepts(dict(action="parse", page="A"))
+    assert not planner.accepts(dict(action="query", meta="siteinfo"))
+    assert not planner.accepts(dict(action="query", prop="revisions", titles="A", merge_data=None))
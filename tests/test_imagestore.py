@@ -0,0 +1,68 @@
+#! /usr/bin/env py.test
+
+import os
+from mwlib.net.imagestore import imagestore
+
+sha1 = "0123456789abcdef0123456789abcdef01234567"
+
+
+def test_get_add(tmpdir):
+    store = imagestore(tmpdir.join("store").strpath, 1000)
+    src = tmpdir.join("src")
+    src.write("data")
+    dst = tmpdir.join("dst").strpath
+
+    assert not store.get(sha1, 800, dst)
+    store.add(sha1, 800, src.strpath)
+    assert not store.get(sha1, 1200, dst)
+    assert store.get(sha1, 800, dst)
+    assert open(dst).read() == "data"
+    assert (store.hits, store.misses) == (1, 2)
+
+    # no valid sha1, no store
+    store.add("../../etc", 800, src.strpath)
+    assert store.blobpath("../../etc", 800) is None
+    assert not store.get(None, 800, dst)
+
+
+def test_evict(tmpdir):
+    store = imagestore(tmpdir.join("store").strpath, 25)
+    for i in range(5):
+        src = tmpdir.join("src%s" % i)
+        src.write("x" * 10)
+        store.add(sha1, i, src.strpath)
+        os.unlink(src.strpath)
+        os.utime(store.blobpath(sha1, i), (i, i))
+
+    store.evict()
+    present = [i for i in range(5) if os.path.exists(store.blobpath(sha1, i))]
+    assert present == [3, 4]
+
+
+def test_evict_on_add(tmpdir, monkeypatch):
+    store = imagestore(tmpdir.join("store").strpath, 35)
+
+    def add(i):
+        src = tmpdir.join("src%s" % i)
+        src.write("x" * 10)
+        store.add(sha1, i, src.strpath)
+        os.utime(store.blobpath(sha1, i), (i, i))
+
+    add(0)
+    assert open(store.sizepath).read() == "10"
+
+    # the recorded size is used without looking at the blobs
+    def walk(path):
+        raise AssertionError("store scanned")
+
+    monkeypatch.setattr(os, "walk", walk)
+    add(1)
+    add(2)
+    assert open(store.sizepath).read() == "30"
+    monkeypatch.undo()
+
+    # too large: evict the least recently used blobs
+    add(3)
+    present = [i for i in range(4) if os.path.exists(store.blobpath(sha1, i))]
+    assert present == [1, 2, 3]
+    assert open(store.sizepath).read() == "30"
@@ -0,0 +1,48 @@
+#! /usr/bin/env py.test
+
+from mwlib import nshandling
+from mwlib.net import imageusage
+
+
+def usages(txt):
+    nshandler = nshandling.get_nshandler_for_lang("en")
+    return [(t, imageusage.sizer(1200).get_width(u)) for t, u in imageusage.find_usages(txt, nshandler)]
+
+
+def test_find_usages():
+    txt = u"""[[File:Flag.svg|20px]] text [[Image:thumb.jpg|thumb|caption with [[a link]]]]
+[[:File:Linked.png]] [[Category:X]] [[Media:Sound.ogg]]
+<gallery widths=200px>
+File:G1.jpg|one
+G2.jpg
+</gallery>"""
+    res = usages(txt)
+    assert [t for t, w in res] == [u"File:G1.jpg", u"File:G2.jpg", u"File:Flag.svg", u"File:Thumb.jpg", u"File:Sound.ogg"]
+
+
+def test_widths():
+    s = imageusage.sizer(1200, print_width=480, print_width_px=800, dpi=300, step=50)
+    u = imageusage.usage()
+    assert s.get_width(u) == 1200  # original size
+
+    u.width = 20
+    assert s.get_width(u) == 50  # 20/800*480/72*300 = 50
+
+    u.width = 0
+    u.thumb = True
+    assert s.get_width(u) == 450  # default thumb width of 180px is 450px at 300dpi
+
+    u.upright = 0.5
+    assert s.get_width(u) == 250
+
+    u = imageusage.usage()
+    u.width = 4000
+    assert s.get_width(u) == 1200
+
+
+def test_get_sizer(monkeypatch):
+    assert imageusage.get_sizer(800).maxwidth == 800
+    monkeypatch.setenv("MWLIB_FETCH_PRINT_DPI", "150")
+    assert imageusage.get_sizer(800).dpi == 150
+    monkeypatch.setenv("MWLIB_FETCH_SIZE_IMAGES", "no")
+    assert imageusage.get_sizer(800) is None
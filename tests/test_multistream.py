@@ -0,0 +1,151 @@
+#! /usr/bin/env py.test
+# -*- coding: utf-8 -*-
+
+import os, bz2
+
+import py
+
+from mwlib import multistream
+from mwlib.dumpparser import DumpParser
+
+header = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.4/">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+  </siteinfo>
+"""
+
+
+def page_xml(i):
+    return """  <page>
+    <title>Page %d</title>
+    <revision><id>%d</id><text>text of page %d</text></revision>
+  </page>
+""" % (i, i, i)
+
+
+def write_dump(path, count=20, per_stream=3):
+    streams = [header]
+    for i in range(0, count, per_stream):
+        streams.append("".join(page_xml(j) for j in range(i, min(count, i + per_stream))))
+    streams.append("</mediawiki>\n")
+    data = [bz2.compress(s) for s in streams]
+    path.write("".join(data), "wb")
+
+    offsets = []
+    pos = 0
+    for d in data:
+        offsets.append(pos)
+        pos += len(d)
+    return path.strpath, offsets, "".join(streams)
+
+
+def test_iter_bz2_streams(tmpdir):
+    p = tmpdir.join("x.bz2")
+    p.write(bz2.compress("abc") + bz2.compress("de" * 1000), "wb")
+    streams = list(multistream.iter_bz2_streams(p.open("rb"), blocksize=7))
+    assert [s[2] for s in streams] == ["abc", "de" * 1000]
+    assert streams[1][0] == streams[0][1]
+    assert streams[1][0] + streams[1][1] == p.size()
+
+
+def test_find_streams(tmpdir):
+    path, offsets, xml = write_dump(tmpdir.join("dump.xml.bz2"))
+    ranges = list(multistream.find_streams(path))
+    assert [r[0] for r in ranges] == offsets
+    assert sum(r[1] for r in ranges) == tmpdir.join("dump.xml.bz2").size()
+
+    # wikimedia's index lists the streams with pages only
+    index = "".join("%d:%d:Page %d\n" % (o, i, i) for i, o in enumerate(offsets[1:-1]))
+    tmpdir.join("index.txt.bz2").write(bz2.compress(index), "wb")
+    ranges = list(multistream.find_streams(path, indexpath=tmpdir.join("index.txt.bz2").strpath))
+    assert [r[0] for r in ranges] == offsets[:-1]
+
+    py.test.raises(multistream.not_multistream, list, multistream.find_streams(path, maxlength=10))
+
+
+def test_find_streams_single_stream(tmpdir, monkeypatch):
+    p = tmpdir.join("single.xml.bz2")
+    p.write(bz2.compress(os.urandom(200000)), "wb")
+    read = []
+
+    class countingfile(file):
+        def read(self, size=-1):
+            data = file.read(self, size)
+            read.append(len(data))
+            return data
+
+    monkeypatch.setattr(multistream, "open", countingfile, raising=False)
+    headers = multistream._search_headers(p.strpath, maxlength=10000, blocksize=4096)
+    py.test.raises(multistream.not_multistream, list, headers)
+    # stopped long before the end of the file
+    assert sum(read) < 20000
+
+
+def test_decompress_range():
+    data = bz2.compress("abc") + bz2.compress("def")
+    assert multistream.decompress_range(data) == "abcdef"
+    py.test.raises(ValueError, multistream.decompress_range, data[:-5])
+
+
+def test_iter_ranges(tmpdir):
+    path, offsets, xml = write_dump(tmpdir.join("dump.xml.bz2"))
+    ranges = list(multistream.find_streams(path))
+    res = list(multistream.iter_ranges(path, ranges, processes=2, window=2))
+    assert "".join(x[2] for x in res) == xml
+
+    res = list(multistream.iter_ranges(path, ranges, processes=2, ordered=False))
+    assert sorted(x[0] for x in res) == offsets
+
+
+def test_iter_ranges_split_stream(tmpdir):
+    """a stream header found inside of a stream"""
+    path, offsets, xml = write_dump(tmpdir.join("dump.xml.bz2"))
+    ranges = list(multistream.find_streams(path))
+    offset, length = ranges[2]
+    ranges[2:3] = [(offset, 10), (offset + 10, length - 10)]
+
+    for ordered in (True, False):
+        res = multistream.iter_ranges(path, ranges, processes=2, ordered=ordered)
+        res = sorted(res)
+        assert [x[0] for x in res] == offsets
+        assert "".join(x[2] for x in res) == xml
+
+
+def test_dumpparser(tmpdir):
+    path, offsets, xml = write_dump(tmpdir.join("dump.xml.bz2"))
+    titles = ["Page %d" % i for i in range(20)]
+
+    p = DumpParser(path, processes=2, multistream=True)
+    assert [x.title for x in p] == titles
+    assert p.siteinfo["general"]["sitename"] == "Wikipedia"
+
+    p = DumpParser(path, processes=2, ordered=False, multistream=True)
+    pages = list(p)
+    assert sorted(x.title for x in pages) == sorted(titles)
+    assert sorted(x.revid for x in pages) == range(20)
+    assert p.siteinfo["general"]["sitename"] == "Wikipedia"
+
+
+def test_dumpparser_page_crosses_streams(tmpdir):
+    xml = header + "".join(page_xml(i) for i in range(6)) + "</mediawiki>\n"
+    cut = xml.index("<text>text of page 3")
+    tmpdir.join("dump.xml.bz2").write(bz2.compress(xml[:cut]) + bz2.compress(xml[cut:]), "wb")
+    path = tmpdir.join("dump.xml.bz2").strpath
+    titles = ["Page %d" % i for i in range(6)]
+
+    p = DumpParser(path, processes=2, multistream=True)
+    assert [x.title for x in p] == titles
+
+    p = DumpParser(path, processes=2, ordered=False, multistream=True)
+    py.test.raises(ValueError, list, p)
+
+
+def test_dumpparser_not_multistream(tmpdir, monkeypatch):
+    path, offsets, xml = write_dump(tmpdir.join("dump.xml.bz2"))
+
+    def find_streams(*args, **kwargs):
+        raise AssertionError("searched for streams")
+
+    monkeypatch.setattr(multistream, "find_streams", find_streams)
+    p = DumpParser(path, processes=2, ordered=False)
+    assert [x.title for x in p] == ["Page %d" % i for i in range(20)]
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import py
 import shutil
 import subprocess
 import tempfile
@@ -35,3 +36,265 @@ class Test_nuwiki_xnet(object):
         assert self.nuwiki.siteinfo['general']['lang'] == 'de'
         assert self.nuwiki.nshandler is not None
         assert self.nuwiki.nfo['base_url'] == 'http://de.wikipedia.org/w/'
+
+
+def make_nuwiki(path):
+    from mwlib.net.fetch import fsoutput
+    from mwlib.siteinfo import get_siteinfo
+
+    fsout = fsoutput(path)
+    fsout.write_siteinfo(get_siteinfo("en"))
+    fsout.write_pages({"pages": {
+        "1": dict(title=u"Main", ns=0, revisions=[dict(revid=10, **{"*": u"old main"}),
+                                                  dict(revid=11, **{"*": u"new main \xe4"})]),
+        "2": dict(title=u"Template:Foo", ns=10, revisions=[dict(revid=20, **{"*": u"foo"})])}})
+    fsout.write_expanded_page(u"Expanded", 0, u"expanded text")
+    fsout.set_db_key("authors", u"Main", [u"Alice", u"Bob"])
+    fsout.set_db_key("authors", u"File:Bild \xe4.jpg", [u"Carol"])
+    fsout.set_db_key("imageinfo", u"File:Bild \xe4.jpg", dict(width=100, height=50))
+    for title in (u"File:Bild \xe4.jpg", u"File:Logo.svg"):
+        open(fsout.get_imagepath(title), "wb").write("image data")
+    fsout.close()
+    return fsout
+
+
+def test_revindex(tmpdir):
+    from mwlib.nuwiki import nuwiki
+    path = tmpdir.join("nuwiki").strpath
+    make_nuwiki(path)
+    assert os.path.exists(os.path.join(path, "revindex.json"))
+
+    def check(nw):
+        assert nw.get_page(u"Main").rawtext == u"new main \xe4"
+        assert nw.get_page(u"Main", 10).rawtext == u"old main"
+        assert nw.get_page(u"Template:Foo").rawtext == u"foo"
+        assert nw.get_page(u"Expanded").expanded
+        assert nw.get_page(u"Expanded").rawtext == u"expanded text"
+        assert nw.articles() == [u"Expanded", u"Main"]
+        assert all(isinstance(t, unicode) for t in nw.articles())
+
+    check(nuwiki(path))
+
+    # collections written before revindex.json existed are scanned
+    os.unlink(os.path.join(path, "revindex.json"))
+    check(nuwiki(path))
+
+
+def test_revindex_pickle(tmpdir):
+    import cPickle
+    from mwlib.nuwiki import nuwiki
+    path = tmpdir.join("nuwiki").strpath
+    make_nuwiki(path)
+    nw = cPickle.loads(cPickle.dumps(nuwiki(path, allow_pickle=True)))
+    assert nw.get_page(u"Main").rawtext == u"new main \xe4"
+    assert nw.get_page(u"Main").decoded_cache is nw.decoded_cache
+
+
+def test_decoded_cache(tmpdir):
+    from mwlib.nuwiki import nuwiki
+    path = tmpdir.join("nuwiki").strpath
+    make_nuwiki(path)
+    nw1, nw2 = nuwiki(path), nuwiki(path)
+    assert nw1.decoded_cache is not nw2.decoded_cache
+    assert nw1.get_page(u"Main").rawtext == u"new main \xe4"
+    assert nw1.decoded_cache.misses == 1
+    assert nw1.get_page(u"Main").rawtext == u"new main \xe4"
+    assert nw1.decoded_cache.hits == 1
+    assert nw2.get_page(u"Main").rawtext == u"new main \xe4"
+    assert (nw2.decoded_cache.hits, nw2.decoded_cache.misses) == (0, 1)
+
+
+def test_zipnuwiki(tmpdir):
+    zipfn = tmpdir.join("collection.zip").strpath
+    shutil.copy(os.path.join(os.path.dirname(__file__), "speisesalz-nuwiki.zip"), zipfn)
+    zf = zipfile.ZipFile(zipfn)
+    a = adapt(zf)
+    try:
+        path = a.nuwiki.path
+        assert a.nuwiki.articles() == [u"Speisesalz"]
+        assert a.nuwiki.get_page(u"Speisesalz").rawtext.startswith(u"[[Datei:Speisesalz.jpg")
+        assert a.metabook.articles()[0].title == u"Speisesalz"
+        # nothing but the images directory has been extracted
+        assert os.listdir(path) == ["images"]
+
+        p = a.getDiskPath(u"Datei:Speisesalz.jpg")
+        assert os.path.isfile(p)
+        assert os.stat(p).st_size == 61378
+        assert sorted(os.listdir(os.path.join(path, "images"))) == ["Datei:Speisesalz.jpg", "safe"]
+        assert a.getDiskPath(u"Datei:Missing.jpg") is None
+    finally:
+        a.clear()
+    assert not os.path.exists(path)
+
+
+def test_dumbjsondb_cache(tmpdir):
+    from mwlib.nuwiki import DumbJsonDB
+    path = tmpdir.join("nuwiki").strpath
+    make_nuwiki(path)
+    db = DumbJsonDB(os.path.join(path, "authors.db"), cachesize=10)
+
+    assert db[u"Main"] == [u"Alice", u"Bob"]
+    assert (db.hits, db.misses) == (0, 1)
+    assert db.get(u"Main") == [u"Alice", u"Bob"]
+    assert (db.hits, db.misses) == (1, 1)
+
+    res = db.get_many([u"File:Bild \xe4.jpg", u"Main", u"Missing"], blocksize=2)
+    assert res == [[u"Carol"], [u"Alice", u"Bob"], None]
+    assert (db.hits, db.misses) == (2, 3)
+    assert db[u"Missing"] is None
+    assert db[u"File:Bild \xe4.jpg"] == [u"Carol"]
+    assert (db.hits, db.misses) == (4, 3)
+
+
+def test_prefetch(tmpdir):
+    path = tmpdir.join("nuwiki").strpath
+    make_nuwiki(path)
+    a = adapt(path)
+    a.prefetch(titles=[u"Main"], images=[u"Image:Bild \xe4.jpg"])
+    authors, imageinfo = a.nuwiki.authors, a.nuwiki.imageinfo
+    assert authors.misses == 2
+    assert imageinfo.misses == 1
+
+    assert a.getAuthors(u"Main") == [u"Alice", u"Bob"]
+    assert authors[u"File:Bild \xe4.jpg"] == [u"Carol"]
+    assert imageinfo[u"File:Bild \xe4.jpg"] == dict(width=100, height=50)
+    assert (authors.hits, authors.misses) == (2, 2)
+    assert (imageinfo.hits, imageinfo.misses) == (1, 1)
+
+
+def test_prefetch_larger_than_cache(tmpdir, monkeypatch):
+    from mwlib.net.fetch import fsoutput
+    from mwlib.siteinfo import get_siteinfo
+
+    monkeypatch.setenv("MWLIB_NUWIKI_DB_CACHESIZE", "10")
+    path = tmpdir.join("nuwiki").strpath
+    fsout = fsoutput(path)
+    fsout.write_siteinfo(get_siteinfo("en"))
+    titles = [u"Article %d" % i for i in range(30)]
+    for t in titles:
+        fsout.set_db_key("authors", t, [t])
+    fsout.close()
+
+    a = adapt(path)
+    a.prefetch(titles=titles)
+    authors = a.nuwiki.authors
+    assert authors.misses == 30
+
+    def get(key, default=None):
+        raise AssertionError("%r not prefetched" % (key,))
+
+    monkeypatch.setattr(authors.db, "get", get)
+    for t in titles:
+        assert a.getAuthors(t) == [t]
+    assert (authors.hits, authors.misses) == (30, 30)
+    assert authors.prefetched == {}
+
+
+def test_image_manifest(tmpdir):
+    from mwlib.nuwiki import nuwiki
+    path = tmpdir.join("nuwiki").strpath
+    make_nuwiki(path)
+    nw = nuwiki(path)
+
+    # all symlinks are created when opening the nuwiki
+    safe = sorted(os.listdir(os.path.join(path, "images", "safe")))
+    assert len(safe) == 2
+    assert sorted(os.path.splitext(x)[1] for x in safe) == [".jpg", ".png"]
+
+    p = nw.normalize_and_get_image_path(u"Image:Bild \xe4.jpg")
+    assert os.path.basename(p) in safe
+    assert open(p).read() == "image data"
+    assert nw.normalize_and_get_image_path(u"Bild \xe4.jpg") == p
+    assert nw.normalize_and_get_image_path(u"File:Logo.svg").endswith(".png")
+    assert nw.normalize_and_get_image_path(u"File:Missing.jpg") is None
+    assert nw.normalize_and_get_image_path(u"Main") is None
+
+
+def test_title_index(tmpdir):
+    from mwlib.nuwiki import nuwiki, Page
+    path = tmpdir.join("nuwiki").strpath
+    make_nuwiki(path)
+    nw = nuwiki(path)
+
+    assert nw.articles() == [u"Expanded", u"Main"]
+    assert nw.select(u"F", u"Z") == [u"Main", u"Template:Foo"]
+    assert nw.select(u"Main", u"Main") == [u"Main"]
+    assert list(nw.iter_titles(end=u"Main")) == [u"Expanded", u"Main"]
+    assert list(nw.iter_titles(ns=10)) == [u"Template:Foo"]
+
+    nw.add_page(Page(dict(title=u"Another", ns=0, revid=30), u"another"))
+    nw.add_page(Page(dict(title=u"Main", ns=0, revid=9), u"older main"))
+    assert nw.articles() == [u"Another", u"Expanded", u"Main"]
+    assert nw.get_page(u"Main").rawtext == u"new main \xe4"
+    assert nw.get_page(None, 9).rawtext == u"older main"
+
+    nw.add_page(Page(dict(title=u"Main", ns=0, revid=12), u"newest main"))
+    assert nw.get_page(u"Main").rawtext == u"newest main"
+    assert nw.select(u"A", u"Mz") == [u"Another", u"Expanded", u"Main"]
+
+
+def test_page():
+    import cPickle
+    from mwlib.nuwiki import Page
+    p = Page(dict(title=u"T\xe4st", ns=0, revid=5), u"text \xe4")
+    assert not hasattr(p, "__dict__")
+    assert p._data == "text \xc3\xa4"
+    assert p.rawtext == u"text \xe4"
+    assert p.expanded == 0
+    p.rawtext = u"other"
+    assert p.rawtext == u"other"
+
+    p2 = cPickle.loads(cPickle.dumps(p))
+    assert (p2.title, p2.ns, p2.revid, p2.rawtext) == (u"T\xe4st", 0, 5, u"other")
+
+    from mwlib.lrucache import mt_lrucache
+    p3 = Page(dict(title=u"Cached"), u"cached", cache=mt_lrucache(10))
+    assert p3.rawtext == u"cached"
+    assert p3.decoded_cache.cache == {"cached": u"cached"}
+    assert cPickle.loads(cPickle.dumps(p3)).decoded_cache is None
+    assert Page(dict(title=u"Empty")).rawtext is None
+
+
+def test_snapshot(tmpdir, monkeypatch):
+    from mwlib.nuwiki import nuwiki
+    path = tmpdir.join("nuwiki").strpath
+    make_nuwiki(path)
+
+    # off by default
+    monkeypatch.delenv("MWLIB_NUWIKI_SNAPSHOT", raising=False)
+    nuwiki(path)
+    assert not os.path.exists(os.path.join(path, "nuwiki.snapshot"))
+
+    monkeypatch.setenv("MWLIB_NUWIKI_SNAPSHOT", "yes")
+    nw = nuwiki(path)
+    assert os.path.exists(os.path.join(path, "nuwiki.snapshot"))
+
+    def read_metadata(self):
+        raise AssertionError("snapshot not used")
+
+    orig_read_metadata = nuwiki._read_metadata
+    monkeypatch.setattr(nuwiki, "_read_metadata", read_metadata)
+    nw2 = nuwiki(path)
+    assert nw2.get_page(u"Main").rawtext == u"new main \xe4"
+    assert nw2.siteinfo == nw.siteinfo
+    assert nw2.nshandler.get_fqname(u"foo", 10) == u"Template:Foo"
+
+    # changed files invalidate the snapshot
+    open(os.path.join(path, "redirects.json"), "wb").write('{"Old": "Main"}')
+    py.test.raises(AssertionError, nuwiki, path)
+    monkeypatch.setattr(nuwiki, "_read_metadata", orig_read_metadata)
+    assert nuwiki(path).redirects == {u"Old": u"Main"}
+    monkeypatch.setattr(nuwiki, "_read_metadata", read_metadata)
+    assert nuwiki(path).get_page(u"Old").title == u"Main"
+
+
+def test_zip_snapshot(tmpdir, monkeypatch):
+    monkeypatch.setenv("MWLIB_NUWIKI_SNAPSHOT", "yes")
+    zipfn = tmpdir.join("collection.zip").strpath
+    shutil.copy(os.path.join(os.path.dirname(__file__), "speisesalz-nuwiki.zip"), zipfn)
+    a = adapt(zipfile.ZipFile(zipfn))
+    a.clear()
+    assert os.path.exists(zipfn + ".snapshot")
+    a = adapt(zipfile.ZipFile(zipfn))
+    assert a.nuwiki.articles() == [u"Speisesalz"]
+    a.clear()
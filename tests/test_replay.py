@@ -0,0 +1,306 @@
+#! /usr/bin/env py.test
+
+import os, sys, subprocess, threading, urlparse, StringIO, BaseHTTPServer, SocketServer
+
+from mwlib import myjson as json
+from mwlib.net import replay, sapi
+from mwlib.siteinfo import get_siteinfo
+
+
+def test_request_key():
+    k = replay.request_key
+    assert k("http://w.org/w/api.php?b=2&a=1&maxlag=5") == k("https://w.org/w/api.php?a=1&b=2")
+    assert k("http://w.org/w/api.php?a=1", "b=2") == k("http://w.org/w/api.php?a=1&b=2")
+    assert k("http://w.org/w/api.php?a=1") != k("http://other.org/w/api.php?a=1")
+    assert k("http://w.org/img/A%C3%A4.png") == k("http://w.org/img/A\xc3\xa4.png")
+
+
+def make_recording(path):
+    rec = replay.recorder(path)
+    rec.add("http://w.org/w/api.php?action=query&titles=A",
+            '{"url": "http://up.org/a.png", "escaped": "https:\\/\\/up.org\\/b.png"}')
+    rec.add("http://w.org/w/api.php", '{"posted": 1}', data="action=parse&text=x")
+    rec.add("http://up.org/a.png", "\x89PNG http://up.org/", kind="file")
+    rec.close()
+
+
+def call(server, path, query="", data=None):
+    environ = {"PATH_INFO": path, "QUERY_STRING": query, "REQUEST_METHOD": "GET"}
+    if data is not None:
+        environ.update(REQUEST_METHOD="POST", **{"wsgi.input": StringIO.StringIO(data)})
+    res = []
+    body = "".join(server(environ, lambda status, headers: res.append(status)))
+    return res[0], body
+
+
+def test_replay(tmpdir):
+    path = tmpdir.join("rec.jsonl").strpath
+    make_recording(path)
+    server = replay.replay_server(path)
+    server.prefix = "http://127.0.0.1:1/-/"
+    server._rewrite_responses()
+
+    status, body = call(server, "/-/w.org/w/api.php", "titles=A&action=query&maxlag=5")
+    assert status == "200 OK"
+    assert body == '{"url": "http://127.0.0.1:1/-/up.org/a.png", "escaped": "http:\\/\\/127.0.0.1:1\\/-\\/up.org\\/b.png"}'
+
+    assert call(server, "/-/w.org/w/api.php", "", "text=x&action=parse") == ("200 OK", '{"posted": 1}')
+    # files are not rewritten
+    assert call(server, "/-/up.org/a.png") == ("200 OK", "\x89PNG http://up.org/")
+
+    assert call(server, "/-/w.org/w/api.php", "action=query&titles=B")[0] == "404 Not Found"
+    assert (server.requests, server.missing, server.errors) == (4, 1, 0)
+    assert server.local_url("http://w.org/w/") == "http://127.0.0.1:1/-/w.org/w/"
+
+
+def test_error_injection(tmpdir):
+    path = tmpdir.join("rec.jsonl").strpath
+    make_recording(path)
+    server = replay.replay_server(path, error_rate=1.0)
+    assert call(server, "/-/up.org/a.png")[0] == "503 Service Unavailable"
+    assert server.errors == 1
+
+
+def test_bandwidth(tmpdir):
+    path = tmpdir.join("rec.jsonl").strpath
+    make_recording(path)
+    server = replay.replay_server(path, bandwidth=1000000)
+    server.chunksize = 4
+    assert call(server, "/-/up.org/a.png")[1] == "\x89PNG http://up.org/"
+    assert server.bytes_sent == len("\x89PNG http://up.org/")
+
+
+def test_merged_parts(tmpdir):
+    path = tmpdir.join("rec.jsonl").strpath
+    rec = replay.recorder(path)
+    rec.add("http://w.org/w/api.php?action=query&prop=info&titles=a|B",
+            '{"query": {"normalized": [{"from": "a", "to": "A"}],'
+            ' "pages": {"1": {"title": "A"}, "2": {"title": "B"}}}}')
+    rec.add("http://w.org/w/api.php?action=query&prop=info&titles=C|D",
+            '{"query": {"pages": {"3": {"title": "C"}, "-1": {"title": "D", "missing": ""}}}}')
+    rec.add("http://w.org/w/api.php?action=query&prop=revisions&revids=5|6",
+            '{"query": {"pages": {"1": {"title": "A", "revisions": [{"revid": 5}, {"revid": 6}]}}}}')
+    rec.add("http://w.org/w/api.php?action=query&prop=info&titles=E",
+            '{"query": {"pages": {"4": {"title": "E"}}}, "query-continue": {"info": {}}}')
+    rec.close()
+    server = replay.replay_server(path)
+
+    status, body = call(server, "/-/w.org/w/api.php", "action=query&prop=info&titles=a|C|D")
+    assert status == "200 OK"
+    assert json.loads(body) == {"query": {
+        "normalized": [{"from": "a", "to": "A"}],
+        "pages": {"1": {"title": "A"}, "3": {"title": "C"}, "-1": {"title": "D", "missing": ""}}}}
+
+    body = call(server, "/-/w.org/w/api.php", "action=query&prop=revisions&revids=6")[1]
+    assert json.loads(body) == {"query": {"pages": {"1": {"title": "A", "revisions": [{"revid": 6}]}}}}
+
+    # other parameters and continued queries must match exactly
+    assert call(server, "/-/w.org/w/api.php", "action=query&prop=revisions&titles=A")[0] == "404 Not Found"
+    assert call(server, "/-/w.org/w/api.php", "action=query&prop=info&titles=B|E")[0] == "404 Not Found"
+    assert (server.merged, server.missing) == (2, 2)
+
+
+def test_merged_props(tmpdir):
+    path = tmpdir.join("rec.jsonl").strpath
+    rec = replay.recorder(path)
+    rec.add("http://w.org/w/api.php?action=query&prop=info&redirects=1&titles=A",
+            '{"query": {"pages": {"1": {"title": "A", "lastrevid": 6}}}}')
+    rec.add("http://w.org/w/api.php?action=query&prop=revisions&rvprop=content&redirects=1&titles=A|B",
+            '{"query": {"pages": {"1": {"title": "A", "revisions": [{"*": "a"}]},'
+            ' "2": {"title": "B", "revisions": [{"*": "b"}]}}}}')
+    for revid in (5, 6):
+        rec.add("http://w.org/w/api.php?action=query&prop=revisions&rvprop=content&revids=%d" % revid,
+                '{"query": {"pages": {"1": {"title": "A", "revisions": [{"*": "text %d"}]}}}}' % revid)
+    rec.close()
+    server = replay.replay_server(path)
+
+    # prop modules merged by the query planner
+    body = call(server, "/-/w.org/w/api.php", "action=query&prop=info|revisions&rvprop=content&redirects=1&titles=A")[1]
+    assert json.loads(body) == {"query": {"pages": {"1": {
+        "title": "A", "lastrevid": 6, "revisions": [{"*": "a"}]}}}}
+
+    # revids batched by the query planner
+    body = call(server, "/-/w.org/w/api.php", "action=query&prop=revisions&rvprop=content|ids&revids=5|6")[1]
+    assert json.loads(body) == {"query": {"pages": {"1": {"title": "A", "revisions": [
+        {"revid": 5, "*": "text 5"}, {"revid": 6, "*": "text 6"}]}}}}
+
+    # modules or revision properties, which have not been recorded
+    assert call(server, "/-/w.org/w/api.php", "action=query&prop=info|images&redirects=1&titles=A")[0] == "404 Not Found"
+    assert call(server, "/-/w.org/w/api.php", "action=query&prop=info&titles=A")[0] == "404 Not Found"
+    assert call(server, "/-/w.org/w/api.php", "action=query&prop=revisions&rvprop=content|user&revids=5")[0] == "404 Not Found"
+    assert (server.merged, server.missing) == (2, 3)
+
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = '{"query": {"x": 1}}'
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def test_mwapi_records(tmpdir, monkeypatch):
+    path = tmpdir.join("rec.jsonl").strpath
+    monkeypatch.setenv("MWLIB_FETCH_RECORD", path)
+    monkeypatch.setenv("MWLIB_FETCH_APICACHE", tmpdir.join("cache.db").strpath)
+    s = server(("127.0.0.1", 0), handler)
+    t = threading.Thread(target=s.serve_forever)
+    t.daemon = True
+    t.start()
+    try:
+        api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % s.server_address[1])
+        assert api.cache is None
+        assert api.do_request(action="query", titles="A") == {"x": 1}
+    finally:
+        s.shutdown()
+
+    [(key, kind, body)] = replay.read_recording(path)
+    assert key == replay.request_key(api._build_url(action="query", titles="A"))
+    assert (kind, body) == ("api", '{"query": {"x": 1}}')
+
+
+class wikihandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """a tiny mediawiki, which knows the pages it's asked for"""
+
+    def page(self, i, title):
+        title = title[0].upper() + title[1:]
+        p = dict(pageid=i + 1, ns=0, title=title, lastrevid=100 + i)
+        props = self.params.get("prop", "").split("|")
+        if "revisions" in props:
+            p["revisions"] = [dict(revid=100 + i, user=u"Alice", timestamp=u"2011-01-01T00:00:00Z",
+                                   **{"*": u"text of %s" % title})]
+        if "contributors" in props:
+            p["contributors"] = [dict(name=u"Bob")]
+        return p
+
+    def query(self):
+        if self.params.get("meta") == "siteinfo":
+            return get_siteinfo("en")
+        pages = {}
+        normalized = []
+        for r in self.params.get("revids", "").split("|"):
+            if r:
+                i = int(r) - 100
+                p = pages[str(i + 1)] = self.page(i, u"Page %d" % i)
+                if "revisions" in p and "ids" not in self.params.get("rvprop", "").split("|"):
+                    del p["revisions"][0]["revid"]
+        for t in self.params.get("titles", "").split("|"):
+            if t:
+                p = pages[str(len(pages) + 1)] = self.page(int(t.rsplit(" ", 1)[-1]), t)
+                if p["title"] != t:
+                    normalized.append({"from": t, "to": p["title"]})
+        res = dict(pages=pages)
+        if normalized:
+            res["normalized"] = normalized
+        return res
+
+    def do_GET(self, data=""):
+        self.params = dict(urlparse.parse_qsl(urlparse.urlsplit(self.path)[3]) + urlparse.parse_qsl(data))
+        action = self.params["action"]
+        if action == "query":
+            res = self.query()
+        elif action == "parse":
+            res = dict(revid=1, text={"*": u"<p>%s</p>" % self.params.get("page", self.params.get("oldid"))})
+        elif action == "expandtemplates":
+            res = {"*": u"text of %s" % self.params["title"]}
+        else:
+            res = {}
+        body = json.dumps({action: res})
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.do_GET(self.rfile.read(int(self.headers["Content-Length"])))
+
+    def log_message(self, *args):
+        pass
+
+
+class benchoptions(object):
+    imagesize = 800
+    noimages = False
+    script_extension = ".php"
+    username = password = domain = None
+    collectionpage = None
+
+
+# (title, revision), articles with a revision are fetched by revid
+articles = [(u"Page %d" % i, None) for i in range(20)] + [(u"page 20", None)] + [
+    (u"Page %d" % i, 100 + i) for i in range(21, 27)]
+
+bench = """
+import sys
+from gevent import monkey
+monkey.patch_all(thread=False)
+from mwlib import myjson as json
+from mwlib.metabook import collection, wikiconf
+from mwlib.apps.fetchbench import run_bench
+
+class options(object):
+    imagesize = 800
+    noimages = False
+    script_extension = ".php"
+    username = password = domain = None
+    collectionpage = None
+    config = sys.argv[2]
+
+def metabook_from_options(options):
+    mb = collection()
+    mb.wikis = [wikiconf(baseurl=options.config)]
+    for t, r in json.loads(sys.argv[3]):
+        mb.append_article(t, revision=r)
+    return mb
+
+print json.dumps(run_bench(sys.argv[1], options(), metabook_from_options, latency=0.01))
+"""
+
+
+def test_fetch_bench(tmpdir, monkeypatch):
+    from mwlib.metabook import collection, wikiconf
+    from mwlib.apps.make_nuwiki import make_nuwiki
+    import signal
+
+    path = tmpdir.join("rec.jsonl").strpath
+    monkeypatch.setenv("MWLIB_FETCH_RECORD", path)
+    monkeypatch.setattr(signal, "signal", lambda *args: None)
+
+    s = server(("127.0.0.1", 0), wikihandler)
+    t = threading.Thread(target=s.serve_forever)
+    t.daemon = True
+    t.start()
+    baseurl = "http://127.0.0.1:%s/w/" % s.server_address[1]
+    try:
+        options = benchoptions()
+        options.config = baseurl
+        mb = collection()
+        mb.wikis = [wikiconf(baseurl=baseurl)]
+        for title, revision in articles:
+            mb.append_article(title, revision=revision)
+        make_nuwiki(tmpdir.join("nuwiki").strpath, metabook=mb, options=options)
+    finally:
+        s.shutdown()
+        replay.get_recorder().close()
+
+    # smaller blocks of titles than recorded
+    env = dict(os.environ, MWLIB_FETCH_API_REQUEST_LIMIT="4")
+    del env["MWLIB_FETCH_RECORD"]
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    p = subprocess.Popen([sys.executable, "-c", bench, path, baseurl, json.dumps(articles)],
+                         stdout=subprocess.PIPE, env=env, cwd=cwd)
+    out = p.communicate()[0]
+    assert p.returncode == 0, out
+    res = json.loads(out.strip().splitlines()[-1])
+    assert res["missing"] == 0
+    assert res["errors"] == 0
+    assert res["merged"] > 0
+    assert res["requests"] >= len(articles) * 2
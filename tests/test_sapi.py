@@ -0,0 +1,194 @@
+#! /usr/bin/env py.test
+
+import py, threading, zlib, gzip, StringIO, BaseHTTPServer, SocketServer
+
+from mwlib.net import sapi
+
+body = '{"query": {"text": "%s"}}' % ("wikitext " * 1000)
+
+
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    encoding = None
+    failures = ()  # list of (status, headers, body) sent before succeeding
+    requests = 0
+
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        self.server.paths.append(self.path)
+        if self.server.failures:
+            code, headers, data = self.server.failures.pop(0)
+            self.send_response(code)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        accepted = self.headers.get("Accept-Encoding", "")
+        encoding = self.server.encoding
+        data = body
+        if encoding == "gzip" and "gzip" in accepted:
+            f = StringIO.StringIO()
+            g = gzip.GzipFile(fileobj=f, mode="wb")
+            g.write(body)
+            g.close()
+            data = f.getvalue()
+        elif encoding == "deflate" and "deflate" in accepted:
+            data = zlib.compress(body)
+        elif encoding == "rawdeflate" and "deflate" in accepted:
+            data = zlib.compress(body)[2:-4]
+            encoding = "deflate"
+        else:
+            encoding = None
+
+        self.send_response(200)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def pytest_funcarg__httpd(request):
+    s = server(("127.0.0.1", 0), handler)
+    s.paths = []
+    t = threading.Thread(target=s.serve_forever)
+    t.daemon = True
+    t.start()
+    request.addfinalizer(s.shutdown)
+    return s
+
+
+def test_compressed_transfer(httpd):
+    api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % httpd.server_address[1])
+    for encoding in ("gzip", "deflate", "rawdeflate"):
+        httpd.encoding = encoding
+        received, decoded = api.bytes_received, api.bytes_decoded
+        assert api.do_request(action="query") == {"text": "wikitext " * 1000}
+        assert api.bytes_decoded - decoded == len(body)
+        assert api.bytes_received - received < len(body) / 10
+
+
+def test_uncompressed_transfer(httpd):
+    api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % httpd.server_address[1])
+    assert api.do_request(action="query") == {"text": "wikitext " * 1000}
+    assert api.bytes_received == api.bytes_decoded == len(body)
+
+
+def test_retry(httpd, monkeypatch):
+    import time
+    delays = []
+    monkeypatch.setattr(time, "sleep", delays.append)
+
+    api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % httpd.server_address[1])
+    api.max_retry_count = 3
+    maxlag = '{"error": {"code": "maxlag", "info": "Waiting for db1: 7 seconds lagged"}}'
+    httpd.failures = [(503, {}, "busy"), (503, {"Retry-After": "12"}, "busy"), (200, {}, maxlag)]
+    assert api.do_request(action="query") == {"text": "wikitext " * 1000}
+    assert api.retry_count == 3
+    assert len(delays) == 3
+    assert 0 <= delays[0] <= 1.0
+    assert 12 <= delays[1] <= 12.5
+    assert 5 <= delays[2] <= 5.5
+
+
+def test_retry_gives_up(httpd, monkeypatch):
+    import time, urllib2
+    from mwlib.net.throttle import retry_budget
+    monkeypatch.setattr(time, "sleep", lambda x: None)
+
+    api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % httpd.server_address[1])
+    api.max_retry_count = 3
+    api.retry_budget = retry_budget(1)
+    httpd.failures = [(503, {}, "busy")] * 3
+    py.test.raises(urllib2.HTTPError, api.do_request, action="query")
+    assert api.retry_count == 1
+
+    # client errors are not retried
+    httpd.failures = [(404, {}, "not found")]
+    api.retry_budget = None
+    py.test.raises(urllib2.HTTPError, api.do_request, action="query")
+    assert api.retry_count == 1
+
+
+def test_cache(httpd, tmpdir, monkeypatch):
+    monkeypatch.setenv("MWLIB_FETCH_APICACHE", tmpdir.join("apicache.db").strpath)
+    apiurl = "http://127.0.0.1:%s/w/api.php" % httpd.server_address[1]
+
+    for i in range(2):
+        api = sapi.mwapi(apiurl)
+        assert api.do_request(action="query", revids="1") == {"text": "wikitext " * 1000}
+    assert httpd.requests == 1
+    assert api.cache.hits == 1
+
+    # errors are not cached
+    httpd.failures = [(200, {}, '{"error": {"code": "internal", "info": "broken"}}')]
+    py.test.raises(RuntimeError, api.do_request, action="query", revids="2")
+    assert api.do_request(action="query", revids="2") == {"text": "wikitext " * 1000}
+    assert httpd.requests == 3
+
+    # not shared with logged in users
+    assert sapi.mwapi(apiurl, "user", "secret").cache is None
+    api = sapi.mwapi(apiurl)
+    monkeypatch.setattr(api, "_post", lambda **kw: {"login": {"result": "Success"}})
+    api.login(u"user", u"secret")
+    assert api.cache is None
+
+
+def test_continue_unfinished_modules(httpd):
+    httpd.failures = [
+        (200, {}, '{"query": {"pages": {"1": {"title": "A", "revisions": [{"revid": 1}], "categories": [{"title": "Category:X"}]}}},'
+                  ' "query-continue": {"categories": {"clcontinue": "1|Y"}}}'),
+        (200, {}, '{"query": {"pages": {"1": {"title": "A", "categories": [{"title": "Category:Y"}]}}}}')]
+    api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % httpd.server_address[1])
+    res = api.fetch_pages(titles=["A"])
+    page = res["pages"]["1"]
+    assert page["revisions"] == [{"revid": 1}]
+    assert [c["title"] for c in page["categories"]] == ["Category:X", "Category:Y"]
+    assert len(httpd.paths) == 2
+    assert "prop=revisions|categories" in httpd.paths[0]
+    assert "prop=categories&" in httpd.paths[1] or httpd.paths[1].endswith("prop=categories")
+
+
+def test_fetch_contributors(httpd):
+    httpd.failures = [
+        (200, {}, '{"query": {"normalized": [{"from": "a", "to": "A"}],'
+                  ' "pages": {"1": {"title": "A", "contributors": [{"name": "Bob"}, {"name": "Carol"}],'
+                  ' "anoncontributors": 2}, "-1": {"title": "Missing", "missing": ""}}}}')]
+    api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % httpd.server_address[1])
+    res = api.fetch_contributors(["a", "Missing"])
+    assert res.keys() == ["a"]
+    assert u"Bob" in res["a"] and u"Carol" in res["a"]
+    # the number of anonymous users, not of their edits
+    assert res["a"][-1] == "ANONCONTRIBUTORS:2"
+    assert not [x for x in res["a"] if x.startswith("ANONIPEDITS")]
+    assert api.has_contributors is True
+    assert "prop=contributors" in httpd.paths[0]
+
+
+def test_fetch_contributors_unsupported(httpd):
+    httpd.failures = [(200, {}, '{"warnings": {"query": {"*": "Unrecognized value for parameter \'prop\': contributors"}},'
+                                ' "query": {"pages": {"1": {"title": "A"}}}}')]
+    api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % httpd.server_address[1])
+    assert api.fetch_contributors(["A"]) is None
+    assert api.fetch_contributors(["B"]) is None
+    assert httpd.requests == 1
+
+
+def test_max_history_depth(httpd, monkeypatch):
+    monkeypatch.setenv("MWLIB_FETCH_MAX_HISTORY_DEPTH", "2")
+    page = '{"query": {"pages": {"1": {"title": "A", "revisions": [{"user": "U%s"}, {"user": "V%s"}]}}},' \
+           ' "query-continue": {"revisions": {"rvstartid": %s}}}'
+    httpd.failures = [(200, {}, page % (i, i, i)) for i in range(3)]
+    api = sapi.mwapi("http://127.0.0.1:%s/w/api.php" % httpd.server_address[1])
+    authors = api.get_edits("A", None).get_authors()
+    assert authors == ["U0", "V0", "ANONIPEDITS:0"]
+    assert httpd.requests == 1
+    assert "rvlimit=2" in httpd.paths[0]
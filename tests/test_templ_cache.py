@@ -0,0 +1,71 @@
+#! /usr/bin/env py.test
+# -*- coding: utf-8 -*-
+
+from mwlib.expander import Expander, DictDB
+from mwlib.templ.cache import templatecache, get_template_cache
+
+
+def expand(db, txt):
+    return Expander(txt, pagename="thispage", wikidb=db).expandTemplates()
+
+
+def test_shared_between_expanders():
+    db = DictDB(t=u"<b>{{{1}}}</b>", u=u"{{t|x}}{{t|y}}")
+    cache = get_template_cache(db)
+    assert get_template_cache(db) is cache
+
+    assert expand(db, u"{{u}}") == u"<b>x</b><b>y</b>"
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["hits"] == 0
+
+    assert expand(db, u"{{u}} {{t|z}}") == u"<b>x</b><b>y</b> <b>z</b>"
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["entries"] == 2
+
+    assert get_template_cache(DictDB()) is not cache
+
+
+def test_tags_in_shared_templates():
+    db = DictDB(t=u"<nowiki>''{{{1}}}''</nowiki><ref>r</ref>")
+    first = expand(db, u"<nowiki>a</nowiki>{{t|x}}")
+    assert get_template_cache(db).stats()["misses"] == 1
+    second = expand(db, u"<nowiki>a</nowiki>{{t|x}}")
+    assert get_template_cache(db).stats()["hits"] == 1
+    assert first == second == u"a''{{{1}}}''<ref>r</ref>"
+
+
+def test_changed_text():
+    db = DictDB(t=u"one")
+    assert expand(db, u"{{t}}") == u"one"
+    db.d["t"] = u"two"
+    assert expand(db, u"{{t}}") == u"two"
+    assert get_template_cache(db).stats()["misses"] == 2
+
+
+def test_revision_key():
+    class page(object):
+        rawtext = u"text"
+        revid = None
+
+    p = page()
+    assert templatecache.get_key(u"Template:T", p) != templatecache.get_key(u"Template:U", p)
+    p.revid = 5
+    assert templatecache.get_key(u"Template:T", p) == (u"Template:T", 5)
+
+
+def test_size_bound():
+    c = templatecache(maxsize=10)
+    c.put("a", "A", {}, 4)
+    c.put("b", "B", {}, 4)
+    assert c.get("a") == ("A", {})
+    c.put("c", "C", {}, 4)  # evicts b, a was used more recently
+    assert c.get("b") is None
+    assert c.get("c") == ("C", {})
+    c.put("d", "D", {}, 11)  # larger than the cache
+    assert c.get("d") is None
+
+    stats = c.stats()
+    assert stats["size"] == 8
+    assert stats["evictions"] == 1
+    assert (stats["hits"], stats["misses"]) == (2, 2)
+    assert stats["hitrate"] == 0.5
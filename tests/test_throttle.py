@@ -0,0 +1,76 @@
+#! /usr/bin/env py.test
+
+import time, socket, urllib2
+import gevent
+
+from mwlib.net.throttle import aimd, is_congestion
+
+
+def test_increase_while_latency_is_flat():
+    a = aimd(initial=2, maximum=5)
+    for i in range(20):
+        a.success(time.time())
+    assert a.window == 5
+
+
+def test_no_increase_when_latency_grows():
+    a = aimd(initial=2, maximum=5)
+    a.success(time.time() - 0.1)
+    a.success(time.time() - 1.0)
+    assert a.window == 2.5
+    a.success(time.time() - 1.0)
+    assert a.window == 2.5
+
+
+def test_decrease():
+    a = aimd(initial=8)
+    start = time.time()
+    a.failure(start)
+    assert a.window == 4
+    # a second request started before the decrease doesn't count again
+    a.failure(start)
+    assert a.window == 4
+    a.failure(time.time())
+    assert a.window == 2
+    for i in range(5):
+        a.failure(time.time())
+    assert a.window == 1
+
+
+def test_acquire_blocks():
+    a = aimd(initial=2)
+    running = []
+
+    def worker(i):
+        with a:
+            running.append(a.active)
+            gevent.sleep(0.01)
+
+    gevent.joinall([gevent.spawn(worker, i) for i in range(6)])
+    assert max(running) == 2
+    assert a.active == 0
+
+
+def test_is_congestion():
+    assert is_congestion(urllib2.HTTPError("http://x", 503, "unavailable", {}, None))
+    assert is_congestion(urllib2.HTTPError("http://x", 429, "too many", {}, None))
+    assert not is_congestion(urllib2.HTTPError("http://x", 404, "not found", {}, None))
+    assert is_congestion(urllib2.URLError(socket.timeout("timed out")))
+    assert is_congestion(socket.timeout())
+    assert not is_congestion(ValueError())
+
+
+def test_retry_delay():
+    from mwlib.net.throttle import retry_delay, retry_budget, maxlag_error
+    err = urllib2.HTTPError("http://x", 503, "unavailable", {}, None)
+    for attempt in range(4):
+        assert 0 <= retry_delay(err, attempt, 5) <= 0.5 * 2 ** (attempt + 1)
+    assert retry_delay(err, 5, 5) is None
+    assert retry_delay(ValueError(), 0, 5) is None
+    assert 3 <= retry_delay(maxlag_error("lagged", retry_after=3), 0, 5) <= 3.5
+
+    budget = retry_budget(2)
+    assert retry_delay(err, 0, 5, budget) is not None
+    assert retry_delay(err, 0, 5, budget) is not None
+    assert retry_delay(err, 0, 5, budget) is None
+    assert budget.retries == 2